@@ -0,0 +1,150 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any
+
+import httpx
+
+# Closed-loop load generator: `concurrency` workers each issue requests back to back for `duration` seconds.
+#
+# Targets are either the app in-process over ASGI (framework overhead only, no network or server) or a uvicorn
+# subprocess over a real socket (end to end, server and load generator on separate interpreters).
+
+TOKEN = "secretapikey456"
+
+
+class Scenario:
+    def __init__(self, name: str, method: str, path: str, json: Any = None, authenticated: bool = False):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.json = json
+        self.authenticated = authenticated
+
+    def headers(self) -> dict[str, str]:
+        return {"Authorization": "Bearer %s" % TOKEN} if self.authenticated else {}
+
+
+SCENARIOS = [
+    Scenario("static", "GET", "/static"),
+    Scenario("row", "GET", "/row"),
+    Scenario("list", "GET", "/list"),
+    Scenario("mutation", "POST", "/touch"),
+    Scenario("authenticated", "GET", "/me", authenticated=True),
+    Scenario("streaming", "GET", "/stream"),
+]
+
+
+def percentile(latencies: list[float], q: float) -> float:
+    # Nearest rank over already sorted latencies
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def summarise(latencies: list[float], errors: int, elapsed: float) -> dict[str, float]:
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p90": percentile(latencies, 0.90),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else 0.0,
+    }
+
+
+async def drive(client: httpx.AsyncClient, scenario: Scenario, concurrency: int, duration: float, warmup: float = 0.5) -> dict[str, float]:
+    headers = scenario.headers()
+    latencies: list[float] = []
+    errors = 0
+
+    async def worker(until: float, record: bool):
+        nonlocal errors
+        while time.perf_counter() < until:
+            t_start = time.perf_counter()
+            try:
+                resp = await client.request(scenario.method, scenario.path, json=scenario.json, headers=headers)
+                await resp.aread()
+                ok = resp.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            if record:
+                if ok:
+                    latencies.append(time.perf_counter() - t_start)
+                else:
+                    errors += 1
+
+    if warmup > 0:
+        await asyncio.gather(*(worker(time.perf_counter() + warmup, False) for _ in range(concurrency)))
+    t_start = time.perf_counter()
+    await asyncio.gather(*(worker(t_start + duration, True) for _ in range(concurrency)))
+    return summarise(latencies, errors, time.perf_counter() - t_start)
+
+
+def _headers() -> dict[str, str]:
+    return {"Accept": "application/json", "Content-Type": "application/json"}
+
+
+async def inprocess(scenarios: list[Scenario], concurrency: list[int], duration: float) -> dict[str, dict]:
+    import benchmark.load.app  # noqa: F401
+    from unrest import Server
+
+    transport = httpx.ASGITransport(app=Server()) # type:ignore
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=_headers()) as client:
+        return {"%s@%d" % (s.name, c): await drive(client, s, c, duration) for s in scenarios for c in concurrency}
+
+
+def _port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait(port: int, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not start listening on port %d" % port)
+
+
+async def oversocket(scenarios: list[Scenario], concurrency: list[int], duration: float) -> dict[str, dict]:
+    port = _port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmark.load.app:server", "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        env=os.environ.copy(),
+    )
+    try:
+        _wait(port)
+        limits = httpx.Limits(max_connections=max(concurrency), max_keepalive_connections=max(concurrency))
+        async with httpx.AsyncClient(base_url="http://127.0.0.1:%d" % port, headers=_headers(), limits=limits) as client:
+            return {"%s@%d" % (s.name, c): await drive(client, s, c, duration) for s in scenarios for c in concurrency}
+    finally:
+        server.terminate()
+        server.wait(10)
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float = 0.1) -> list[str]:
+    # Regressions beyond `tolerance` (relative) in throughput or median and tail latency, for keys in both runs
+    regressions = []
+    for key, now in results.items():
+        then = baseline.get(key)
+        if then is None:
+            continue
+        if then["rps"] and now["rps"] < then["rps"] * (1.0 - tolerance):
+            regressions.append("%s: %.0f rps, was %.0f" % (key, now["rps"], then["rps"]))
+        for q in ("p50", "p99"):
+            if then[q] and now[q] > then[q] * (1.0 + tolerance):
+                regressions.append("%s: %s %.2fms, was %.2fms" % (key, q, now[q] * 1000, then[q] * 1000))
+        if now["errors"] > then["errors"]:
+            regressions.append("%s: %d errors, was %d" % (key, now["errors"], then["errors"]))
+    return regressions
@@ -0,0 +1,43 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+# Successful requests only: access logs would otherwise dominate what is being measured
+os.environ.setdefault("UNREST_ACCESS_LOG_SAMPLE", "0")
+
+from benchmark.load import SCENARIOS, compare, inprocess, oversocket
+
+parser = argparse.ArgumentParser(description="Load tests against a local Postgres (run `unrest db reset` first)")
+parser.add_argument("--mode", choices=("asgi", "socket"), default="asgi", help="in-process over ASGI, or a uvicorn server over a socket")
+parser.add_argument("-k", dest="pattern", default="", help="only run scenarios whose name contains this")
+parser.add_argument("-c", dest="concurrency", default="1,10,50", help="comma separated concurrency levels")
+parser.add_argument("-d", dest="duration", type=float, default=5.0, help="seconds per scenario and concurrency")
+parser.add_argument("--json", dest="output", help="write results to this file")
+parser.add_argument("--baseline", help="compare against results previously written with --json")
+parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression")
+args = parser.parse_args()
+
+scenarios = [s for s in SCENARIOS if args.pattern in s.name]
+concurrency = [int(c) for c in args.concurrency.split(",")]
+run = inprocess if args.mode == "asgi" else oversocket
+results = asyncio.run(run(scenarios, concurrency, args.duration))
+
+print("%-24s %10s %8s %10s %10s %10s %10s" % ("scenario", "rps", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+for key, r in results.items():
+    print("%-24s %10.0f %8d %10.2f %10.2f %10.2f %10.2f" % (key, r["rps"], r["errors"], r["p50"] * 1000, r["p90"] * 1000, r["p99"] * 1000, r["max"] * 1000))
+
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump({"mode": args.mode, "results": results}, f, indent=2, sort_keys=True)
+
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("mode") != args.mode:
+        print("WARNING: baseline was recorded in %s mode" % baseline.get("mode"))
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for line in regressions:
+        print("REGRESSION %s" % line)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,84 @@
+import json
+
+from unrest import Payload, Server, api, auth, db, http
+
+# Endpoints exercised by the load harness, against the test migration's users table
+
+
+class User(Payload):
+    id: str
+    email: str
+
+
+@db.query
+def user_by_email(email: str):
+    return db.fetchrow("select id, email from users where email = $1", email)
+
+
+@db.query
+def all_users():
+    return db.fetch("select id, email from users order by email")
+
+
+@db.query
+def api_user(token: str):
+    return db.fetchrow("select id, email, claims from users where apikey = $1", token)
+
+
+@db.mutate
+def touch_user(email: str):
+    return db.execute("update users set claims = claims where email = $1", email)
+
+
+@api.authentication("bearer", cache=auth.AuthCache())
+async def authenticate(token: str | None, url: http.URL) -> auth.AuthResponse:
+    if token:
+        props = await db._fetchrow("select id, email, claims from users where apikey = $1", token)
+        if props:
+            return auth.AuthenticatedUser(identity=props["id"], display_name=props["email"], claims=props["claims"]), None
+    return auth.UnauthenticatedUser(), None
+
+
+@api.query("/static", auth.Unrestricted)
+async def static() -> User:
+    return User(id="123", email="foo@bar.com")
+
+
+@api.query("/row", auth.Unrestricted)
+async def row() -> User:
+    async with user_by_email("bar@example.com") as result:
+        return result
+
+
+@api.query("/list", auth.Unrestricted)
+async def rows() -> list[User]:
+    async with all_users() as result:
+        return result
+
+
+@api.mutate("/touch", auth.Unrestricted)
+async def touch() -> None:
+    async with touch_user("bar@example.com"):
+        return None
+
+
+@api.query("/me", auth.Claim("support"))
+async def me() -> User:
+    return User(id="456", email="bar@example.com")
+
+
+@api.query("/stream", auth.Unrestricted)
+async def stream():
+    # NB: the user context ends with the handler, so rows are fetched here and only the encoding is streamed
+    async with all_users() as result:
+        users = [dict(r) for r in result]
+
+    async def body():
+        for _ in range(20):
+            for user in users:
+                yield json.dumps(user) + "\n"
+
+    return http.StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+server = Server()
@@ -0,0 +1,43 @@
+import asyncio
+import time
+from inspect import iscoroutinefunction
+from typing import Callable
+
+# Each case performs `n` iterations of the operation under test
+_cases: dict[str, Callable] = {}
+
+
+def case(f: Callable) -> Callable:
+    _cases["%s.%s" % (f.__module__.rsplit(".", 1)[-1], f.__name__)] = f
+    return f
+
+
+def measure(f: Callable, number: int = 10000, repeat: int = 5) -> float:
+    # Best of `repeat` runs, in nanoseconds per iteration
+    loop = asyncio.new_event_loop() if iscoroutinefunction(f) else None
+    try:
+        best = float("inf")
+        for _ in range(repeat):
+            t_start = time.perf_counter_ns()
+            if loop is not None:
+                loop.run_until_complete(f(number))
+            else:
+                f(number)
+            best = min(best, (time.perf_counter_ns() - t_start) / number)
+        return best
+    finally:
+        if loop is not None:
+            loop.close()
+
+
+def run(pattern: str = "", number: int = 10000, repeat: int = 5) -> dict[str, float]:
+    return {name: measure(f, number, repeat) for name, f in _cases.items() if pattern in name}
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], tolerance: float = 0.2) -> list[str]:
+    # Cases more than `tolerance` (relative) slower than in the baseline; cases missing from either are ignored
+    return [
+        "%s: %.0f ns/op, was %.0f (%+.0f%%)" % (name, ns, baseline[name], (ns / baseline[name] - 1.0) * 100)
+        for name, ns in results.items()
+        if baseline.get(name) and ns > baseline[name] * (1.0 + tolerance)
+    ]
@@ -0,0 +1,29 @@
+import argparse
+import json
+import sys
+
+from benchmark.micro import auth, compare, context, logs, payload, profiling, run, sql  # noqa: F401
+
+parser = argparse.ArgumentParser(description="Micro-benchmarks for framework internals (no database required)")
+parser.add_argument("-k", dest="pattern", default="", help="only run cases whose name contains this")
+parser.add_argument("-n", dest="number", type=int, default=10000, help="iterations per run")
+parser.add_argument("-r", dest="repeat", type=int, default=5, help="runs per case (best is reported)")
+parser.add_argument("--json", dest="output", help="write results to this file")
+parser.add_argument("--baseline", help="compare against results previously written with --json")
+parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as a regression")
+args = parser.parse_args()
+
+results = run(args.pattern, args.number, args.repeat)
+for name, ns in results.items():
+    print("%-40s %12.0f ns/op" % (name, ns))
+
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+if args.baseline:
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for line in regressions:
+        print("REGRESSION %s" % line)
+    sys.exit(1 if regressions else 0)
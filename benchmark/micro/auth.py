@@ -0,0 +1,39 @@
+from benchmark.micro import case
+from unrest import query
+from unrest.contexts import auth, requestcontext, usercontext
+
+roles = [auth.Claim("role%d" % i) for i in range(16)]
+user = auth.AuthenticatedUser(identity="1", display_name="bench", claims={"role15": True, "role7": False})
+
+# (role0 & ~role1) | (role2 & ~role3) | ... , 16 claims deep
+deep = auth.UserIsAuthenticated
+for i in range(0, 16, 2):
+    deep = deep & ((roles[i] & ~roles[i + 1]) | roles[15])
+
+
+@query(deep)
+async def guarded():
+    return None
+
+
+@case
+def claim(n: int):
+    check = roles[15]
+    with usercontext(user):
+        for _ in range(n):
+            check(user)
+
+
+@case
+def deep_predicate(n: int):
+    with usercontext(user):
+        for _ in range(n):
+            deep(user)
+
+
+@case
+async def deep_predicate_query(n: int):
+    with usercontext(user):
+        with requestcontext():
+            for _ in range(n):
+                await guarded()
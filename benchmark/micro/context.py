@@ -0,0 +1,61 @@
+from benchmark.micro import case
+from unrest import context, query
+from unrest.contexts import auth, usercontext
+from unrest.contexts._context import get, operationalcontext
+
+user = auth.AuthenticatedUser(identity="1", display_name="bench", claims={"admin": True})
+
+
+@query(auth.Unrestricted)
+async def noop():
+    return None
+
+
+@case
+def nested_context(n: int):
+    for _ in range(n):
+        with context(a=1, b=2):
+            with context(c=3):
+                with context(a=4):
+                    context["b"]
+
+
+@case
+def context_lookup(n: int):
+    with context(a=1):
+        with context(b=2):
+            for _ in range(n):
+                context["a"]
+                context.user
+                context.tenant
+
+
+@case
+def context_copy(n: int):
+    with context(a=1, b=2):
+        with context(c=3):
+            ctx = get()
+            for _ in range(n):
+                ctx.copy()
+
+
+@case
+def user_context(n: int):
+    for _ in range(n):
+        with usercontext(user):
+            pass
+
+
+@case
+async def operational_context(n: int):
+    with usercontext(user):
+        for _ in range(n):
+            async with operationalcontext(False, noop, auth.Unrestricted):
+                pass
+
+
+@case
+async def query_call(n: int):
+    with usercontext(user):
+        for _ in range(n):
+            await noop()
@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+import time
+from queue import SimpleQueue
+
+from benchmark.micro import case
+from unrest import context, http, routing
+from unrest.contexts import auth, usercontext
+from unrest.contexts.observability import QueueHandler, Writer, formatter
+from unrest.routing import Endpoint, Service
+
+# Caller-side cost of one access-log style record, i.e. the latency a request pays for logging, and the latency of a
+# whole (in-process) request that logs while other threads are logging heavily
+
+user = auth.AuthenticatedUser(identity="1", display_name="bench", claims={"admin": True})
+devnull = open(os.devnull, "w")
+
+
+def _logger(name: str, handler: logging.Handler) -> logging.Logger:
+    handler.setFormatter(formatter)
+    log = logging.getLogger("benchmark.%s" % name)
+    log.handlers = [handler]
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    return log
+
+
+def _emit(log: logging.Logger, n: int):
+    with usercontext(user):
+        with context(route="/bench"):
+            for _ in range(n):
+                log.info("GET /bench 200 0.001", extra={"request": {"method": "GET", "path": "/bench", "status": 200, "time": 0.001}})
+
+
+@case
+def log_sync(n: int):
+    _emit(_logger("sync", logging.StreamHandler(devnull)), n)
+
+
+@case
+def log_enqueue(n: int):
+    # Caller only: the writer drains while the loop would otherwise be waiting on I/O
+    queue: SimpleQueue = SimpleQueue()
+    _emit(_logger("enqueue", QueueHandler(queue, maxsize=n)), n)
+
+
+@case
+def log_queued(n: int):
+    # End to end, including draining the queue (the writer competes for the GIL)
+    queue: SimpleQueue = SimpleQueue()
+    handler = QueueHandler(queue, maxsize=n)
+    writer = Writer(queue, handler, stream=devnull)
+    writer.start()
+    try:
+        _emit(_logger("queued", handler), n)
+    finally:
+        writer.stop(timeout=60)
+
+
+@case
+def log_disabled(n: int):
+    log = _logger("disabled", logging.StreamHandler(devnull))
+    log.setLevel(logging.WARNING)
+    _emit(log, n)
+
+
+@case
+def log_format(n: int):
+    # Formatter only, as paid by the writer thread (or the caller when logging synchronously)
+    record = logging.LogRecord("benchmark", logging.INFO, __file__, 1, "GET /bench 200 0.001", None, None)
+    record.request = {"method": "GET", "path": "/bench", "status": 200, "time": 0.001}
+    with usercontext(user):
+        with context(route="/bench"):
+            for _ in range(n):
+                record.__dict__.pop("context", None)
+                formatter.format(record)
+
+
+async def _handler():
+    return None
+
+endpoint = Endpoint(_handler, Service())
+request = http.Request({"type": "http", "method": "GET", "path": "/bench", "query_string": b"", "headers": []})
+
+
+@case
+def access_log_sampled_out(n: int):
+    endpoint.sample = 0.0
+    t_start = time.perf_counter()
+    for _ in range(n):
+        endpoint.access(request, 200, t_start)
+
+
+@case
+def access_log_disabled(n: int):
+    endpoint.sample = 1.0
+    level = routing.log.level
+    routing.log.setLevel(logging.WARNING)
+    try:
+        t_start = time.perf_counter()
+        for _ in range(n):
+            endpoint.access(request, 200, t_start)
+    finally:
+        routing.log.setLevel(level)
+
+
+class _Endpoint(Endpoint):
+    # The request path without HTTP decoding and encoding
+    async def decode(self, req: http.Request) -> tuple[list, dict]:
+        return [], {}
+
+    async def encode(self, req: http.Request, resp) -> http.Response:
+        return http.Response(status_code=200)
+
+
+routed = _Endpoint(_handler, Service(), sample=1.0)
+
+
+def _flood(log: logging.Logger, stop: threading.Event):
+    # Roughly 100k records a second from another thread, as from other requests, tasks and libraries
+    while not stop.is_set():
+        for _ in range(100):
+            log.info("GET /other 200 0.001", extra={"request": {"method": "GET", "path": "/other", "status": 200, "time": 0.001}})
+        time.sleep(0.001)
+
+
+async def _requests(n: int, handler: logging.Handler, flood: bool):
+    handler.setFormatter(formatter)
+    handlers, propagate = routing.log.handlers, routing.log.propagate
+    routing.log.handlers, routing.log.propagate = [handler], False
+    stop = threading.Event()
+    flooding = threading.Thread(target=_flood, args=(routing.log, stop), daemon=True) if flood else None
+    if flooding is not None:
+        flooding.start()
+    try:
+        for _ in range(n):
+            await routed(request)
+    finally:
+        stop.set()
+        if flooding is not None:
+            flooding.join()
+        routing.log.handlers, routing.log.propagate = handlers, propagate
+
+
+async def _queued(n: int, flood: bool):
+    queue: SimpleQueue = SimpleQueue()
+    handler = QueueHandler(queue, maxsize=10000)
+    writer = Writer(queue, handler, stream=devnull)
+    writer.start()
+    try:
+        await _requests(n, handler, flood)
+    finally:
+        writer.stop(timeout=60)
+
+
+@case
+async def request_log_sync(n: int):
+    await _requests(n, logging.StreamHandler(devnull), False)
+
+
+@case
+async def request_log_sync_flooded(n: int):
+    await _requests(n, logging.StreamHandler(devnull), True)
+
+
+@case
+async def request_log_queued(n: int):
+    await _queued(n, False)
+
+
+@case
+async def request_log_queued_flooded(n: int):
+    await _queued(n, True)
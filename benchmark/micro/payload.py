@@ -0,0 +1,80 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import UUID
+
+from benchmark.micro import case
+from unrest import Payload, http
+from unrest.api import ApiEndpoint
+from unrest.api.payload import JSONEncoder, JSONResponse, PayloadResponse
+from unrest.routing import Service
+
+
+class Item(Payload):
+    id: str
+    email: str
+    tags: list[str]
+
+
+class Search(Payload):
+    email: str
+    limit: int
+
+
+async def search(req: Search, group: str, page: int = 1) -> list[Item]:
+    return []
+
+endpoint = ApiEndpoint(search, Service())
+body = json.dumps({"email": "foo@bar.com", "limit": 10}).encode()
+items = [Item(id=str(i), email="user%d@example.com" % i, tags=["a", "b"]) for i in range(100)]
+rows = [{"id": UUID(int=i), "created": datetime(2024, 1, 1), "day": date(2024, 1, 1), "amount": Decimal("1.5")} for i in range(100)]
+
+
+def _request() -> http.Request:
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+    scope = {"type": "http", "method": "QUERY", "path": "/search/g", "query_string": b"page=2", "headers": [], "path_params": {"group": "g"}}
+    return http.Request(scope, receive)
+
+
+@case
+async def endpoint_decode(n: int):
+    for _ in range(n):
+        await endpoint.decode(_request())
+
+
+@case
+async def endpoint_encode(n: int):
+    request = _request()
+    for _ in range(n):
+        await endpoint.encode(request, items)
+
+
+@case
+def payload_render(n: int):
+    response = PayloadResponse(items[:1])
+    for _ in range(n):
+        response.render(items)
+
+
+@case
+def payload_render_dicts(n: int):
+    response = PayloadResponse(items[:1])
+    dicts = [{"id": str(i), "email": "user%d@example.com" % i} for i in range(100)]
+    for _ in range(n):
+        response.render(dicts)
+
+
+@case
+def json_encoder_default(n: int):
+    # UUID, datetime, date and Decimal all go through JSONEncoder.default
+    response = JSONResponse(None)
+    for _ in range(n):
+        response.render(rows)
+
+
+@case
+def json_encoder_payload(n: int):
+    encoder = JSONEncoder()
+    for _ in range(n):
+        encoder.default(items[0])
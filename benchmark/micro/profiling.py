@@ -0,0 +1,42 @@
+import asyncio
+import logging
+
+from benchmark.micro import case
+from unrest import http, profiling, routing
+from unrest.api import ApiEndpoint
+from unrest.routing import Service
+
+# Whole-endpoint cost with the profiler off, and with every request sampled
+
+
+async def _handler():
+    return {"ok": True}
+
+endpoint = ApiEndpoint(_handler, Service())
+request = http.Request({"type": "http", "method": "GET", "path": "/bench", "query_string": b"", "headers": []})
+
+
+def _run(n: int, sample: float):
+    async def loop():
+        for _ in range(n):
+            await endpoint(request)
+
+    previous = profiling._sample
+    level = routing.log.level
+    profiling.configure(sample=sample)
+    routing.log.setLevel(logging.WARNING)
+    try:
+        asyncio.run(loop())
+    finally:
+        profiling.configure(sample=previous)
+        routing.log.setLevel(level)
+
+
+@case
+def endpoint_unprofiled(n: int):
+    _run(n, 0.0)
+
+
+@case
+def endpoint_profiled(n: int):
+    _run(n, 1.0)
@@ -0,0 +1,46 @@
+from benchmark.micro import case
+from unrest import db
+from unrest.contexts import auth, usercontext
+from unrest.db.sql import SqlExpression
+
+user = auth.AuthenticatedUser(identity="1", display_name="bench", claims={"admin": True})
+
+
+@db.query
+def users_by_domain(domain: str):
+    return db.fetch("select * from users where email like '%@' || $1", domain)
+
+
+@db.query
+def some_users_by_domain(domain: str, n: int = 5):
+    return db.fetch("select * from $1 limit $2", users_by_domain(domain), n)
+
+
+@db.query
+def admins_among(domain: str):
+    # Shares users_by_domain with some_users_by_domain, which is compiled once
+    return db.fetch("select a.* from $1 a join $2 b using (id) where a.claims ? 'admin'", some_users_by_domain(domain), users_by_domain(domain))
+
+
+@case
+def sql_compile(n: int):
+    with usercontext(user):
+        frag = users_by_domain("example.com")
+        for _ in range(n):
+            str(SqlExpression(frag))
+
+
+@case
+def sql_compile_composed(n: int):
+    with usercontext(user):
+        frag = admins_among("example.com")
+        for _ in range(n):
+            str(SqlExpression(frag))
+
+
+@case
+def sql_build_and_compile(n: int):
+    # Including building the fragments, as a request would
+    with usercontext(user):
+        for _ in range(n):
+            str(SqlExpression(admins_among("example.com")))
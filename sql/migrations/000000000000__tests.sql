@@ -25,3 +25,20 @@ INSERT INTO users (email, claims, apikey) VALUES
     ('rst@example.com', '{"admin": true}'::jsonb, NULL),
     ('uvw@example.com', '{"developer": true}'::jsonb, NULL);
 
+
+CREATE TABLE notes (
+    id serial,
+    tenant_id text not null,
+    body text not null
+);
+
+INSERT INTO notes (tenant_id, body) VALUES
+    ('acme', 'first'),
+    ('acme', 'second'),
+    ('globex', 'third');
+GRANT USAGE ON SEQUENCE notes_id_seq TO readwrite_access;
+
+-- Generated by unrest.db.rls.policy("notes", auth.Claim("support"), tenant="tenant_id")
+ALTER TABLE notes ENABLE ROW LEVEL SECURITY;
+CREATE POLICY notes__unrest_query ON notes FOR SELECT USING (tenant_id::text = rls_tenant() AND rls_claim('support', false));
+CREATE POLICY notes__unrest_mutate ON notes FOR ALL USING (tenant_id::text = rls_tenant() AND rls_claim('support', true)) WITH CHECK (tenant_id::text = rls_tenant() AND rls_claim('support', true));
@@ -0,0 +1,80 @@
+import asyncio
+import contextvars
+
+from pytest import mark
+
+from unrest import Server, api, auth
+from unrest.admission import Limiter
+from unrest.api import Client
+
+
+@mark.asyncio(loop_scope="session")
+async def test_queue_and_priority():
+    limiter = Limiter(1, queue=2, timeout=1.0)
+    assert await limiter.acquire()
+
+    order = []
+    async def wait(name: str, priority: bool):
+        if await limiter.acquire(priority):
+            order.append(name)
+            limiter.release()
+
+    query = asyncio.create_task(wait("query", False))
+    await asyncio.sleep(0)
+    mutation = asyncio.create_task(wait("mutation", True))
+    await asyncio.sleep(0)
+    assert limiter.queued == 2
+
+    # The queue is full
+    assert not await limiter.acquire()
+    assert limiter.rejected == 1
+
+    # Mutations are admitted first
+    limiter.release()
+    await asyncio.gather(query, mutation)
+    assert order == ["mutation", "query"]
+    assert limiter.inflight == 0
+
+
+@mark.asyncio(loop_scope="session")
+async def test_wait_deadline():
+    limiter = Limiter(1, queue=10, timeout=0.05)
+    assert await limiter.acquire()
+    assert not await limiter.acquire()
+    assert limiter.rejected == 1 and limiter.queued == 0
+    limiter.release()
+    assert limiter.inflight == 0
+
+
+def test_adaptive_limit():
+    limiter = Limiter(10, target=0.1)
+    limiter.inflight = 10
+    for _ in range(10):
+        limiter.release(0.01)
+        limiter.inflight += 1
+    assert limiter.limit == 11
+
+    limiter.release(1.0)
+    assert limiter.limit == 9
+    # Only once per target interval
+    limiter.release(1.0)
+    assert limiter.limit == 9
+
+
+limited = Limiter(1, queue=0, timeout=1.0)
+
+@api.query("/limited", auth.Unrestricted, limiter=limited)
+async def limited_query() -> None:
+    await asyncio.sleep(0.05)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_load_shedding():
+    client = Client(Server())
+    first = asyncio.create_task(client.query("/limited"), context=contextvars.Context())
+    await asyncio.sleep(0.01)
+    resp = await client.query("/limited")
+    assert resp.status_code == 503
+    assert resp.headers["retry-after"] == "1"
+    assert (await first).status_code == 202
+    assert limited.name == "tests.test_admission.limited_query"
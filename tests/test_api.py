@@ -1,14 +1,35 @@
-
-from pytest import fixture, raises, mark
-from unrest import context, Payload, getLogger, auth, Unauthorized, query, mutate, ContextError
-from unrest import api, auth, http
-
-from unrest import Server
-from unrest.api import Client
-
+import asyncio
 import base64
-
-from unrest.contexts.auth import AuthResponse
+import contextvars
+import time
+
+from pytest import fixture, mark, raises
+
+from unrest import (
+    ClientError,
+    ContextError,
+    Payload,
+    Server,
+    Unauthorized,
+    api,
+    auth,
+    context,
+    getLogger,
+    http,
+    metrics,
+    mutate,
+    offload,
+    profiling,
+    query,
+    usercontext,
+)
+from unrest.api import Client, encoding
+from unrest.api.batch import Operation, resolve
+from unrest.api.batch import run as run_operation
+from unrest.api.cache import cachekey
+from unrest.contexts import requestcontext
+from unrest.contexts._context import get
+from unrest.routing import get_pool
 
 log = getLogger(__name__)
 
@@ -151,3 +172,388 @@ async def test_happy_path_indirectly(client: Client):
 
     resp = await client.query("/also_protected")        
     assert resp.status_code == 401
+
+
+def whoami(n: int) -> tuple:
+    return n * n, context.user.display_name, context.tenant.identity, context["flag"]
+
+threaded_whoami = offload("thread")(whoami)
+
+@offload("process")
+def forked_whoami(n: int) -> tuple:
+    return whoami(n)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_offload_propagates_context():
+    tenant = auth.Tenant(identity="t1")
+    with usercontext(auth.AuthenticatedUser(identity="123", display_name="jon"), tenant):
+        with context(flag="on"):
+            assert await threaded_whoami(3) == (9, "jon", "t1", "on")
+            assert await forked_whoami(4) == (16, "jon", "t1", "on")
+
+    stats = get_pool("process").stats()
+    assert stats["submitted"] == stats["completed"] == 1
+    assert stats["inflight"] == stats["queued"] == 0
+    get_pool("process").shutdown()
+
+    # Failures are counted apart from completions
+    before = get_pool("thread").stats()
+    with raises(KeyError):
+        await threaded_whoami(2)  # no flag set
+    stats = get_pool("thread").stats()
+    assert stats["failed"] == before["failed"] + 1 and stats["completed"] == before["completed"]
+
+    with raises(RuntimeError):
+        offload()(an_example_mutation)
+
+
+@api.query("/sampled/{n:int}", auth.Unrestricted, sample=0.0)
+async def sampled(n: int) -> None:
+    if n > 0:
+        raise RuntimeError("Oh noes!")
+
+
+@mark.asyncio(loop_scope="session")
+async def test_access_log_sampling(client: Client, caplog):
+    def access():
+        return [r for r in caplog.records if r.name == "unrest.routing" and hasattr(r, "request")]
+
+    resp = await client.query("/sampled/0")
+    assert resp.is_success
+    assert access() == []
+
+    # Errors are always logged
+    resp = await client.query("/sampled/1")
+    assert resp.status_code == 500
+    assert [r.request["status"] for r in access()] == [500]
+
+
+@api.query("/measured", auth.Unrestricted)
+async def measured() -> ExampleResponse:
+    return ExampleResponse(id="1", email="foo@bar.com")
+
+
+@mark.asyncio(loop_scope="session")
+async def test_metrics_endpoint(client: Client):
+    resp = await client.query("/measured")
+    assert resp.is_success
+
+    # Served without authentication, content negotiation or a route
+    resp = await Client(Server()).get("/metrics", headers={"Accept": "text/plain"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    lines = resp.text.splitlines()
+    assert 'unrest_requests_total{route="tests.test_api.measured",method="GET",status="200"} 1' in lines
+    assert 'unrest_request_duration_seconds_count{route="tests.test_api.measured"} 1' in lines
+    assert 'unrest_request_duration_seconds_bucket{route="tests.test_api.measured",le="+Inf"} 1' in lines
+    assert 'unrest_requests_inflight{route="tests.test_api.measured"} 0' in lines
+
+
+
+def test_broken_collector(caplog):
+    @metrics.collector
+    def broken():
+        raise RuntimeError("No pool")
+
+    try:
+        assert "unrest_request_duration_seconds" in metrics.render()
+        assert "No pool" in caplog.text
+    finally:
+        metrics._collectors.remove(broken)
+
+
+api.profiles("/profiles", auth.Unrestricted)
+
+def _busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+@api.query("/profiled", auth.Unrestricted)
+async def profiled() -> ExampleResponse:
+    _busy(0.05)
+    await asyncio.sleep(0.05)
+    return ExampleResponse(id="1", email="foo@bar.com")
+
+
+@mark.asyncio(loop_scope="session")
+async def test_profiling(client: Client, monkeypatch):
+    # Off unless sampled or asked for with the right token
+    monkeypatch.setattr(profiling, "_token", "secret")
+    monkeypatch.setattr(profiling, "enabled", True)
+    assert (await client.query("/profiled", headers={profiling.HEADER: "wrong"})).is_success
+    assert "tests.test_api.profiled" not in (await client.query("/profiles")).json()
+
+    assert (await client.query("/profiled", headers={profiling.HEADER: "secret"})).is_success
+    summary = (await client.query("/profiles")).json()["tests.test_api.profiled"]
+    assert summary["requests"] == 1 and summary["samples"] > 0
+    assert not profiling._sampler.active
+
+    resp = await client.query("/profiles", params={"route": "tests.test_api.profiled"})
+    assert resp.headers["content-type"].startswith("text/plain")
+    stacks = resp.text.splitlines()
+    assert any("_busy" in line for line in stacks)
+    assert any("(waiting)" in line and "sleep" in line for line in stacks)
+    assert all(line.startswith("Endpoint.__call__ (routing.py:") for line in stacks)
+
+
+def test_negotiate_encoding():
+    assert encoding.negotiate("gzip, deflate") == "gzip"
+    assert encoding.negotiate("gzip;q=0, deflate") is None
+    assert encoding.negotiate("*") == encoding._encodings[0]
+    assert encoding.negotiate("identity") is None
+    assert encoding.matches('W/"abc", "def"', '"abc"') and not encoding.matches('"abc"', '"abc-gzip"')
+
+
+@mark.asyncio(loop_scope="session")
+async def test_compression_and_etags(client: Client):
+    resp = await client.query("/list/100", ExampleRequest(email="foo@bar.com"), headers={"Accept-Encoding": "gzip"})
+    assert resp.status_code == 200
+    assert resp.headers["content-encoding"] == "gzip" and resp.headers["vary"] == "Accept-Encoding"
+    assert len(resp.json()) == 100
+    assert int(resp.headers["content-length"]) < len(resp.content)
+    tag = resp.headers["etag"]
+    assert tag.endswith('-gzip"')
+
+    # Repeat polls cost neither the body nor compressing it
+    resp = await client.query("/list/100", ExampleRequest(email="foo@bar.com"), headers={"Accept-Encoding": "gzip", "If-None-Match": tag})
+    assert resp.status_code == 304 and resp.content == b"" and resp.headers["etag"] == tag
+
+    # Tags are per encoding, and small bodies are not compressed
+    resp = await client.query("/list/100", ExampleRequest(email="foo@bar.com"), headers={"Accept-Encoding": "identity", "If-None-Match": tag})
+    assert resp.status_code == 200 and "content-encoding" not in resp.headers and resp.headers["etag"] != tag
+    resp = await client.query("/object/obj123", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in resp.headers and "etag" in resp.headers
+
+
+def concurrently(coro):
+    # NB: in-process requests otherwise share (and concurrently mutate) the test's own context
+    return asyncio.create_task(coro, context=contextvars.Context())
+
+
+cached_calls = {"n": 0}
+swr = api.QueryCache(ttl=60.0)
+
+@api.query("/cached", auth.Unrestricted, cache=api.QueryCache(ttl=60.0))
+async def cached(q: str = "") -> ExampleResponse:
+    cached_calls["n"] += 1
+    await asyncio.sleep(0.01)
+    return ExampleResponse(id=str(cached_calls["n"]), email=q)
+
+@api.query("/cached/stale", auth.Unrestricted, cache=swr)
+async def cached_stale() -> ExampleResponse:
+    cached_calls["n"] += 1
+    return ExampleResponse(id=str(cached_calls["n"]), email="")
+
+@api.query("/cached/admin", Roles.admin, cache=api.QueryCache(ttl=60.0))
+async def cached_admin() -> ExampleResponse:
+    return ExampleResponse(id="1", email="")
+
+
+@mark.asyncio(loop_scope="session")
+async def test_query_cache(client: Client):
+    # Concurrent misses share one handler call, then hits skip it
+    before = cached_calls["n"]
+    responses = await asyncio.gather(*(concurrently(client.query("/cached", params={"q": "a"})) for _ in range(5)))
+    assert cached_calls["n"] == before + 1
+    assert len({r.json()["id"] for r in responses}) == 1
+    resp = await client.query("/cached", params={"q": "a"})
+    assert cached_calls["n"] == before + 1
+    assert resp.headers["cache-control"].startswith("private, max-age=")
+    assert "age" in resp.headers
+
+    # Revalidation is answered from the cache, and other parameters are other entries
+    resp = await client.query("/cached", params={"q": "a"}, headers={"If-None-Match": resp.headers["etag"]})
+    assert resp.status_code == 304 and cached_calls["n"] == before + 1
+    resp = await client.query("/cached", params={"q": "b"})
+    assert resp.json()["email"] == "b" and cached_calls["n"] == before + 2
+
+    # Not authorized to run the handler, so not authorized to see its cached response either
+    resp = await client.query("/cached/admin")
+    assert resp.status_code == 401
+
+
+@mark.asyncio(loop_scope="session")
+async def test_query_cache_stale_while_revalidate(client: Client, monkeypatch):
+    first = (await client.query("/cached/stale")).json()["id"]
+    monkeypatch.setattr(swr, "ttl", 0.0)
+    monkeypatch.setattr(swr, "stale", 60.0)
+
+    # Served stale while a single refresh runs in the background
+    resp = await client.query("/cached/stale")
+    assert resp.json()["id"] == first
+    assert "stale-while-revalidate=60" in resp.headers["cache-control"]
+    while swr._tasks:
+        await asyncio.sleep(0.01)
+    assert swr.refreshes == 1
+    assert (await client.query("/cached/stale")).json()["id"] != first
+
+
+coalesced_calls = {"n": 0}
+
+@api.query("/coalesced", auth.Unrestricted, coalesce=True)
+async def coalesced(q: str = "") -> ExampleResponse:
+    coalesced_calls["n"] += 1
+    await asyncio.sleep(0.05)
+    return ExampleResponse(id=str(coalesced_calls["n"]), email=q)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_single_flight(client: Client):
+    before = coalesced_calls["n"]
+    responses = await asyncio.gather(
+        *(concurrently(client.query("/coalesced", params={"q": "a"})) for _ in range(5)),
+        concurrently(client.query("/coalesced", params={"q": "b"})),
+    )
+    assert all(r.status_code == 200 for r in responses)
+    # Identical requests share a call, other parameters do not
+    assert coalesced_calls["n"] == before + 2
+    assert len({r.json()["id"] for r in responses[:5]}) == 1
+
+    # Nothing is kept once the call completes
+    await client.query("/coalesced", params={"q": "a"})
+    assert coalesced_calls["n"] == before + 3
+
+
+abandoned_calls = {"n": 0}
+
+@api.query("/coalesced/slow", auth.Unrestricted, coalesce=True)
+async def coalesced_slow(q: str = "") -> ExampleResponse:
+    abandoned_calls["n"] += 1
+    await asyncio.sleep(0.1)
+    return ExampleResponse(id=str(abandoned_calls["n"]), email=q)
+
+@api.query("/cached/slow", auth.Unrestricted, cache=api.QueryCache(ttl=60.0))
+async def cached_slow(q: str = "") -> ExampleResponse:
+    return await coalesced_slow.__wrapped__(q)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_cancelled_leader(client: Client):
+    # The first request gives up, the others are still waiting for its call and one of them takes over
+    for path in ("/coalesced/slow", "/cached/slow"):
+        before = abandoned_calls["n"]
+        leader = concurrently(client.query(path, params={"q": "a"}, headers={"X-Request-Timeout": "0.03"}))
+        await asyncio.sleep(0.01)
+        followers = [concurrently(client.query(path, params={"q": "a"})) for _ in range(3)]
+        assert (await leader).status_code == 504
+        responses = await asyncio.gather(*followers)
+        assert [r.status_code for r in responses] == [200, 200, 200]
+        assert len({r.json()["id"] for r in responses}) == 1
+        assert abandoned_calls["n"] == before + 2
+
+
+@mark.asyncio(loop_scope="session")
+async def test_shared_responses_are_scoped():
+    request = http.Request({"type": "http", "method": "GET", "path": "/coalesced", "query_string": b"q=a", "headers": []})
+    alice = auth.AuthenticatedUser(identity="1", display_name="alice", claims={"admin": True})
+    bob = auth.AuthenticatedUser(identity="2", display_name="bob", claims={"admin": True})
+    carol = auth.AuthenticatedUser(identity="3", display_name="carol", claims={"admin": False})
+
+    async def keys(per_user: bool, tenant: str = "acme"):
+        found = []
+        for user in (alice, bob, carol):
+            with usercontext(user, auth.Tenant(identity=tenant)):
+                found.append(await cachekey(request, per_user))
+        return found
+
+    # Per user unless a cache opts in to sharing, then at least per tenant and claims
+    assert api.QueryCache().per_user and api.SingleFlight().per_user
+    assert len(set(await keys(True))) == 3
+    a, b, c = await keys(False)
+    assert a == b and a != c
+    assert a not in await keys(False, "globex")
+
+
+api.batch()
+
+@api.mutate("/fails", auth.Unrestricted)
+async def always_fails() -> None:
+    raise ClientError("Nope")
+
+
+@mark.asyncio(loop_scope="session")
+async def test_batch(client: Client):
+    resp = await client.batch([
+        {"path": "/object/obj1"},
+        {"path": "/list/3", "payload": ExampleRequest(email="foo@bar.com")},
+        {"path": "/cached", "params": {"q": "batched"}},
+        {"path": "/protected"},
+        {"path": "/missing"},
+        {"path": "/safe", "mutate": True},
+    ])
+    assert resp.status_code == 200
+    results = resp.json()
+    assert [r["status"] for r in results] == [200, 200, 200, 401, 404, 202]
+    assert results[0]["body"] == {"id": "obj1", "email": "foo@bar.com"}
+    assert [x["id"] for x in results[1]["body"]] == ["0", "1", "2"]
+    assert results[2]["body"]["email"] == "batched"
+
+    # A failed mutation rolls back the others
+    resp = await client.batch([{"path": "/safe", "mutate": True}, {"path": "/fails", "mutate": True}, {"path": "/safe", "mutate": True}])
+    assert [r["status"] for r in resp.json()] == [424, 400, 424]
+
+
+@mark.asyncio(loop_scope="session")
+async def test_batch_operations_restore_context():
+    request = http.Request({"type": "http", "method": "POST", "path": "/batch", "query_string": b"", "headers": []})
+    point, op = resolve(api.get_instance(), request, Operation(path="/object/obj1")) # type:ignore
+    with requestcontext(request):
+        ctx = get()
+        memo = ctx._memo
+        assert (await run_operation(point, op))[0] == 200
+        # The rest of the batch request sees its own request and permission checks again
+        assert ctx._request is request and ctx._memo is memo
+
+
+slow_cancelled = []
+
+@api.query("/slow", auth.Unrestricted, timeout=5.0)
+async def slow(seconds: float = 1.0):
+    try:
+        await asyncio.sleep(float(seconds))
+    except asyncio.CancelledError:
+        slow_cancelled.append(context.deadline is not None)
+        raise
+    return {"slept": seconds}
+
+
+@mark.asyncio(loop_scope="session")
+async def test_request_deadline(client: Client):
+    resp = await client.query("/slow", params={"seconds": "0"}, headers={"X-Request-Timeout": "1"})
+    assert resp.status_code == 200
+
+    resp = await client.query("/slow", params={"seconds": "2"}, headers={"X-Request-Timeout": "0.1"})
+    assert resp.status_code == 504
+    assert slow_cancelled == [True]
+
+    # The route's own timeout bounds whatever a client asks for
+    point = api.get_instance().endpoints[slow.__module__ + ".slow"]
+    request = http.Request({"type": "http", "method": "GET", "path": "/slow", "headers": [(b"x-request-timeout", b"60")]})
+    deadline = point.deadline(request)
+    assert deadline is not None and 4.0 < deadline - time.monotonic() <= 5.0
+
+
+@mark.asyncio(loop_scope="session")
+async def test_client_disconnect():
+    slow_cancelled.clear()
+    sent = []
+
+    async def receive():
+        if not sent:
+            sent.append(True)
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.sleep(0.1)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": "/slow", "raw_path": b"/slow",
+             "query_string": b"seconds=2", "root_path": "", "headers": [(b"host", b"test.app"), (b"accept", b"application/json")], "server": ("test.app", 80), "client": ("127.0.0.1", 1)}
+    t_start = time.monotonic()
+    await concurrently(Server()(scope, receive, send))
+    assert time.monotonic() - t_start < 1.0
+    assert slow_cancelled == [True]
+    assert sent[1]["status"] == 499
@@ -0,0 +1,265 @@
+import time
+from asyncio import CancelledError, create_task, gather, sleep
+from itertools import product
+
+from pytest import importorskip, mark, raises
+
+from unrest import auth, http
+from unrest.api import Api
+from unrest.contexts import jwt
+
+
+def user(identity: str):
+    return auth.AuthenticatedUser(identity=identity, display_name="user%s" % identity), auth.Tenant(identity="t%s" % identity)
+
+
+class Lookup:
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self, token: str | None):
+        self.calls += 1
+        await sleep(0.01)
+        if token == "broken":
+            raise RuntimeError("Database is down")
+        if token and token.startswith("key"):
+            return user(token[3:])
+        return auth.UnauthenticatedUser(), auth.Tenant()
+
+
+@mark.asyncio(loop_scope="session")
+async def test_auth_cache_hits_and_expiry():
+    lookup = Lookup()
+    cache = auth.AuthCache(ttl=0.2, negative_ttl=0.02)
+
+    u, t = await cache.get("key1", lambda: lookup("key1"))
+    assert u.identity == "1" and t.identity == "t1"
+    assert (await cache.get("key1", lambda: lookup("key1")))[0] is u
+    assert lookup.calls == 1
+
+    # Bad tokens are cached too, but not for as long
+    assert not (await cache.get("nope", lambda: lookup("nope")))[0].is_authenticated
+    assert not (await cache.get("nope", lambda: lookup("nope")))[0].is_authenticated
+    assert lookup.calls == 2
+    await sleep(0.03)
+    await cache.get("nope", lambda: lookup("nope"))
+    await cache.get("key1", lambda: lookup("key1"))
+    assert lookup.calls == 3
+
+    await sleep(0.2)
+    await cache.get("key1", lambda: lookup("key1"))
+    assert lookup.calls == 4
+    assert cache.hits == 3 and cache.misses == 4
+
+
+@mark.asyncio(loop_scope="session")
+async def test_auth_cache_single_flight():
+    lookup = Lookup()
+    cache = auth.AuthCache()
+
+    responses = await gather(*[cache.get("key2", lambda: lookup("key2")) for _ in range(10)])
+    assert lookup.calls == 1
+    assert all(r[0] is responses[0][0] for r in responses)
+
+    # Errors are shared by concurrent callers but never cached
+    results = await gather(*[cache.get("broken", lambda: lookup("broken")) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert lookup.calls == 2
+    with raises(RuntimeError):
+        await cache.get("broken", lambda: lookup("broken"))
+    assert lookup.calls == 3
+
+
+@mark.asyncio(loop_scope="session")
+async def test_auth_cache_cancelled_leader():
+    lookup = Lookup()
+    cache = auth.AuthCache()
+
+    # The leader's request goes away mid-lookup, a follower makes the call again for the others
+    leader = create_task(cache.get("key5", lambda: lookup("key5")))
+    await sleep(0.001)
+    followers = [create_task(cache.get("key5", lambda: lookup("key5"))) for _ in range(3)]
+    await sleep(0.001)
+    leader.cancel()
+    with raises(CancelledError):
+        await leader
+    responses = await gather(*followers)
+    assert all(r[0].identity == "5" for r in responses)
+    assert lookup.calls == 2
+    assert cache.peek("key5") is not None
+
+
+@mark.asyncio(loop_scope="session")
+async def test_auth_cache_bounds_and_invalidation():
+    lookup = Lookup()
+    cache = auth.AuthCache(maxsize=2)
+    for key in ["key1", "key2", "key3"]:
+        await cache.get(key, lambda: lookup(key))
+    assert len(cache) == 2
+    assert cache.peek("key1") is None
+
+    cache.invalidate("key2")
+    assert cache.peek("key2") is None
+    assert cache.peek("key3") is not None
+
+    cache.invalidate_user("3")
+    assert len(cache) == 0
+
+    await cache.get("key4", lambda: lookup("key4"))
+    cache.invalidate_tenant("t4")
+    assert len(cache) == 0
+
+secret = "not-a-very-good-secret"
+
+
+@mark.asyncio(loop_scope="session")
+async def test_jwt_hs256():
+    backend = jwt.JWTAuthentication(secret=secret, audience="unrest")
+    claims = {"sub": "123", "email": "foo@example.com", "aud": "unrest", "tenant": "t1", "claims": {"admin": True}, "exp": time.time() + 60}
+
+    user, tenant = await backend(jwt.sign(claims, secret), http.URL("http://test.app"))
+    assert user.is_authenticated
+    assert user.identity == "123"
+    assert user.display_name == "foo@example.com"
+    assert user.claims == {"admin": True}
+    assert user.tenant == tenant.identity == "t1"
+
+    # Verified tokens are cached
+    token = jwt.sign({**claims, "claims": ["support"]}, secret)
+    first, _ = await backend(token, http.URL("http://test.app"))
+    second, _ = await backend(token, http.URL("http://test.app"))
+    assert first is second
+    assert first.claims == {"support": True}
+
+    rejected = [
+        jwt.sign(claims, "wrong-secret"),
+        jwt.sign({**claims, "exp": time.time() - 1}, secret),
+        jwt.sign({**claims, "aud": "someone-else"}, secret),
+        jwt.sign({k: v for k, v in claims.items() if k != "sub"}, secret),
+        jwt.sign(claims, secret, "HS512"),
+        jwt.sign(claims, secret).rsplit(".", 1)[0] + ".",
+        "not.a.token",
+        "garbage",
+    ]
+    for token in rejected:
+        user, _ = await backend(token, http.URL("http://test.app"))
+        assert not user.is_authenticated
+
+    user, _ = await backend(None, http.URL("http://test.app"))
+    assert not user.is_authenticated
+
+    with raises(jwt.InvalidToken):
+        jwt.verify(jwt.sign(claims, secret).replace(".", ".x", 1), secret)
+
+
+@mark.parametrize("algorithm", ["RS256", "EdDSA"])
+def test_jwt_asymmetric(algorithm):
+    importorskip("cryptography")
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+    private = rsa.generate_private_key(public_exponent=65537, key_size=2048) if algorithm == "RS256" else ed25519.Ed25519PrivateKey.generate()
+    private_pem = private.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+    public_pem = private.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+
+    token = jwt.sign({"sub": "123"}, private_pem, algorithm)
+    assert jwt.verify(token, public_key=public_pem, algorithms=[algorithm]) == {"sub": "123"}
+
+    with raises(jwt.InvalidToken):
+        jwt.verify(token[:-4] + "AAAA", public_key=public_pem, algorithms=[algorithm])
+
+    # The public key must never be accepted as an HMAC secret
+    with raises(jwt.InvalidToken):
+        jwt.verify(jwt.sign({"sub": "123"}, public_pem), public_key=public_pem, algorithms=["HS256", algorithm])
+
+
+def test_compiled_predicates():
+    admin, support, dev = auth.Claim("admin"), auth.Claim("support"), auth.Claim("developer")
+
+    def reference(expr, user, mutation):
+        # The straightforward tree-walking semantics the compiled form must match
+        if isinstance(expr, auth.Claim):
+            return user.is_authenticated and expr._name in user.claims and user.claims[expr._name] >= mutation
+        if isinstance(expr, auth.AndExpression):
+            return reference(expr._left, user, mutation) and reference(expr._right, user, mutation)
+        if isinstance(expr, auth.OrExpression):
+            return reference(expr._left, user, mutation) or reference(expr._right, user, mutation)
+        if isinstance(expr, auth.NotExpression):
+            return not reference(expr._expr, user, mutation)
+        if expr is auth.UserIsAuthenticated:
+            return user.is_authenticated
+        if expr is auth.Unrestricted:
+            return True
+        return expr(user)
+
+    exprs = [
+        admin,
+        admin | support,
+        (admin | support) & ~dev,
+        auth.UserIsAuthenticated & ~support,
+        ~(admin & (support | dev)) | auth.Unrestricted,
+        admin & (lambda user: user.display_name == "jon"),
+    ]
+    values = [None, False, True]
+    for a, s, d in product(values, values, values):
+        claims = {k: v for k, v in zip(["admin", "support", "developer"], [a, s, d]) if v is not None}
+        for cls in [auth.AuthenticatedUser, auth.UnauthenticatedUser]:
+            user = cls(identity="1", display_name="jon", claims=claims)
+            for expr in exprs:
+                for mutation in [False, True]:
+                    assert auth.evaluate(expr, user, mutation) == reference(expr, user, mutation), (expr, claims, cls, mutation)
+
+
+def test_claim_bits_are_bounded():
+    # Claims no predicate names are never given a bit
+    stranger = auth.AuthenticatedUser(identity="1", display_name="jon", claims={"x-arbitrary-%s" % time.time(): True})
+    auth.claimset(stranger)
+    assert not any(name.startswith("x-arbitrary-") for name in auth._claimbits)
+
+    # A predicate compiled later is still seen by users whose claimsets are cached
+    late = "late-%s" % time.time()
+    user = auth.AuthenticatedUser(identity="1", display_name="jon", claims={late: True})
+    assert auth.claimset(user) == (0, 0)
+    assert auth.evaluate(auth.Claim(late), user, True)
+
+
+def test_predicate_subclasses():
+    class Admin(auth.Claim):
+        pass
+
+    class Audited(auth.Claim):
+        calls = 0
+
+        def __call__(self, user):
+            Audited.calls += 1
+            return super().__call__(user)
+
+    user = auth.AuthenticatedUser(identity="1", display_name="jon", claims={"admin": True})
+    assert auth.evaluate(Admin("admin"), user, False)
+    assert auth.evaluate(Admin("admin") & auth.UserIsAuthenticated, user, True)
+    assert not auth.evaluate(~Admin("admin"), user, False)
+
+    # Overriding __call__ is respected, at the root and within expressions
+    assert auth.evaluate(Audited("admin"), user, False)
+    assert auth.evaluate(Audited("admin") | Admin("support"), user, False)
+    assert not auth.evaluate(Audited("support"), user, False)
+    assert Audited.calls == 3
+
+
+@mark.asyncio(loop_scope="session")
+async def test_auth_cache_is_per_host():
+    calls = []
+    service = Api("hosts")
+
+    @service.authentication("bearer", cache=auth.AuthCache())
+    async def by_host(token: str | None, url: http.URL) -> auth.AuthResponse:
+        calls.append(url.hostname)
+        return auth.AuthenticatedUser(identity=str(token), display_name=""), auth.Tenant(identity=str(url.hostname).split(".")[0])
+
+    def request(host: str):
+        return http.Request({"type": "http", "method": "GET", "path": "/", "scheme": "http", "server": (host, 80), "headers": [(b"host", host.encode()), (b"authorization", b"Bearer key1")]})
+
+    assert (await service.authenticate(request("acme.example.com")))[1].identity == "acme"
+    assert (await service.authenticate(request("globex.example.com")))[1].identity == "globex"
+    assert (await service.authenticate(request("acme.example.com")))[1].identity == "acme"
+    assert calls == ["acme.example.com", "globex.example.com"]
@@ -1,6 +1,13 @@
-from pytest import raises, mark
+import logging
 from contextlib import contextmanager
-from unrest.contexts import context, usercontext, query, mutate, auth, ContextError, config, Unauthorized
+from queue import SimpleQueue
+
+from pytest import mark, raises
+
+from unrest import http
+from unrest.contexts import ContextError, Unauthorized, auth, config, context, mutate, query, requestcontext, usercontext
+from unrest.contexts.observability import QueueHandler
+
 
 class Roles:
     foo: auth.UserPredicate = auth.Claim("foo")
@@ -34,6 +41,34 @@ async def some_mutate(val: str):
 async def bad_query(val: str):
     return await some_mutate(val)
 
+maintenance = {"on": False}
+
+@query(lambda user: not maintenance["on"])
+async def opaque_query():
+    return True
+
+@query(Roles.foo)
+async def structural_query():
+    return True
+
+
+@mark.asyncio(loop_scope="session")
+async def test_request_memo_is_structural_only():
+    request = http.Request({"type": "http", "method": "GET", "path": "/", "query_string": b"", "headers": []})
+    with user(foo=True) as some_user:
+        with usercontext(some_user):
+            with requestcontext(request):
+                assert await structural_query() and await opaque_query()
+                # Depends on more than the user, so checked again
+                maintenance["on"] = True
+                try:
+                    with raises(Unauthorized):
+                        await opaque_query()
+                finally:
+                    maintenance["on"] = False
+                assert await structural_query()
+
+
 @mark.asyncio(loop_scope="session")
 async def test_is_under_test():
     assert config.is_under_test()
@@ -115,3 +150,59 @@ async def test_escalation():
     assert ctx._global is None
     assert ctx._local is None
     assert ctx._entrypoint is None
+
+
+def test_nested_context_vars():
+    with context(a=1, b=2):
+        with context(b=3, c=4):
+            assert dict(context.items()) == {"a": 1, "b": 3, "c": 4}
+            context["d"] = 5
+            assert context["d"] == 5
+
+            snapshot = context._ctx.copy()
+            with snapshot.set(e=6):
+                assert "e" not in context
+            assert dict(snapshot._vars) == {"a": 1, "b": 3, "c": 4, "d": 5}
+
+        # Inner frame (including writes made inside it) is discarded on exit
+        assert context.copy() == {"a": 1, "b": 2}
+    assert len(context) == 0
+
+
+def test_nested_context_deletes():
+    with context(a=1, b=2):
+        with context(c=3):
+            del context["a"]
+            assert "a" not in context
+            assert context.pop("b") == 2
+            assert context.pop("b", None) is None
+            with raises(KeyError):
+                del context["a"]
+            assert context.copy() == {"c": 3}
+        assert context.copy() == {"a": 1, "b": 2}
+
+        with context(c=3):
+            context.clear()
+            assert context.copy() == {} and len(context) == 0 and list(context) == []
+        assert context.copy() == {"a": 1, "b": 2}
+
+
+def test_log_records_capture_context_on_caller():
+    handler = QueueHandler(SimpleQueue(), maxsize=2)
+    log = logging.getLogger("tests.test_context.queued")
+    log.addHandler(handler)
+    log.propagate = False
+    try:
+        with user(foo=True) as u:
+            with usercontext(u):
+                with context(a=1, _private=2, **{"": 3}):
+                    log.warning("hello %s", "world")
+                    log.warning("second")
+                    log.warning("dropped")
+        record = handler.queue.get_nowait()
+        assert record.msg == "hello world" and record.args is None
+        assert record.context["properties"] == {"a": 1, "": 3}
+        assert record.user["display_name"] == "testuser"
+        assert handler.dropped == 1
+    finally:
+        log.removeHandler(handler)
@@ -0,0 +1,125 @@
+from time import monotonic
+
+from asyncpg.exceptions import InsufficientPrivilegeError
+from pytest import mark, raises
+
+from unrest import db, usercontext
+from unrest.contexts import auth, requestcontext
+from unrest.db import rls, stats
+
+acme = auth.Tenant(identity="acme")
+support = auth.AuthenticatedUser(identity="1", display_name="support", claims={"support": True, "admin": None})
+readonly = auth.AuthenticatedUser(identity="2", display_name="readonly", claims={"support": False})
+nobody = auth.AuthenticatedUser(identity="3", display_name="nobody", claims={})
+
+
+@db.query
+def list_notes():
+    return db.fetch("select body from notes order by id")
+
+
+@db.mutate
+def add_note(body: str):
+    return db.fetchrow("insert into notes (tenant_id, body) values (rls_tenant(), $1) returning id", body)
+
+
+@db.mutate
+def touch_notes():
+    return db.execute("update notes set body = body where false")
+
+
+def test_predicate_sql():
+    admin, support, developer = auth.Claim("admin"), auth.Claim("support"), auth.Claim("developer")
+    assert rls.sql(admin | (support & ~developer)) == "(rls_claim('admin', false) OR (rls_claim('support', false) AND (NOT rls_claim('developer', false))))"
+    assert rls.sql(auth.UserIsAuthenticated & admin, mutation=True) == "((rls_user() IS NOT NULL) AND rls_claim('admin', true))"
+    assert rls.sql(auth.Unrestricted) == "true"
+    with raises(ValueError):
+        rls.sql(lambda user: True)
+
+
+def test_predicate_subclass_sql():
+    class Admin(auth.Claim):
+        pass
+
+    class Audited(auth.Claim):
+        def __call__(self, user):
+            return super().__call__(user)
+
+    assert rls.sql(Admin("admin") & ~Admin("developer")) == "(rls_claim('admin', false) AND (NOT rls_claim('developer', false)))"
+    assert rls.sql(Audited("admin")) == "rls_claim('admin', false)"
+    # Below the root an overridden __call__ is opaque, as it is to auth.evaluate
+    with raises(ValueError):
+        rls.sql(Admin("admin") | Audited("support"))
+
+
+@mark.asyncio(loop_scope="session")
+async def test_session_settings():
+    with usercontext(support, acme):
+        row = await db._fetchrow("select rls_tenant() as tenant, rls_user() as user, rls_claim('support') as q, rls_claim('support', true) as m, rls_claim('admin') as admin")
+        assert dict(row) == {"tenant": "acme", "user": "1", "q": True, "m": True, "admin": False}
+
+    with usercontext(readonly, acme):
+        row = await db._fetchrow("select rls_user() as user, rls_claim('support') as q, rls_claim('support', true) as m")
+        assert dict(row) == {"user": "2", "q": True, "m": False}
+
+    row = await db._fetchrow("select rls_user() as user, rls_claims() as claims")
+    assert dict(row) == {"user": None, "claims": {}}
+
+
+@mark.asyncio(loop_scope="session")
+async def test_policy_filters_rows():
+    with usercontext(support, acme):
+        assert [r["body"] for r in await list_notes()()] == ["first", "second"]
+
+    with usercontext(readonly, acme):
+        assert [r["body"] for r in await list_notes()()] == ["first", "second"]
+        with raises(InsufficientPrivilegeError):
+            await add_note("denied")()
+
+    with usercontext(nobody, acme):
+        assert await list_notes()() == []
+
+    with usercontext(support, auth.Tenant(identity="globex")):
+        assert [r["body"] for r in await list_notes()()] == ["third"]
+
+
+@mark.asyncio(loop_scope="session")
+async def test_fragment_stats_and_slow_queries(monkeypatch, caplog):
+    monkeypatch.setattr(stats, "_slow", 0.0)
+    monkeypatch.setattr(stats, "_explain", 1.0)
+    before = stats.get("tests.test_db.list_notes").calls
+    with usercontext(support, acme):
+        await list_notes()()
+    after = stats.get("tests.test_db.list_notes").snapshot()
+    assert after["calls"] == before + 1
+    assert after["rows"] >= 2 and after["p99"] > 0.0
+
+    slow = [r for r in caplog.records if r.name == "unrest.db.stats" and hasattr(r, "query")]
+    assert slow[-1].query["path"] == "tests.test_db.list_notes"
+    assert "select body from notes" in slow[-1].query["sql"]
+    assert slow[-1].query["plan"][0]["Plan"]["Actual Rows"] == 2
+
+    # Mutations are never re-run to explain them
+    with usercontext(support, acme):
+        await touch_notes()()
+    assert [r for r in caplog.records if hasattr(r, "query")][-1].query["plan"] is None
+
+
+@db.query
+def sleep(seconds: float):
+    return db.fetchrow("select pg_sleep($1::float8)", seconds)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_deadline_cancels_statement():
+    with usercontext(support, acme):
+        with requestcontext(None, monotonic() + 0.2):
+            t_start = monotonic()
+            with raises(TimeoutError):
+                await sleep(5)()
+            assert monotonic() - t_start < 2
+            with raises(TimeoutError):
+                await sleep(0)()  # nothing starts once the deadline has passed
+
+        # The connection went back to the pool usable
+        assert [r["body"] for r in await list_notes()()] == ["first", "second"]
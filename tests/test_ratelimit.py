@@ -0,0 +1,119 @@
+import asyncio
+import time
+import uuid
+
+from pytest import mark
+
+from unrest import Server, api, auth, http, ratelimit
+from unrest.api import Client
+from unrest.contexts.auth import AuthenticatedUser, Tenant, UnauthenticatedUser
+from unrest.ratelimit import Bucket, PostgresBackend, RateLimit
+
+
+def test_bucket():
+    bucket = Bucket(2, 0.0)
+    assert bucket.take(1.0, 2, 0.0) == 0
+    assert bucket.take(1.0, 2, 0.0) == 0
+    assert bucket.take(1.0, 2, 0.0) == 1.0
+    assert bucket.take(1.0, 2, 0.5) == 0.5
+    assert bucket.take(1.0, 2, 1.0) == 0
+    # Refills no further than the burst
+    bucket.take(1.0, 2, 100.0)
+    assert bucket.tokens == 1
+
+
+@mark.asyncio(loop_scope="session")
+async def test_keys():
+    request = http.Request({"type": "http", "method": "GET", "path": "/", "headers": [], "client": ("10.0.0.1", 1)})
+    alice = AuthenticatedUser(identity="alice", display_name="alice")
+    acme = Tenant(identity="acme")
+
+    per_tenant, per_user = RateLimit(1, per="tenant", shared=False), RateLimit(1, per="user", shared=False)
+    assert per_tenant.key(request, alice, acme) == "t:acme"
+    assert per_user.key(request, alice, acme) == "u:alice"
+    assert per_user.key(request, UnauthenticatedUser(), acme) == "a:10.0.0.1"
+
+    assert await per_user.take(request, alice, acme) == 0
+    assert await per_user.take(request, alice, acme) > 0
+    assert await per_user.take(request, AuthenticatedUser(identity="bob", display_name="bob"), acme) == 0
+    assert (per_user.allowed, per_user.throttled) == (2, 1)
+
+
+throttled = RateLimit(1, burst=2, per="user", shared=False)
+
+@api.query("/throttled", auth.Unrestricted, ratelimit=throttled)
+async def throttled_query() -> None:
+    return None
+
+
+@mark.asyncio(loop_scope="session")
+async def test_throttling():
+    client = Client(Server())
+    assert [(await client.query("/throttled")).status_code for _ in range(2)] == [202, 202]
+    resp = await client.query("/throttled")
+    assert resp.status_code == 429
+    assert resp.headers["retry-after"] == "1"
+    assert throttled.name.endswith(".throttled_query.user")
+
+
+@mark.asyncio(loop_scope="session")
+async def test_postgres_backend():
+    backend = PostgresBackend()  # NB: the default DSN, i.e. the readwrite role
+    key = str(uuid.uuid4())
+    try:
+        assert [await backend.take(key, 1.0, 2) for _ in range(2)] == [0, 0]
+        assert 0 < await backend.take(key, 1.0, 2) <= 1.0
+        await backend.refund(key, 2)
+        assert await backend.take(key, 1.0, 2) == 0
+        # Buckets are independent
+        assert await backend.take(key + "x", 1.0, 2) == 0
+    finally:
+        await backend.pool.close() # type:ignore
+
+
+api.batch("/ratelimit/batch")
+
+batched = RateLimit(1, burst=2, per="user", shared=False)
+
+@api.query("/throttled/batched", auth.Unrestricted, ratelimit=batched)
+async def batched_query() -> None:
+    return None
+
+
+@mark.asyncio(loop_scope="session")
+async def test_throttling_in_batches():
+    client = Client(Server())
+    resp = await client.batch([{"path": "/throttled/batched"}] * 4, path="/ratelimit/batch")
+    assert resp.status_code == 200
+    assert sorted(r["status"] for r in resp.json()) == [202, 202, 429, 429]
+    assert (await client.query("/throttled/batched")).status_code == 429
+
+
+@mark.asyncio(loop_scope="session")
+async def test_refused_requests_are_refunded():
+    request = http.Request({"type": "http", "method": "GET", "path": "/", "headers": [], "client": ("10.0.0.1", 1)})
+    alice = AuthenticatedUser(identity="alice", display_name="alice")
+    per_tenant, per_user = RateLimit(1, burst=2, per="tenant", shared=False), RateLimit(1, burst=1, per="user", shared=False)
+
+    assert await ratelimit.take([per_tenant, per_user], request, alice, Tenant()) is None
+    # Refused by the second limit: the first gets its token back
+    assert (await ratelimit.take([per_tenant, per_user], request, alice, Tenant()))[0] is per_user # type:ignore
+    assert await per_tenant.take(request, alice, Tenant()) == 0
+    assert (per_tenant.allowed, per_tenant.throttled) == (2, 0)
+
+
+class Stalled:
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        await asyncio.sleep(10)
+        return 0.0
+
+
+@mark.asyncio(loop_scope="session")
+async def test_slow_backend_fails_open(monkeypatch):
+    monkeypatch.setattr(ratelimit, "_backend", Stalled())
+    monkeypatch.setattr(ratelimit, "_timeout", 0.01)
+    request = http.Request({"type": "http", "method": "GET", "path": "/", "headers": [], "client": ("10.0.0.1", 1)})
+    limit = RateLimit(1, per="tenant")
+    t_start = time.monotonic()
+    assert await limit.take(request, AuthenticatedUser(identity="alice", display_name="alice"), Tenant()) == 0
+    assert time.monotonic() - t_start < 1
@@ -0,0 +1,219 @@
+from asyncio import sleep
+from datetime import datetime, timedelta, timezone
+
+from asgi_lifespan import LifespanManager
+from pytest import mark, raises
+
+from unrest import Server, Unauthorized, api, context, metrics, usercontext
+from unrest.api import Client, get_instance
+from unrest.contexts import auth
+from unrest.tasks import (
+    Periodic,
+    Schedule,
+    Scheduler,
+    TaskNotFound,
+    TaskNotReady,
+    TaskTimeout,
+    _periodic,
+    _scheduled,
+    asynchronous,
+    lightweight,
+    result,
+    synchronous,
+)
+
+ticks = []
+someone = auth.AuthenticatedUser(identity="1", display_name="someone")
+someone_else = auth.AuthenticatedUser(identity="2", display_name="someone else")
+
+@lightweight(every=0.05)
+async def heartbeat():
+    ticks.append((context.user.display_name, context._ctx._global))
+
+
+@mark.asyncio(loop_scope="session")
+async def test_lightweight_started_by_lifespan():
+    ticks.clear()
+    async with LifespanManager(Server()):
+        await sleep(0.12)
+    n = len(ticks)
+    assert n >= 2
+    assert all(t == ("__system__", True) for t in ticks)
+
+    # Cancelled on shutdown
+    await sleep(0.1)
+    assert len(ticks) == n
+    assert not any(p.running for p in _periodic)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_lightweight_skips_overrunning_ticks():
+    calls = 0
+
+    async def slow():
+        nonlocal calls
+        calls += 1
+        await sleep(0.07)
+
+    p = Periodic(slow, every=0.05)
+    p.start()
+    await sleep(0.22)
+    await p.stop()
+    assert p.runs == calls
+    assert p.skipped >= 2
+    assert p.failures == 0
+
+
+@mark.asyncio(loop_scope="session")
+async def test_lightweight_counts_failures():
+    async def broken():
+        raise RuntimeError("Oh noes!")
+
+    p = Periodic(broken, every=0.02)
+    p.start()
+    await sleep(0.05)
+    await p.stop()
+    assert p.runs >= 2
+    assert p.failures == p.runs
+    assert not p.running
+    assert isinstance(context.user, auth.UnauthenticatedUser)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_scheduler_leader_election():
+    first, second = Scheduler(), Scheduler()
+    try:
+        await first._elect()
+        await second._elect()
+        assert first.is_leader
+        assert not second.is_leader
+
+        await first._elect()
+        assert first.is_leader
+
+        # Leadership fails over as soon as the leader's session goes away
+        await first.stop()
+        await second._elect()
+        assert second.is_leader
+    finally:
+        await first.stop()
+        await second.stop()
+
+
+@mark.asyncio(loop_scope="session")
+async def test_scheduler_catches_up_missed_ticks():
+    dispatched = []
+
+    class FakeTask:
+        task_name = "tests.test_tasks.every_five_minutes"
+
+        async def kiq(self):
+            dispatched.append(True)
+
+    sched = Schedule(FakeTask(), "*/5 * * * *", "tests.test_tasks.every_five_minutes") # type:ignore
+    now = datetime(2025, 1, 1, 12, 0, 30, tzinfo=timezone.utc)
+    assert sched.due(now - timedelta(minutes=20), now) == 4
+    assert sched.due(now - timedelta(minutes=1), now) == 1
+    assert sched.due(now, now) == 0
+
+    leader = Scheduler(catchup=timedelta(minutes=10))
+    _scheduled.append(sched)
+    try:
+        await leader._elect()
+        assert leader.is_leader
+        await leader._conn.execute("DELETE FROM _schedules WHERE name = $1", sched.name)
+
+        await leader.tick(now)
+        assert len(dispatched) == 1
+
+        # Already ran this minute
+        await leader.tick(now + timedelta(seconds=15))
+        assert len(dispatched) == 1
+
+        # Ticks missed while nobody was leader are coalesced into one run, bounded by the catch-up window
+        await leader.tick(now + timedelta(minutes=30))
+        assert len(dispatched) == 2
+        assert sched.missed == 1
+    finally:
+        _scheduled.remove(sched)
+        await leader.stop()
+
+
+@synchronous(timeout=2.0)
+async def square(n: int) -> dict:
+    return {"value": n * n, "user": context.user.display_name, "mutation": context._ctx._global}
+
+@synchronous(timeout=0.1)
+async def too_slow() -> None:
+    await sleep(0.5)
+
+@asynchronous()
+async def deferred(n: int) -> dict:
+    await sleep(0.1)
+    return {"value": n, "user": context.user.display_name}
+
+@asynchronous()
+async def deferred_failure() -> None:
+    raise ValueError("Secret detail")
+
+api.results("/test/tasks/{task_id}", auth.Unrestricted)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_synchronous_task():
+    with usercontext(someone):
+        assert await square(3) == {"value": 9, "user": "someone", "mutation": True}
+        with raises(TaskTimeout):
+            await too_slow()
+
+    exposition = metrics.render()
+    assert 'unrest_tasks_executed_total{task="%s:square",outcome="ok"}' % __name__ in exposition
+    assert 'unrest_tasks_inflight{task="%s:square"} 0' % __name__ in exposition
+
+
+@mark.asyncio(loop_scope="session")
+async def test_asynchronous_task():
+    with usercontext(someone):
+        task_id = await deferred(3)
+        with raises(TaskNotReady):
+            await result(task_id)
+        with raises(TaskNotFound):
+            await result("no-such-task")
+
+    with usercontext(someone_else):
+        with raises(Unauthorized):
+            await result(task_id)
+
+    with usercontext(someone):
+        await sleep(0.3)
+        assert await result(task_id) == {"value": 3, "user": "someone"}
+
+    with usercontext(someone_else):
+        with raises(Unauthorized):
+            await result(task_id)
+
+    # Failures too are only reported to whoever launched the task
+    with usercontext(someone):
+        task_id = await deferred_failure()
+        await sleep(0.1)
+    with usercontext(someone_else):
+        with raises(Unauthorized):
+            await result(task_id)
+    with usercontext(someone):
+        with raises(ValueError):
+            await result(task_id)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_asynchronous_task_polling():
+    cli = Client(get_instance())
+    task_id = await deferred(5)
+    response = await cli.query("/test/tasks/%s" % task_id)
+    assert response.status_code == 202
+    await sleep(0.3)
+    response = await cli.query("/test/tasks/%s" % task_id)
+    assert response.status_code == 200
+    assert response.json()["value"] == 5
+    # Polling a bad (or expired) id doesn't look like a task that never finishes
+    response = await cli.query("/test/tasks/%s" % "no-such-task")
+    assert response.status_code == 404
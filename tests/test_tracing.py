@@ -0,0 +1,69 @@
+from pytest import fixture, mark
+
+from unrest import Server, api, db, tracing, usercontext
+from unrest.api import Client
+from unrest.contexts import auth
+from unrest.tasks import synchronous
+
+parent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+@db.query
+def select_one():
+    return db.fetchrow("select 1 as one")
+
+
+@api.query("/traced", auth.Unrestricted)
+async def traced() -> dict:
+    return dict(await select_one()())
+
+
+@synchronous(timeout=2.0)
+async def traced_task() -> str | None:
+    return tracing.traceparent()
+
+
+@fixture
+def exporter():
+    exporter = tracing.MemoryExporter()
+    previous = tracing.configure(exporter, sample=1.0)
+    yield exporter
+    tracing.configure(previous)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_request_spans(exporter):
+    cli = Client(Server())
+    resp = await cli.query("/traced", headers={"traceparent": parent})
+    assert resp.json() == {"one": 1}
+
+    spans = {s.name: s for s in exporter.spans}
+    root = spans["tests.test_tracing.traced"]
+    assert root.kind == tracing.SERVER
+    assert (root.trace_id, root.parent_id) == ("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331")
+    assert root.attributes["http.response.status_code"] == 200
+    for name in ("authenticate", "decode", "handler", "encode"):
+        assert spans[name].parent_id == root.span_id
+    sql = spans["sql tests.test_tracing.select_one"]
+    assert sql.parent_id == spans["handler"].span_id
+    assert sql.attributes["unrest.fragment"] == "tests.test_tracing.select_one"
+    assert spans["pool.acquire"].parent_id == sql.span_id
+    assert all(s.trace_id == root.trace_id and s.end >= s.start for s in exporter.spans)
+
+
+@mark.asyncio(loop_scope="session")
+async def test_traceparent_propagates_to_tasks(exporter):
+    with usercontext(auth.AuthenticatedUser(identity="1", display_name="someone")):
+        with tracing.span("caller") as caller:
+            inner = await traced_task()
+    trace_id, span_id, sampled = tracing.parse(inner) # type:ignore
+    assert trace_id == caller.trace_id and sampled
+    consumer = next(s for s in exporter.spans if s.name == "task traced_task")
+    assert consumer.kind == tracing.CONSUMER and consumer.parent_id == caller.span_id and consumer.span_id == span_id
+
+
+def test_disabled_and_malformed():
+    assert tracing.span("nothing") is tracing._noop
+    assert tracing.parse("00-00000000000000000000000000000000-b7ad6b7169203331-01") is None
+    assert tracing.parse("garbage") is None
+    assert tracing.parse(parent) == ("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", True)
@@ -0,0 +1,65 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from unrest.workers import bind
+
+
+def test_reuse_port():
+    first = bind("127.0.0.1", 0, reuse_port=True)
+    port = first.getsockname()[1]
+    second = bind("127.0.0.1", port, reuse_port=True)
+    assert second.getsockname()[1] == port
+    first.close()
+    second.close()
+
+
+def _children(pid: int) -> set[int]:
+    out = subprocess.run(["pgrep", "-P", str(pid)], capture_output=True, text=True).stdout
+    return {int(p) for p in out.split()}
+
+
+def _get(port: int, timeout: float = 10.0) -> httpx.Response:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return httpx.get("http://127.0.0.1:%d/static" % port, headers={"Accept": "application/json"})
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def test_serve_and_rolling_restart():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    env = {**os.environ, "UNREST_ACCESS_LOG_SAMPLE": "0"}
+    command = [sys.executable, "-c", "from unrest.cli import main; main()", "serve", "benchmark.load.app:server", "--port", str(port), "-w", "2", "--graceful", "1"]
+    proc = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        assert _get(port).json() == {"id": "123", "email": "foo@bar.com"}
+        deadline = time.monotonic() + 20
+        while len(workers := _children(proc.pid)) < 2 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert len(workers) == 2
+
+        # Replaced one at a time, serving throughout
+        proc.send_signal(signal.SIGHUP)
+        deadline = time.monotonic() + 20
+        while _children(proc.pid) & workers and time.monotonic() < deadline:
+            assert _get(port).status_code == 200
+            time.sleep(0.1)
+        assert len(_children(proc.pid) - workers) == 2
+
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=20) == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
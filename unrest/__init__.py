@@ -13,7 +13,7 @@ class ServerError(Exception):
     pass
 
 from .serialisation import Payload as Payload
-from .routing import Server as Server, Serverless as Serverless
+from .routing import Server as Server, Serverless as Serverless, offload as offload
 
 
 __all__ = [
@@ -31,6 +31,7 @@ __all__ = [
     "Payload",
     "Server",
     "Serverless",
+    "offload",
 ]
 
 
@@ -0,0 +1,129 @@
+import time
+from asyncio import Future, get_running_loop
+from asyncio import timeout as _timeout
+from collections import deque
+
+from unrest import metrics
+from unrest.contexts import config
+
+# Admission control: a concurrency limit with a bounded wait queue, so that under overload requests are turned
+# away quickly (503 with Retry-After) rather than all of them queueing on the database pool.
+#
+# Mutations are admitted ahead of queued queries. With a target latency the limit adapts (AIMD): it grows by one
+# after a limit's worth of requests within target, and shrinks by a tenth when requests take longer.
+
+
+_limiters: list["Limiter"] = []
+
+
+class Limiter:
+    def __init__(self, limit: int, queue: int = 100, timeout: float = 1.0, target: float | None = None, min_limit: int = 1, max_limit: int | None = None, name: str = ""):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.target = target
+        self.min_limit = min_limit
+        self.max_limit = max_limit if max_limit is not None else limit * 4
+        self.inflight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._waiting: tuple[deque[Future], deque[Future]] = (deque(), deque())  # mutations, queries
+        self._within = 0
+        self._decreased = 0.0
+        _limiters.append(self)
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting[0]) + len(self._waiting[1])
+
+    def retry_after(self) -> int:
+        return max(1, round(self.timeout))
+
+    async def acquire(self, priority: bool = False) -> bool:
+        if self.inflight < self.limit and not self.queued:
+            self.inflight += 1
+            self.admitted += 1
+            return True
+        if self.queued >= self.queue or self.timeout <= 0:
+            self.rejected += 1
+            return False
+
+        waiter = get_running_loop().create_future()
+        waiting = self._waiting[0 if priority else 1]
+        waiting.append(waiter)
+        try:
+            async with _timeout(self.timeout):
+                await waiter
+        except BaseException as ex:
+            if waiter.done() and not waiter.cancelled():
+                # Admitted just as we gave up, so pass the slot on
+                self.release()
+            else:
+                waiter.cancel()
+                try:
+                    waiting.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(ex, TimeoutError):
+                self.rejected += 1
+                return False
+            raise
+        self.admitted += 1
+        return True
+
+    def release(self, elapsed: float | None = None):
+        self.inflight -= 1
+        if self.target is not None and elapsed is not None:
+            self._adapt(elapsed)
+        while self.inflight < self.limit:
+            waiting = self._waiting[0] or self._waiting[1]
+            if not waiting:
+                break
+            waiter = waiting.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(True)
+
+    def _adapt(self, elapsed: float):
+        if elapsed > self.target: # type:ignore
+            # NB: at most once per target interval, otherwise one slow burst collapses the limit
+            now = time.monotonic()
+            if now - self._decreased >= self.target: # type:ignore
+                self.limit = max(self.min_limit, int(self.limit * 0.9))
+                self._decreased = now
+            self._within = 0
+            return
+        self._within += 1
+        if self._within >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1)
+            self._within = 0
+
+
+def from_config(name: str) -> Limiter | None:
+    # Default limiter for a Service, off unless UNREST_MAX_CONCURRENCY is set
+    limit = int(config.get("UNREST_MAX_CONCURRENCY", "0")) # type:ignore
+    if limit <= 0:
+        return None
+    target = config.get("UNREST_TARGET_LATENCY")
+    return Limiter(
+        limit,
+        queue=int(config.get("UNREST_MAX_QUEUE", "100")), # type:ignore
+        timeout=float(config.get("UNREST_QUEUE_TIMEOUT", "1.0")), # type:ignore
+        target=float(target) if target else None,
+        name=name,
+    )
+
+
+@metrics.collector
+def _collect():
+    limit = metrics.Gauge("unrest_admission_limit", "Concurrency limit, by limiter", ("limiter",))
+    inflight = metrics.Gauge("unrest_admission_inflight", "Requests admitted and in progress, by limiter", ("limiter",))
+    queued = metrics.Gauge("unrest_admission_queued", "Requests waiting for admission, by limiter", ("limiter",))
+    rejected = metrics.Counter("unrest_admission_rejected_total", "Requests rejected with 503, by limiter", ("limiter",))
+    for limiter in _limiters:
+        limit.labels(limiter.name).set(limiter.limit)
+        inflight.labels(limiter.name).set(limiter.inflight)
+        queued.labels(limiter.name).set(limiter.queued)
+        rejected.labels(limiter.name).set(limiter.rejected)
+    return [limit, inflight, queued, rejected]
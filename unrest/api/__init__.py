@@ -3,10 +3,15 @@ from typing import Any, Awaitable, Callable
 import typing
 
 from unrest import getLogger, query as _query, mutate as _mutate, Unauthorized
-from unrest import auth, http, routing
+from unrest import admission, auth, context, http, profiling, routing, tasks, tracing
 from unrest.contexts.auth import TokenAuthFunction
+from unrest.ratelimit import RateLimit
 
 from .payload import JSONResponse, PayloadResponse
+from . import encoding
+from .cache import QueryCache, SingleFlight
+from . import batch as _batch
+from .batch import Operation
 from .client import Client
 
 
@@ -16,7 +21,18 @@ from .client import Client
 log = getLogger(__name__)
 
 
+def _ratelimits(limits: RateLimit | list[RateLimit], name: str) -> list[RateLimit]:
+    limits = [limits] if isinstance(limits, RateLimit) else list(limits)
+    for limit in limits:
+        if not limit.name:
+            limit.name = "%s.%s" % (name, limit.per)
+    return limits
+
+
 class ApiEndpoint(routing.Endpoint):
+    cache: QueryCache | SingleFlight | None = None
+    perms: auth.UserPredicateFunction = auth.Unrestricted
+
     async def decode(self, req: http.Request) -> tuple[list, dict]:
         args : list[Any | None] = []
         kwargs = {}
@@ -45,7 +61,27 @@ class ApiEndpoint(routing.Endpoint):
             raise routing.ClientError()    
         return args, kwargs
 
+    async def handle(self, request: http.Request) -> http.Response:
+        if self.cache is None:
+            return await super().handle(request)
+        # NB: a cached or shared response skips the handler, and with it the authorization in its operational context
+        if not auth.evaluate(self.perms, context.user, False):
+            raise Unauthorized("User is not authorized: %s" % self.name)
+        return await self.cache.respond(request, lambda: self.rendered(request))
+
+    async def rendered(self, request: http.Request) -> http.Response:
+        # As handle(), but leaving content negotiation to the caller
+        with tracing.span("decode"):
+            (args, kwargs) = await self.decode(request)
+        with tracing.span("handler"):
+            response = await self.function(*args, **kwargs)
+        with tracing.span("encode"):
+            return self.render(response)
+
     async def encode(self, request: http.Request, resp: Any | None) -> http.Response:
+        return encoding.finalise(request, self.render(resp))
+
+    def render(self, resp: Any | None) -> http.Response:
         if resp is None:
             return JSONResponse(None, status_code=202)
 
@@ -77,38 +113,70 @@ class ApiEndpoint(routing.Endpoint):
 
 
 class Api(routing.Service):
-    def authentication(self, scheme="bearer") -> Callable:
+    def authentication(self, scheme="bearer", cache: auth.AuthCache | None = None) -> Callable:
         def decorator(f: TokenAuthFunction) -> TokenAuthFunction:
+            async def _lookup(credentials: str | None, url: http.URL) -> routing.AuthResponse:
+                if cache is None:
+                    return await f(credentials, url)
+                # NB: the url too, since the auth function may resolve the tenant from the host
+                return await cache.get((credentials, str(url)), lambda: f(credentials, url))
+
             async def _authenticate(request: http.Request) -> routing.AuthResponse:
                 if "Authorization" in request.headers:
                     try:
                         header = request.headers["Authorization"]
                         _scheme, credentials = header.split()
                         if scheme.lower() == _scheme.lower():
-                            return await f(credentials, request.base_url) 
+                            return await _lookup(credentials, request.base_url) 
                     except Exception as ex:
                         raise Unauthorized("Invalid credentials: %s" % ex)
-                return await f(None, request.base_url)
+                return await _lookup(None, request.base_url)
             self._authfunction = _authenticate
             return f
         return decorator
         
-    def query(self, path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
+    def query(self, path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated, sample: float | None = None, cache: QueryCache | None = None, coalesce: bool = False, limiter: admission.Limiter | None = None, timeout: float | None = None, ratelimit: RateLimit | list[RateLimit] | None = None) -> Callable:
+        """
+        Serve `f` for GET and QUERY requests to `path`
+
+        Responses are cached per user with cache=QueryCache(...), and coalesce=True shares concurrent identical calls
+        per user. QueryCache(per_user=False) shares responses between users with the same claims: only safe when the
+        handler reads neither context.user nor tables with per-user RLS policies, or it serves one user's rows to
+        another.
+        """
         def decorator(f: Callable) -> Callable:
             name = f.__module__ + "." + f.__name__
             qry  = _query(perms)(f)
-            point = ApiEndpoint(qry, self)
+            point = ApiEndpoint(qry, self, sample)
+            # NB: caches coalesce their own misses
+            point.cache, point.perms = SingleFlight() if coalesce and cache is None else cache, perms
+            point.limiter = limiter
+            if timeout is not None:
+                point.timeout = timeout or None
+            if limiter is not None and not limiter.name:
+                limiter.name = name
+            if ratelimit is not None:
+                point.ratelimits = _ratelimits(ratelimit, name)
+            self.endpoints[name] = point
             async def wrapper(*args, **kwargs):
                 return await point(*args, **kwargs)
             self.add(http.Route(path, wrapper, methods=["GET", "QUERY"], name=name))
             return qry
         return decorator
 
-    def mutate(self, path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
+    def mutate(self, path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated, sample: float | None = None, limiter: admission.Limiter | None = None, timeout: float | None = None, ratelimit: RateLimit | list[RateLimit] | None = None) -> Callable:
         def decorator(f: Callable) -> Callable:
             name = f.__module__ + "." + f.__name__ 
             qry = _mutate(perms)(f)
-            point = ApiEndpoint(qry, self)
+            point = ApiEndpoint(qry, self, sample)
+            point.limiter = limiter
+            if timeout is not None:
+                point.timeout = timeout or None
+            if limiter is not None and not limiter.name:
+                limiter.name = name
+            if ratelimit is not None:
+                point.ratelimits = _ratelimits(ratelimit, name)
+            self.endpoints[name] = point
             async def wrapper(*args, **kwargs):
                 return await point(*args, **kwargs)
             self.add(http.Route(path, wrapper, methods=["POST"], name=name))
@@ -116,15 +184,48 @@ class Api(routing.Service):
         return decorator
 
 
+    def results(self, path="/tasks/{task_id}", perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
+        # Polling endpoint for tasks.asynchronous handles: 202 until ready, then the task's return value
+        async def task_result(task_id: str):
+            return await tasks.result(task_id)
+        return self.query(path, perms)(task_result)
+
+    def batch(self, path="/batch") -> Callable:
+        # Many query and mutate operations in one request; each is authorized against its own route
+        async def batch(operations: list[Operation]):
+            return await _batch.execute(self, context.request, operations)
+        point = ApiEndpoint(batch, self)
+        async def wrapper(*args, **kwargs):
+            return await point(*args, **kwargs)
+        self.add(http.Route(path, wrapper, methods=["POST"], name=point.name))
+        return batch
+
+    def profiles(self, path="/profiles", perms: auth.UserPredicateFunction = auth.Claim("admin")) -> Callable:
+        # Per-route profiles from profiling: a summary of every route, or ?route= for folded stacks (flamegraph input)
+        async def profile_report(route=None):
+            if route is None:
+                return profiling.summary()
+            return http.Response(profiling.folded(route), media_type="text/plain; charset=utf-8")
+        return self.query(path, perms)(profile_report)
+
+
+def query(path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated, sample: float | None = None, cache: QueryCache | None = None, coalesce: bool = False, limiter: admission.Limiter | None = None, timeout: float | None = None, ratelimit: RateLimit | list[RateLimit] | None = None) -> Callable:
+    return get_instance().query(path, perms, sample, cache, coalesce, limiter, timeout, ratelimit)
+
+def mutate(path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated, sample: float | None = None, limiter: admission.Limiter | None = None, timeout: float | None = None, ratelimit: RateLimit | list[RateLimit] | None = None) -> Callable:
+    return get_instance().mutate(path, perms, sample, limiter, timeout, ratelimit)
+
+def authentication(scheme="bearer", cache: auth.AuthCache | None = None) -> Callable:
+    return get_instance().authentication(scheme, cache)
 
-def query(path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
-    return get_instance().query(path, perms) 
+def results(path="/tasks/{task_id}", perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
+    return get_instance().results(path, perms)
 
-def mutate(path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
-    return get_instance().mutate(path, perms)
+def batch(path="/batch") -> Callable:
+    return get_instance().batch(path)
 
-def authentication(scheme="bearer") -> Callable:
-    return get_instance().authentication(scheme)
+def profiles(path="/profiles", perms: auth.UserPredicateFunction = auth.Claim("admin")) -> Callable:
+    return get_instance().profiles(path, perms)
 
 def abort(status_code) -> JSONResponse:
     return JSONResponse({}, status_code=status_code)
@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import json
+import time
+from typing import TYPE_CHECKING, Any, cast
+from urllib.parse import urlencode
+
+from unrest import Payload, config, db, http, ratelimit, routing, tracing
+from unrest.contexts._context import get, restorecontext
+
+if TYPE_CHECKING:
+    from . import Api, ApiEndpoint
+
+# Many operations in one round-trip: authenticated once, mutations run first and in order in a single transaction,
+# then queries run concurrently, each in its own copy of the request's context. Results keep the request's order.
+
+_maximum = int(config.get("UNREST_BATCH_MAX", "50")) # type:ignore
+_stripped = (b"content-length", b"content-type", b"accept-encoding", b"if-none-match")
+
+
+class Operation(Payload):
+    path: str
+    params: dict[str, Any] = {}
+    payload: Any = None
+    mutate: bool = False
+
+
+class _Rollback(Exception):
+    pass
+
+
+def resolve(api: "Api", request: http.Request, op: Operation) -> tuple["ApiEndpoint", http.Request] | None:
+    # Matches the operation against the api's own routes and builds the request the endpoint would have received
+    body = b"" if op.payload is None else json.dumps(op.payload).encode("utf-8")
+    method = "POST" if op.mutate else ("GET" if op.payload is None else "QUERY")
+    headers = [(k, v) for (k, v) in request.scope["headers"] if k not in _stripped]
+    headers.append((b"content-type", b"application/json"))
+    scope = {
+        **request.scope,
+        "method": method,
+        "path": op.path,
+        "raw_path": op.path.encode("utf-8"),
+        "query_string": urlencode(op.params, doseq=True).encode("utf-8"),
+        "headers": headers,
+    }
+    for route in api.routes:
+        match, child = route.matches(scope)
+        if match == http.Match.FULL:
+            # NB: an Api only registers ApiEndpoints
+            point = cast("ApiEndpoint | None", api.endpoints.get(route.name)) # type:ignore
+            if point is None:
+                return None
+
+            async def receive():
+                return {"type": "http.request", "body": body, "more_body": False}
+            return point, http.Request({**scope, **child}, receive)
+    return None
+
+
+async def run(point: "ApiEndpoint", request: http.Request) -> tuple[int, bytes]:
+    # Each operation counts as a request to its own route: its rate limits, limiter and timeout all apply
+    t_start = time.perf_counter()
+    ctx = get()
+    # NB: the operation's own request and permission memo, but the batch request's id; all restored afterwards
+    _request, _memo, _deadline = ctx._request, ctx._memo, ctx._deadline
+    ctx._request, ctx._memo = request, {}
+    try:
+        limits = point.service.ratelimits if point.ratelimits is None else point.ratelimits
+        if limits and (refused := await ratelimit.take(limits, request, ctx.user, ctx.tenant)) is not None:
+            return point.throttled(request, *refused, t_start).status_code, b"null"
+        # NB: only the route's own limiter, the batch request already holds a slot of the service's
+        limiter = point.limiter
+        if limiter is not None and not await limiter.acquire(request.method in routing._mutations):
+            return point.rejected(request, limiter, t_start).status_code, b"null"
+        t_admitted = time.perf_counter()
+        if point.timeout is not None:
+            deadline = time.monotonic() + point.timeout
+            if _deadline is None or deadline < _deadline:
+                ctx._deadline = deadline
+        try:
+            with tracing.span("batch " + point.name):
+                try:
+                    async with asyncio.timeout(ctx.remaining()):
+                        response = await point.handle(request)
+                except Exception as ex:
+                    return point.failed(request, ex, t_start).status_code, b"null"
+                point.access(request, response.status_code, t_start)
+        finally:
+            if limiter is not None:
+                limiter.release(time.perf_counter() - t_admitted)
+    finally:
+        ctx._request, ctx._memo, ctx._deadline = _request, _memo, _deadline
+    body = getattr(response, "body", None)
+    if not isinstance(body, bytes):
+        return 501, b"null" # streamed responses cannot be embedded
+    if not body:
+        return response.status_code, b"null"
+    if response.media_type != "application/json":
+        body = json.dumps(body.decode(response.charset)).encode("utf-8")
+    return response.status_code, body
+
+
+async def execute(api: "Api", request: http.Request, operations: list[Operation]) -> http.Response:
+    if len(operations) > _maximum:
+        raise routing.ClientError("Too many operations in batch: %d" % len(operations))
+
+    resolved = [resolve(api, request, op) for op in operations]
+    results: list[tuple[int, bytes]] = [(404, b"null") if r is None else (0, b"") for r in resolved]
+    mutations = [i for (i, r) in enumerate(resolved) if r is not None and operations[i].mutate]
+    queries = [i for (i, r) in enumerate(resolved) if r is not None and not operations[i].mutate]
+
+    if mutations:
+        try:
+            async with db.transaction():
+                for i in mutations:
+                    results[i] = await run(*resolved[i]) # type:ignore
+                    if results[i][0] >= 400:
+                        raise _Rollback()
+        except _Rollback:
+            # Rolled back, or never run
+            for i in mutations:
+                if results[i][0] < 400:
+                    results[i] = (424, b"null")
+
+    if queries:
+        async def query(i: int, ctx):
+            with restorecontext(ctx):
+                results[i] = await run(*resolved[i]) # type:ignore
+
+        # NB: a copy of the Context each, since the operational context is set on it
+        await asyncio.gather(*(asyncio.create_task(query(i, get().copy()), context=contextvars.copy_context()) for i in queries))
+
+    body = b"[%s]" % b",".join(b'{"status":%d,"body":%s}' % result for result in results)
+    return http.Response(body, media_type="application/json")
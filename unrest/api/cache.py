@@ -0,0 +1,210 @@
+import asyncio
+import time
+from asyncio import Future, get_running_loop, shield
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Awaitable, Callable, Hashable
+
+from unrest import context, getLogger, http
+from unrest.contexts._context import get, restorecontext
+from unrest.db import rls
+
+from . import encoding
+
+log = getLogger(__name__)
+
+_skipped = (b"content-length", b"content-type", b"content-encoding", b"etag", b"vary")
+# The result followers see when the call they were waiting on was cancelled, so one of them makes it again
+_abandoned = object()
+
+
+class Entry:
+    __slots__ = ("status", "body", "media_type", "headers", "created", "variants")
+
+    def __init__(self, response: http.Response):
+        self.status = response.status_code
+        self.body = bytes(response.body)  # NB: no copy when it already is bytes
+        self.media_type = response.media_type
+        self.headers = {k.decode("latin-1"): v.decode("latin-1") for (k, v) in response.raw_headers if k not in _skipped}
+        self.created = time.monotonic()
+        # Compressed bodies and etags, filled in as clients ask for them
+        self.variants: dict[str | None, tuple[str, bytes]] = {}
+
+
+async def cachekey(request: http.Request, per_user: bool) -> Hashable:
+    # Everything a query's response may depend on: the request itself, and who is allowed to see what
+    user, tenant = context.user, context.tenant
+    body = await request.body() if request.method == "QUERY" else b""
+    return (
+        request.url.path,
+        tuple(sorted(request.query_params.multi_items())),
+        blake2b(body, digest_size=16).digest() if body else None,
+        getattr(tenant, "identity", None),
+        user.identity if per_user else user.is_authenticated,
+        # NB: every claim the user holds, not only those that predicates name, the handler may read any of them
+        rls.claims(user),
+    )
+
+
+class QueryCache:
+    # Rendered responses of an api.query endpoint, keyed by path, query parameters, request body, tenant and user.
+    # Entries are fresh for `ttl` seconds, then served for up to `stale` more while a single background refresh runs.
+    # Concurrent misses for the same key share one handler call.
+    #
+    # NB: per_user=False shares entries between users with the same claims. Only opt in for handlers whose response
+    # depends on nothing else: not on context.user, nor on tables with per-user RLS policies (owner=, rls_user()).
+    def __init__(self, ttl: float = 60.0, stale: float = 0.0, maxsize: int = 10000, per_user: bool = True, public: bool = False) -> None:
+        self.ttl = ttl
+        self.stale = stale
+        self.maxsize = maxsize
+        self.per_user = per_user
+        self.public = public
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries: OrderedDict[Hashable, Entry] = OrderedDict()
+        self._inflight: dict[Hashable, Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def cache_control(self, age: float) -> str:
+        value = "%s, max-age=%d" % ("public" if self.public else "private", max(0, self.ttl - age))
+        if self.stale > 0:
+            value += ", stale-while-revalidate=%d" % self.stale
+        return value
+
+    def serve(self, request: http.Request, entry: Entry, age: float) -> http.Response:
+        response = http.Response(entry.body, status_code=entry.status, headers=entry.headers, media_type=entry.media_type)
+        response.headers["Cache-Control"] = self.cache_control(age)
+        response.headers["Age"] = str(int(age))
+        response = encoding.finalise(request, response, entry.variants)
+        if response.status_code == 304:
+            response.headers["Cache-Control"] = self.cache_control(age)
+        return response
+
+    async def respond(self, request: http.Request, handler: Callable[[], Awaitable[http.Response]]) -> http.Response:
+        # `handler` renders the response without negotiating its encoding, that is done per request here
+        key = await cachekey(request, self.per_user)
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.created
+            if age < self.ttl + self.stale:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                if age >= self.ttl and key not in self._inflight:
+                    self._refresh(key, handler)
+                return self.serve(request, entry, age)
+            del self._entries[key]
+
+        while True:
+            pending = self._inflight.get(key)
+            if pending is None:
+                self.misses += 1
+                entry = await self._load(key, self._begin(key), handler)
+                break
+            entry = await shield(pending)
+            if entry is not _abandoned:
+                self.hits += 1
+                break
+        if entry is None:
+            # Not cacheable (e.g. a 202 or a streamed body), so nothing to share
+            return encoding.finalise(request, await handler())
+        return self.serve(request, entry, time.monotonic() - entry.created)
+
+    def _begin(self, key: Hashable) -> Future:
+        pending = get_running_loop().create_future()
+        self._inflight[key] = pending
+        return pending
+
+    async def _load(self, key: Hashable, pending: Future, handler: Callable[[], Awaitable[http.Response]]) -> Entry | None:
+        try:
+            response = await handler()
+        except Exception as ex:
+            pending.set_exception(ex)
+            pending.exception()  # nobody else may be waiting
+            raise
+        except BaseException:
+            # NB: e.g. the client went away, which is no reason to fail the others
+            pending.set_result(_abandoned)
+            raise
+        finally:
+            del self._inflight[key]
+        entry = None
+        if response.status_code == 200 and isinstance(getattr(response, "body", None), bytes):
+            entry = self._entries[key] = Entry(response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        pending.set_result(entry)
+        return entry
+
+    def _refresh(self, key: Hashable, handler: Callable[[], Awaitable[http.Response]]):
+        # NB: the request's own context is restored (and its user reset) as soon as the stale response is sent
+        ctx = get().copy()
+        pending = self._begin(key)
+
+        async def refresh():
+            with restorecontext(ctx):
+                try:
+                    await self._load(key, pending, handler)
+                    self.refreshes += 1
+                except Exception as ex:
+                    log.warning("Unable to refresh cached response: %s", ex)
+
+        task = asyncio.create_task(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def invalidate_tenant(self, identity: str):
+        for key in [k for k in self._entries if k[3] == identity]: # type:ignore
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SingleFlight:
+    # Concurrent identical requests share one handler call and its rendered response; nothing is kept afterwards.
+    # Scoped to the user by default, so a shared response is only ever one its recipient could have produced.
+    def __init__(self, per_user: bool = True) -> None:
+        self.per_user = per_user
+        self.calls = 0
+        self.shared = 0
+        self._inflight: dict[Hashable, Future] = {}
+
+    async def respond(self, request: http.Request, handler: Callable[[], Awaitable[http.Response]]) -> http.Response:
+        key = await cachekey(request, self.per_user)
+        while True:
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            entry = await shield(pending)
+            if entry is None:
+                return encoding.finalise(request, await handler())
+            if entry is not _abandoned:
+                self.shared += 1
+                response = http.Response(entry.body, status_code=entry.status, headers=entry.headers, media_type=entry.media_type)
+                return encoding.finalise(request, response, entry.variants)
+
+        self.calls += 1
+        pending = self._inflight[key] = get_running_loop().create_future()
+        try:
+            response = await handler()
+        except Exception as ex:
+            pending.set_exception(ex)
+            pending.exception()  # nobody else may be waiting
+            raise
+        except BaseException:
+            pending.set_result(_abandoned)
+            raise
+        finally:
+            del self._inflight[key]
+        if not isinstance(getattr(response, "body", None), bytes):
+            pending.set_result(None)
+            return encoding.finalise(request, response)
+        entry = Entry(response)
+        pending.set_result(entry)
+        response = http.Response(entry.body, status_code=entry.status, headers=entry.headers, media_type=entry.media_type)
+        return encoding.finalise(request, response, entry.variants)
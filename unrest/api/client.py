@@ -28,3 +28,13 @@ class Client(AsyncClient):
             else:
                 kwargs["json"] = payload
         return await self.post(path, **kwargs)
+
+    async def batch(self, operations: list[dict], path="/batch", **kwargs):
+        # Each operation is {"path": ..., "params": {...}, "payload": ..., "mutate": bool}, all but path optional
+        ops = []
+        for op in operations:
+            op = dict(op)
+            if isinstance(op.get("payload"), Payload):
+                op["payload"] = op["payload"].model_dump()
+            ops.append(op)
+        return await self.post(path, json=ops, **kwargs)
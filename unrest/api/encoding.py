@@ -0,0 +1,105 @@
+import gzip
+from hashlib import blake2b
+from typing import Callable
+
+from unrest import config, http
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Negotiated response compression and strong ETags for API responses.
+#
+# Bodies of at least UNREST_COMPRESS_MIN bytes are compressed with the first of UNREST_COMPRESS_ENCODINGS (server
+# preference order) that the client accepts and is installed; brotli and zstandard are optional. Queries also get a
+# strong ETag, per encoding, and a matching If-None-Match is answered with an empty 304.
+
+_minimum = int(config.get("UNREST_COMPRESS_MIN", "1024")) # type:ignore
+_preferred = [e.strip() for e in (config.get("UNREST_COMPRESS_ENCODINGS", "zstd,br,gzip") or "").split(",") if e.strip()]
+
+_compressors: dict[str, Callable[[bytes], bytes]] = {"gzip": lambda body: gzip.compress(body, compresslevel=6, mtime=0)}
+if brotli is not None:
+    _compressors["br"] = lambda body: brotli.compress(body, quality=4)
+if zstandard is not None:
+    _compressors["zstd"] = zstandard.ZstdCompressor(level=3).compress
+
+_encodings = [e for e in _preferred if e in _compressors]
+_conditional = ("GET", "HEAD", "QUERY")
+
+
+def negotiate(accept: str) -> str | None:
+    if not accept or not _encodings:
+        return None
+    accepted: dict[str, float] = {}
+    for part in accept.lower().split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    wildcard = accepted.get("*", 0.0)
+    for encoding in _encodings:
+        if accepted.get(encoding, wildcard) > 0.0:
+            return encoding
+    return None
+
+
+def etag(body: bytes, encoding: str | None = None) -> str:
+    digest = blake2b(body, digest_size=16).hexdigest()
+    return '"%s-%s"' % (digest, encoding) if encoding else '"%s"' % digest
+
+
+def matches(header: str | None, tag: str) -> bool:
+    # If-None-Match uses the weak comparison function
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == tag:
+            return True
+    return False
+
+
+def finalise(request: http.Request, response: http.Response, variants: dict[str | None, tuple[str, bytes]] | None = None) -> http.Response:
+    # `variants` memoises (etag, body) per encoding across requests for the same body, e.g. a cached response
+    body = getattr(response, "body", None)
+    if response.status_code != 200 or not isinstance(body, bytes):
+        return response # e.g. streamed, or nothing worth tagging
+
+    encoding = None
+    if len(body) >= _minimum and _encodings:
+        response.headers["Vary"] = "Accept-Encoding"
+        encoding = negotiate(request.headers.get("accept-encoding", ""))
+
+    variant = variants.get(encoding) if variants is not None else None
+    if request.method in _conditional:
+        # NB: tagged before compressing, so a 304 never pays for it
+        tag = variant[0] if variant is not None else etag(body, encoding)
+        if matches(request.headers.get("if-none-match"), tag):
+            headers = {"ETag": tag}
+            if "vary" in response.headers:
+                headers["Vary"] = response.headers["vary"]
+            return http.Response(status_code=304, headers=headers)
+        response.headers["ETag"] = tag
+
+    if encoding is not None:
+        if variant is None:
+            variant = (response.headers.get("etag") or etag(body, encoding), _compressors[encoding](body))
+            if variants is not None:
+                variants[encoding] = variant
+        response.body = variant[1]
+        response.headers["Content-Encoding"] = encoding
+        response.headers["Content-Length"] = str(len(response.body))
+    elif variant is None and variants is not None:
+        variants[None] = (response.headers.get("etag") or etag(body), body)
+    return response
@@ -34,6 +34,8 @@ class JSONEncoder(json.JSONEncoder):
             return obj.strftime("%Y-%m-%d")
         if isinstance(obj, Decimal):
             return float(obj)
+        if isinstance(obj, BaseModel):
+            return obj.model_dump(mode="json")
         return super().default(obj)
 
 
@@ -1,7 +1,7 @@
 from typing import Any, Awaitable, Callable, Mapping
 
 from unrest.contexts.auth import CookieAuthFunction
-from unrest.http import Request, Response, HTMLResponse, RedirectResponse, Route, UploadFile
+from unrest.http import Request, Response, HTMLResponse, RedirectResponse, Route, UploadFile, URL
 from unrest import context, getLogger, Unauthorized, query as _query, mutate as _mutate
 from unrest import routing, auth
 
@@ -56,34 +56,40 @@ class ApplicationEndpoint(routing.Endpoint):
 
 
 class App(routing.Service):      
-    def authentication(self, cookie="session") -> Callable:
+    def authentication(self, cookie="session", cache: auth.AuthCache | None = None) -> Callable:
         def decorator(f: CookieAuthFunction) -> CookieAuthFunction:
+            async def _lookup(credentials: str | None, url: URL) -> routing.AuthResponse:
+                if cache is None:
+                    return await f(credentials, url)
+                # NB: the url too, since the auth function may resolve the tenant from the host
+                return await cache.get((credentials, str(url)), lambda: f(credentials, url))
+
             async def _authenticate(request: Request) -> routing.AuthResponse:
                 if len(request.cookies) > 0:
                     for key, val in request.cookies.items():
                         if key.lower() == cookie.lower():
                             try:
-                                return await f(val, request.base_url)
+                                return await _lookup(val, request.base_url)
                             except Exception:
                                 raise Unauthorized("Invalid credentials")
-                return await f(None, request.base_url)
+                return await _lookup(None, request.base_url)
             self._authfunction = _authenticate
             return f
         return decorator    
 
-    def get(self, path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
+    def get(self, path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated, sample: float | None = None) -> Callable:
         def decorator(f: Callable) -> Callable:
             name = f.__module__ + "." + f.__name__
             q = _query(perms)(f)
-            self.add(Route(path, ApplicationEndpoint(q, self), methods=["GET"], name=name)) 
+            self.add(Route(path, ApplicationEndpoint(q, self, sample), methods=["GET"], name=name)) 
             return q
         return decorator
 
-    def post(self, path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
+    def post(self, path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated, sample: float | None = None) -> Callable:
         def decorator(f: Callable) -> Callable:
             name = f.__module__ + "." + f.__name__
             m = _mutate(perms)(f)
-            self.add(Route(path, ApplicationEndpoint(m, self), methods=["POST"], name=name)) 
+            self.add(Route(path, ApplicationEndpoint(m, self, sample), methods=["POST"], name=name)) 
             return m
         return decorator
 
@@ -94,11 +100,11 @@ class App(routing.Service):
         return HTMLResponse(status_code=status_code)
 
 
-def get(path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
-    return get_instance().get(path, perms) 
+def get(path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated, sample: float | None = None) -> Callable:
+    return get_instance().get(path, perms, sample) 
 
-def post(path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated) -> Callable:
-    return get_instance().post(path, perms)
+def post(path, perms: auth.UserPredicateFunction = auth.UserIsAuthenticated, sample: float | None = None) -> Callable:
+    return get_instance().post(path, perms, sample)
 
 def redirect(url: str, status_code: int = 302, headers: Mapping[str, str] | None = None) -> RedirectResponse:
     return RedirectResponse(url, status_code=status_code, headers=headers)
@@ -106,8 +112,8 @@ def redirect(url: str, status_code: int = 302, headers: Mapping[str, str] | None
 def abort(status_code) -> HTMLResponse:
     return HTMLResponse(status_code=status_code)
 
-def authentication(cookie="session") -> Callable:
-    return get_instance().authentication(cookie)
+def authentication(cookie="session", cache: auth.AuthCache | None = None) -> Callable:
+    return get_instance().authentication(cookie, cache)
 
 
 _services : dict[str, App] = {}
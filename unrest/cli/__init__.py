@@ -50,6 +50,22 @@ async def init():
         print("ERROR: %s" % str(ex))
 
 
+@cli.command()
+@click.argument("target", default="entrypoint:server")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8000, show_default=True)
+@click.option("--workers", "-w", default=0, help="Worker processes  [default: CPU count]")
+@click.option("--reuse-port/--shared-socket", default=False, help="Bind each worker's own socket with SO_REUSEPORT")
+@click.option("--graceful", default=30.0, show_default=True, help="Seconds to finish in-flight requests on shutdown")
+def serve(target, host, port, workers, reuse_port, graceful):
+    """
+    Serve the application from pre-forked workers (SIGHUP for a rolling restart)
+    """
+    from unrest import workers as _workers
+    app = _workers.prepare(target)
+    _workers.Supervisor(app, host, port, workers or None, reuse_port, graceful).run()
+
+
 @db.command()
 async def reset():
     """
@@ -1,12 +1,14 @@
-from contextlib import asynccontextmanager, contextmanager
+from collections import ChainMap
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from functools import wraps
 from contextvars import ContextVar
 from inspect import iscoroutinefunction
 from typing import Any, Callable, Optional
+import time
 import uuid
 
-from unrest.contexts.auth import Tenant, User, UnauthenticatedUser, UserPredicateFunction, Unrestricted
+from unrest.contexts.auth import Tenant, User, UnauthenticatedUser, UserPredicateFunction, Unrestricted, evaluate, memoizable
 from unrest.http import Request
 
 # defuser = UnauthenticatedUser("00000000-0000-0000-0000-000000000000", "", {}, {})
@@ -21,7 +23,66 @@ class Unauthenticated(ContextError):
     pass
 
 
-@dataclass(kw_only=True)
+class Vars(ChainMap):
+    # ChainMap, minus the exception-driven lookup through parent frames and the slow flattening
+    def __getitem__(self, key):
+        for m in self.maps:
+            if key in m:
+                return m[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        for m in self.maps:
+            if key in m:
+                return m[key]
+        return default
+
+    def flatten(self) -> dict[str, Any]:
+        d: dict[str, Any] = {}
+        for m in reversed(self.maps):
+            d.update(m)
+        return d
+
+    # NB: deletes copy the outer frames into the innermost first, so they are undone when its block exits
+
+    def _collapse(self):
+        if len(self.maps) > 1:
+            self.maps = [self.flatten()]
+
+    def __delitem__(self, key):
+        if key not in self.maps[0]:
+            self._collapse()
+        del self.maps[0][key]
+
+    def pop(self, key, *default):
+        if key not in self.maps[0]:
+            self._collapse()
+        return self.maps[0].pop(key, *default)
+
+    def popitem(self):
+        self._collapse()
+        return self.maps[0].popitem()
+
+    def clear(self):
+        self.maps = [{}]
+
+
+class Frame:
+    __slots__ = ("ctx", "kwargs", "_vars")
+
+    def __init__(self, ctx: "Context", kwargs: dict[str, Any]):
+        self.ctx = ctx
+        self.kwargs = kwargs
+
+    def __enter__(self):
+        self._vars = self.ctx._vars
+        self.ctx._vars = self._vars.new_child(self.kwargs)
+
+    def __exit__(self, type, value, traceback):
+        self.ctx._vars = self._vars
+
+
+@dataclass(kw_only=True, slots=True)
 class Context:
     id: str = str(uuid.uuid4())
     user: User = field(default_factory=lambda: UnauthenticatedUser())
@@ -31,25 +92,21 @@ class Context:
     _global: bool = None #type:ignore
     _local: bool = None #type:ignore
     _entrypoint: str = None #type:ignore
-    _vars: dict[str, Any] = field(default_factory=dict)
-    _stack: list[dict[str, Any]] = field(default_factory=list)
+    # Each nested context(**kwargs) block pushes a frame rather than copying everything above it
+    _vars: Vars = field(default_factory=Vars)
+    # Permission checks already made during this request
+    _memo: dict[tuple, tuple] = field(default_factory=dict)
+    # time.monotonic() by which the request must complete, if any
+    _deadline: float | None = None
 
     def __post_init__(self):
-        self._stack.append(self._vars)
+        if not isinstance(self._vars, Vars):
+            self._vars = Vars(self._vars)
 
-    @contextmanager
-    def set(self, **kwargs):
-        self._vars = dict(self._vars)
-        self._vars.update(kwargs)
-        self._stack.append(self._vars)
-        try:
-            yield
-        finally:
-            self._stack.pop()
-            self._vars = self._stack[-1]
+    def set(self, **kwargs) -> Frame:
+        return Frame(self, kwargs)
 
     def copy(self) -> "Context":
-        stack = [ dict(s) for s in self._stack ]
         return Context(
             id=self.id,
             user=self.user,
@@ -58,50 +115,92 @@ class Context:
             _global=self._global,
             _local=self._local,
             _entrypoint=self._entrypoint,
-            _stack=stack,
-            _vars=stack[-1],
+            _vars=Vars(self._vars.flatten()),
+            _deadline=self._deadline,
         )
 
+    def remaining(self) -> float | None:
+        # NB: a passed deadline is raised rather than returned, so nothing starts that cannot finish
+        if self._deadline is None:
+            return None
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Request deadline exceeded")
+        return remaining
+
+    def export(self) -> dict[str, Any]:
+        # Plain snapshot that can be serialised and passed back to Context(**kwargs), e.g. by a task worker
+        return {
+            "id": self.id,
+            "user": self.user,
+            "tenant": self.tenant,
+            "_global": self._global,
+            "_local": self._local,
+            "_entrypoint": self._entrypoint,
+            "_vars": self._vars.flatten(),
+        }
+
 
 
 __ctx: ContextVar[Context] = ContextVar("context")
+_current = __ctx.get
 
 def get() -> Context:
-    ctx =  __ctx.get(None)
-    if ctx is None:
+    try:
+        return _current()
+    except LookupError:
         ctx = Context()
         __ctx.set(ctx)
-    return ctx
+        return ctx
 
-@asynccontextmanager
-async def operationalcontext(is_mutation: bool, f: Callable, expr: UserPredicateFunction):
-    try:
+
+def authorize(expr: UserPredicateFunction, ctx: Context) -> bool:
+    user = ctx.user
+    # NB: only predicates of the user alone are memoized for the request, other callables may read other state
+    if ctx._request is None or not memoizable(expr):
+        return evaluate(expr, user, ctx._local)
+    key = (id(expr), id(user), ctx._local)
+    hit = ctx._memo.get(key)
+    if hit is not None and hit[0] is expr and hit[1] is user:
+        return hit[2]
+    result = evaluate(expr, user, ctx._local)
+    ctx._memo[key] = (expr, user, result)
+    return result
+
+
+class operationalcontext:
+    # A plain class rather than an asynccontextmanager generator: this is entered on every query/mutate call
+    __slots__ = ("is_mutation", "f", "expr", "_saved")
+
+    def __init__(self, is_mutation: bool, f: Callable, expr: UserPredicateFunction):
+        self.is_mutation = is_mutation
+        self.f = f
+        self.expr = expr
+
+    async def __aenter__(self) -> Context:
         ctx = get()
-        _root   = ctx._global is None
-        _local  = ctx._local
-        _global = ctx._global
-        _entry = ctx._entrypoint
-        if _root:
-            ctx._global = is_mutation
+        f = self.f
+        self._saved = (ctx, ctx._local, ctx._global, ctx._entrypoint)
+        if ctx._global is None:
+            ctx._global = self.is_mutation
             ctx._entrypoint = f.__module__ + "." + f.__name__        
-        ctx._local = is_mutation
-        try:        
-            if not expr(ctx.user):
+        ctx._local = self.is_mutation
+        try:
+            if not authorize(self.expr, ctx):
                raise Unauthorized("User is not authorized: %s" % f.__name__)
 
-            if ctx._global is False and is_mutation:
+            if ctx._global is False and self.is_mutation:
                 raise ContextError("Cannot mutate in a query context: %s" % f.__name__)
-
-            yield ctx
-        except Exception as e:
-            # TODO: e.g. log error
+        except BaseException:
+            self._restore()
             raise
-        finally:
-            ctx._local = _local
-            ctx._global = _global  
-            ctx._entrypoint = _entry        
-    except LookupError:
-        raise ContextError("No context")
+        return ctx
+
+    async def __aexit__(self, type, value, traceback):
+        self._restore()
+
+    def _restore(self):
+        ctx, ctx._local, ctx._global, ctx._entrypoint = self._saved
 
 @contextmanager
 def usercontext(user : User, tenant: Tenant | None = None):
@@ -145,17 +244,23 @@ def restorecontext(context: Context):
         __ctx.reset(token)
 
 @contextmanager
-def requestcontext(request: Request | None = None):
+def requestcontext(request: Request | None = None, deadline: float | None = None):
     ctx = get()
     _req = ctx._request
     _id = ctx.id
+    _memo = ctx._memo
+    _deadline = ctx._deadline
     try:
         ctx.id = str(uuid.uuid4())
         ctx._request = request
+        ctx._memo = {}
+        ctx._deadline = deadline
         yield
     finally:
         ctx._request = _req
         ctx.id = _id
+        ctx._memo = _memo
+        ctx._deadline = _deadline
 
 
 def query(expr: UserPredicateFunction = Unrestricted):
@@ -182,26 +287,36 @@ def mutate(expr: UserPredicateFunction = Unrestricted):
     return decorator
 
 class ContextWrapper:
+    __slots__ = ()
+
     @property
     def _ctx(self):
         return get()
 
     @property
     def id(self):
-        return self._ctx.id
+        return get().id
     
     @property
     def user(self):
-        return self._ctx.user
+        return get().user
 
     @property
     def tenant(self):
-        return self._ctx.tenant
+        return get().tenant
+
+    @property
+    def deadline(self) -> float | None:
+        return get()._deadline
+
+    def remaining(self) -> float | None:
+        # Seconds left before the request's deadline, or None without one
+        return get().remaining()
 
     @property
     def request(self):
         # We should never need to use this but provided as a fallback
-        return self._ctx._request
+        return get()._request
 
     # @contextmanager
     # def unsafe(self):
@@ -214,58 +329,55 @@ class ContextWrapper:
     #     finally:
     #         ctx._global = prev
 
-    @contextmanager
     def __call__(self, **kwargs):
-        with self._ctx.set(**kwargs):
-            yield
+        return get().set(**kwargs)
+
+    # NB: writes and deletes only apply to the innermost context(**kwargs) block
 
     def __setitem__(self, key, item):
-        self._ctx._vars[key] = item
+        get()._vars[key] = item
 
     def __getitem__(self, key):
-        return self._ctx._vars[key]
+        return get()._vars[key]
 
     def __repr__(self):
-        return repr(self._ctx._vars)
+        return repr(get()._vars.flatten())
 
     def __len__(self):
-        return len(self._ctx._vars)
+        return len(get()._vars)
 
     def __delitem__(self, key):
-        del self._ctx._vars[key]
+        del get()._vars[key]
 
     def clear(self):
-        return self._ctx._vars.clear()
+        return get()._vars.clear()
 
     def copy(self):
-        return self._ctx._vars.copy()
+        return get()._vars.flatten()
 
     def has_key(self, k):
-        return k in self._ctx._vars
+        return k in get()._vars
 
     def update(self, *args, **kwargs):
-        return self._ctx._vars.update(*args, **kwargs)
+        return get()._vars.update(*args, **kwargs)
 
     def keys(self):
-        return self._ctx._vars.keys()
+        return get()._vars.keys()
 
     def values(self):
-        return self._ctx._vars.values()
+        return get()._vars.values()
 
     def items(self):
-        return self._ctx._vars.items()
+        return get()._vars.items()
 
     def pop(self, *args):
-        return self._ctx._vars.pop(*args)
+        return get()._vars.pop(*args)
 
     def __cmp__(self, dict_):
-        return self.__cmp__(self._ctx._vars, dict_)
+        return self.__cmp__(get()._vars, dict_)
 
     def __contains__(self, item):
-        return item in self._ctx._vars
+        return item in get()._vars
 
     def __iter__(self):
-        return iter(self._ctx._vars)
-
-
-
+        return iter(get()._vars)
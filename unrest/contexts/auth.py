@@ -1,7 +1,10 @@
+from asyncio import Future, get_running_loop, shield
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from functools import wraps
 from inspect import iscoroutinefunction
-from typing import Any, Awaitable, Callable, Mapping, Protocol, Tuple
+from typing import Any, Awaitable, Callable, Hashable, Mapping, Protocol, Tuple, cast
+import time
 import uuid
 
 from unrest import http
@@ -78,60 +81,148 @@ class UserPredicateFunction(Protocol):
     def __call__(self, user: User) -> bool:
         ...
 
-class AndExpression(UserPredicateFunction):
-    def __init__(self, left: UserPredicateFunction, right: UserPredicateFunction) -> None:
-        self._left = left
-        self._right = right
+# Predicate trees are compiled once into a single flat Python expression over the user's claims,
+# pre-indexed as bitsets: one of claims usable in a query and one of claims usable in a mutation.
+# NB: only claims named in compiled predicates get a bit, never whatever claims tokens happen to carry
+_claimbits: dict[str, int] = {}
+
+def _claimbit(name: str) -> int:
+    bit = _claimbits.get(name)
+    if bit is None:
+        bit = _claimbits[name] = 1 << len(_claimbits)
+    return bit
+
+def claimset(user: User) -> tuple[int, int]:
+    # Cached on the user until its claims change, or a newly compiled predicate names another claim
+    cached = user.__dict__.get("_claimset")
+    if cached is not None and cached[0] is user.claims and cached[1] == len(_claimbits):
+        return cached[2]
+    read = write = 0
+    for name, value in user.claims.items():
+        bit = _claimbits.get(name)
+        if bit is None:
+            continue
+        try:
+            if value >= False:
+                read |= bit
+            if value >= True:
+                write |= bit
+        except TypeError:
+            pass
+    user.__dict__["_claimset"] = (user.claims, len(_claimbits), (read, write))
+    return read, write
+
+def _overrides(expr: Any) -> bool:
+    return type(expr).__call__ is not _structural
+
+def _source(expr: UserPredicateFunction, env: dict[str, Any], root: bool = False) -> str:
+    # NB: subclasses that override __call__ are opaque leaves below the root, so their own __call__ decides
+    if isinstance(expr, UserPredicate) and (root or not _overrides(expr)):
+        if isinstance(expr, Claim):
+            return "(b & %d != 0)" % _claimbit(expr._name)
+        if isinstance(expr, AndExpression):
+            return "(%s and %s)" % (_source(expr._left, env), _source(expr._right, env))
+        if isinstance(expr, OrExpression):
+            return "(%s or %s)" % (_source(expr._left, env), _source(expr._right, env))
+        if isinstance(expr, NotExpression):
+            return "(not %s)" % _source(expr._expr, env)
+        if isinstance(expr, UnrestrictedHelper):
+            return "True"
+        if isinstance(expr, UserIsAuthenticatedHelper):
+            return "a"
+        raise TypeError("Not a permission expression: %r" % expr)
+    name = "f%d" % len(env)
+    env[name] = expr
+    return "%s(user)" % name
+
+def compile_predicate(expr: UserPredicateFunction) -> Callable[[User, bool, int], bool]:
+    env: dict[str, Any] = {}
+    return eval("lambda user, a, b: bool(%s)" % _source(expr, env, True), env)
+
+def evaluate(expr: UserPredicateFunction, user: User, mutation: bool | None) -> bool:
+    # NB: avoids isinstance(), which is slow against Protocol subclasses
+    check: Any = getattr(expr, "_compiled", False)
+    if check is False or type(expr).__call__ is not _structural:
+        return expr(user)
+    return _check(cast(UserPredicate, expr), check, user, mutation)
+
+def memoizable(expr: UserPredicateFunction) -> bool:
+    # Whether the result depends on the user alone: structural predicates do, opaque callables may read anything
+    pure = getattr(expr, "_pure", False)
+    if pure is None:
+        pure = expr._pure = _structural_only(expr) # type:ignore
+    return pure
+
+def _structural_only(expr: UserPredicateFunction) -> bool:
+    if not isinstance(expr, UserPredicate) or _overrides(expr):
+        return False
+    if isinstance(expr, (AndExpression, OrExpression)):
+        return _structural_only(expr._left) and _structural_only(expr._right)
+    if isinstance(expr, NotExpression):
+        return _structural_only(expr._expr)
+    return True
 
-    def __call__(self, user: User) -> bool:
-        return self._left(user) and self._right(user)
-    
-class OrExpression(UserPredicateFunction):
-    def __init__(self, left: UserPredicateFunction, right: UserPredicateFunction) -> None:
-        self._left = left
-        self._right = right
+def _check(expr: "UserPredicate", check: Callable[[User, bool, int], bool] | None, user: User, mutation: bool | None) -> bool:
+    if check is None:
+        check = expr._compiled = compile_predicate(expr)
+    if not user.is_authenticated:
+        return check(user, False, 0)
+    return check(user, True, claimset(user)[1 if mutation else 0])
 
-    def __call__(self, user: User) -> bool:
-        return self._left(user) or self._right(user)
-    
-class NotExpression(UserPredicateFunction):
-    def __init__(self, expr: UserPredicateFunction) -> None:
-        self._expr = expr
+_get: Callable[[], Any] | None = None
+
+def _mutation() -> bool | None:
+    global _get
+    if _get is None:
+        from unrest.contexts._context import get
+        _get = get
+    return _get()._local
 
-    def __call__(self, user: User) -> bool:
-        return not self._expr(user)
 
 class UserPredicate(UserPredicateFunction):
+    _compiled: Callable[[User, bool, int], bool] | None = None
+    _pure: bool | None = None
+
     def __and__(self, other: UserPredicateFunction) -> UserPredicateFunction:
         return AndExpression(self, other)
     def __or__(self, other: UserPredicateFunction) -> UserPredicateFunction:
         return OrExpression(self, other)
     def __invert__(self) -> UserPredicateFunction:
         return NotExpression(self)
+    def __call__(self, user: User) -> bool:
+        return _check(self, self._compiled, user, _mutation())
+
+_structural = UserPredicate.__call__
+
+class AndExpression(UserPredicate):
+    def __init__(self, left: UserPredicateFunction, right: UserPredicateFunction) -> None:
+        self._left = left
+        self._right = right
+    
+class OrExpression(UserPredicate):
+    def __init__(self, left: UserPredicateFunction, right: UserPredicateFunction) -> None:
+        self._left = left
+        self._right = right
+    
+class NotExpression(UserPredicate):
+    def __init__(self, expr: UserPredicateFunction) -> None:
+        self._expr = expr
     
 class Claim(UserPredicate):
+    # Granted if the user holds the claim, and it is true when in a mutation context
     def __init__(self, name: str) -> None:
         self._name = name
-    def __call__(self, user: User) -> bool:
-        from unrest.contexts import context
-        if not user.is_authenticated:
-            return False
-        # if "*" in user.claims:
-        #     return user.claims["*"] >= context._ctx._local
-        return self._name in user.claims and user.claims[self._name] >= context._ctx._local     
     
 
 
 
 class UnrestrictedHelper(UserPredicate):
-    def __call__(self, user: User) -> bool:
-        return True
+    pass
 Unrestricted = UnrestrictedHelper()
 
 
 class UserIsAuthenticatedHelper(UserPredicate):
-    def __call__(self, user: User) -> bool:
-        return user.is_authenticated
+    pass
 UserIsAuthenticated = UserIsAuthenticatedHelper()
 
 
@@ -140,4 +231,89 @@ AuthResponse = Tuple[User, Tenant | None]
 AuthFunction = Callable[[http.Request], Awaitable[AuthResponse]]
 
 TokenAuthFunction = Callable[[str|None, http.URL], Awaitable[AuthResponse]]
-CookieAuthFunction = Callable[[str|None, http.URL], Awaitable[AuthResponse]]
\ No newline at end of file
+CookieAuthFunction = Callable[[str|None, http.URL], Awaitable[AuthResponse]]
+
+# What followers see when the lookup they were waiting on was cancelled
+_abandoned = object()
+
+
+class AuthCache:
+    # Caches credentials -> (User, Tenant) so authentication isn't a database round-trip per request.
+    # Failed lookups are cached briefly (negative_ttl) and concurrent misses for the same credentials
+    # share a single call to the underlying auth function.
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 5.0, maxsize: int = 10000) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[float, AuthResponse]] = OrderedDict()
+        self._inflight: dict[Hashable, Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, key: Hashable, response: AuthResponse, ttl: float | None = None):
+        if ttl is None:
+            ttl = self.ttl if response[0].is_authenticated else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def peek(self, key: Hashable) -> AuthResponse | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[AuthResponse]]) -> AuthResponse:
+        response = self.peek(key)
+        if response is not None:
+            self.hits += 1
+            return response
+
+        while (pending := self._inflight.get(key)) is not None:
+            shared = await shield(pending)
+            if shared is not _abandoned:
+                self.hits += 1
+                return shared
+
+        self.misses += 1
+        pending = get_running_loop().create_future()
+        self._inflight[key] = pending
+        try:
+            response = await loader()
+        except Exception as ex:
+            pending.set_exception(ex)
+            pending.exception()  # nobody else may be waiting
+            raise
+        except BaseException:
+            # NB: e.g. the client went away, which is no reason to fail the others: the first of them loads it again
+            pending.set_result(_abandoned)
+            raise
+        finally:
+            del self._inflight[key]
+        pending.set_result(response)
+        self.put(key, response)
+        return response
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def invalidate_user(self, identity: str):
+        for key in [k for k, (_, (user, _)) in self._entries.items() if str(user.identity) == str(identity)]:
+            del self._entries[key]
+
+    def invalidate_tenant(self, identity: str):
+        for key in [k for k, (_, (_, tenant)) in self._entries.items() if tenant is not None and str(tenant.identity) == str(identity)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,194 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from functools import lru_cache
+from typing import Any, Iterable, Mapping
+
+from unrest import http
+from unrest.contexts import config, getLogger
+from unrest.contexts.auth import AuthCache, AuthenticatedUser, AuthResponse, Tenant, UnauthenticatedUser
+
+log = getLogger(__name__)
+
+_hmacs = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+_rsas = {"RS256": "SHA256", "RS384": "SHA384", "RS512": "SHA512"}
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _crypto():
+    try:
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+    except ImportError:
+        raise RuntimeError("RSA and EdDSA tokens require the 'cryptography' package")
+    return InvalidSignature, hashes, serialization, padding
+
+
+@lru_cache(maxsize=32)
+def _public_key(pem: str) -> Any:
+    _, _, serialization, _ = _crypto()
+    return serialization.load_pem_public_key(pem.encode("ascii"))
+
+
+@lru_cache(maxsize=32)
+def _private_key(pem: str) -> Any:
+    _, _, serialization, _ = _crypto()
+    return serialization.load_pem_private_key(pem.encode("ascii"), password=None)
+
+
+def sign(claims: Mapping[str, Any], key: str, algorithm: str = "HS256") -> str:
+    header = _b64encode(json.dumps({"alg": algorithm, "typ": "JWT"}, separators=(",", ":")).encode())
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    signing_input = ("%s.%s" % (header, payload)).encode("ascii")
+    if algorithm in _hmacs:
+        signature = hmac.new(key.encode(), signing_input, _hmacs[algorithm]).digest()
+    elif algorithm in _rsas:
+        _, hashes, _, padding = _crypto()
+        signature = _private_key(key).sign(signing_input, padding.PKCS1v15(), getattr(hashes, _rsas[algorithm])())
+    elif algorithm == "EdDSA":
+        signature = _private_key(key).sign(signing_input)
+    else:
+        raise InvalidToken("Unsupported algorithm: %s" % algorithm)
+    return "%s.%s" % (signing_input.decode("ascii"), _b64encode(signature))
+
+
+def verify(token: str, secret: str | None = None, public_key: str | None = None, algorithms: Iterable[str] = ("HS256",), audience: str | None = None, issuer: str | None = None, leeway: float = 0.0) -> dict[str, Any]:
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        header = json.loads(_b64decode(header_b64))
+        signature = _b64decode(signature_b64)
+    except Exception:
+        raise InvalidToken("Malformed token")
+
+    # NB: symmetric and asymmetric keys are configured separately, so a public key can never be used as an HMAC secret
+    algorithm = header.get("alg")
+    if algorithm not in algorithms:
+        raise InvalidToken("Algorithm not allowed: %s" % algorithm)
+    signing_input = ("%s.%s" % (header_b64, payload_b64)).encode("ascii")
+    if algorithm in _hmacs:
+        if secret is None:
+            raise InvalidToken("No secret configured for %s" % algorithm)
+        if not hmac.compare_digest(hmac.new(secret.encode(), signing_input, _hmacs[algorithm]).digest(), signature):
+            raise InvalidToken("Invalid signature")
+    elif algorithm in _rsas or algorithm == "EdDSA":
+        if public_key is None:
+            raise InvalidToken("No public key configured for %s" % algorithm)
+        InvalidSignature, hashes, _, padding = _crypto()
+        try:
+            if algorithm == "EdDSA":
+                _public_key(public_key).verify(signature, signing_input)
+            else:
+                _public_key(public_key).verify(signature, signing_input, padding.PKCS1v15(), getattr(hashes, _rsas[algorithm])())
+        except (InvalidSignature, TypeError, ValueError):
+            raise InvalidToken("Invalid signature")
+    else:
+        raise InvalidToken("Unsupported algorithm: %s" % algorithm)
+
+    try:
+        claims = json.loads(_b64decode(payload_b64))
+    except Exception:
+        raise InvalidToken("Malformed token")
+    if not isinstance(claims, dict):
+        raise InvalidToken("Malformed token")
+
+    now = time.time()
+    if "exp" in claims and now > float(claims["exp"]) + leeway:
+        raise InvalidToken("Token has expired")
+    if "nbf" in claims and now < float(claims["nbf"]) - leeway:
+        raise InvalidToken("Token is not yet valid")
+    if audience is not None:
+        aud = claims.get("aud")
+        if audience not in (aud if isinstance(aud, list) else [aud]):
+            raise InvalidToken("Invalid audience")
+    if issuer is not None and claims.get("iss") != issuer:
+        raise InvalidToken("Invalid issuer")
+    return claims
+
+
+class JWTAuthentication:
+    # Stateless bearer authentication: tokens are verified locally and never touch the database.
+    # Use as api.authentication("bearer")(JWTAuthentication()); keys default to JWT_* config.
+    def __init__(
+        self,
+        secret: str | None = None,
+        public_key: str | None = None,
+        algorithms: Iterable[str] | None = None,
+        audience: str | None = None,
+        issuer: str | None = None,
+        leeway: float = 0.0,
+        cache: AuthCache | None = None,
+    ) -> None:
+        self.secret = secret or config.get("JWT_SECRET")
+        self.public_key = public_key or config.get("JWT_PUBLIC_KEY")
+        self.algorithms = tuple(algorithms or (config.get("JWT_ALGORITHMS", "HS256") or "HS256").split(","))
+        self.audience = audience or config.get("JWT_AUDIENCE")
+        self.issuer = issuer or config.get("JWT_ISSUER")
+        self.leeway = leeway
+        self.cache = cache if cache is not None else AuthCache()
+        if self.secret is None and self.public_key is None:
+            raise RuntimeError("JWT_SECRET or JWT_PUBLIC_KEY must be set")
+
+    def verify(self, token: str) -> dict[str, Any]:
+        return verify(token, self.secret, self.public_key, self.algorithms, self.audience, self.issuer, self.leeway)
+
+    def map(self, claims: dict[str, Any]) -> AuthResponse:
+        granted = claims.get("claims", {})
+        if isinstance(granted, str):
+            granted = {c: True for c in granted.split()}
+        elif isinstance(granted, list):
+            granted = {c: True for c in granted}
+        user = AuthenticatedUser(
+            identity=str(claims["sub"]),
+            display_name=claims.get("name") or claims.get("email") or str(claims["sub"]),
+            props={k: v for (k, v) in claims.items() if k != "claims"},
+            claims=granted,
+        )
+        tenant = claims.get("tenant")
+        if tenant is None:
+            return user, Tenant()
+        if isinstance(tenant, dict):
+            user.tenant = str(tenant["id"])
+            return user, Tenant(identity=str(tenant["id"]), display_name=tenant.get("name", ""), props=tenant)
+        user.tenant = str(tenant)
+        return user, Tenant(identity=str(tenant))
+
+    async def __call__(self, token: str | None, url: http.URL) -> AuthResponse:
+        if token is None:
+            return UnauthenticatedUser(), Tenant()
+
+        response = self.cache.peek(token)
+        if response is not None:
+            self.cache.hits += 1
+            return response
+        self.cache.misses += 1
+
+        try:
+            claims = self.verify(token)
+            if "sub" not in claims:
+                raise InvalidToken("Token has no subject")
+        except InvalidToken as ex:
+            log.warning("Rejected bearer token: %s", ex)
+            response = UnauthenticatedUser(), Tenant()
+            self.cache.put(token, response)
+            return response
+
+        response = self.map(claims)
+        ttl = self.cache.ttl
+        if "exp" in claims:
+            ttl = min(ttl, float(claims["exp"]) + self.leeway - time.time())
+        self.cache.put(token, response, ttl)
+        return response
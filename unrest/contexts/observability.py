@@ -1,35 +1,212 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import os
 import sys
+import threading
+import time
 from datetime import datetime, timezone
+from queue import Empty, SimpleQueue
 
 from pythonjsonlogger.jsonlogger import JsonFormatter
 
+from unrest import metrics, tracing
+from unrest.contexts import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None # type:ignore
+
 loglevel = logging.INFO
 otherlevel = logging.ERROR
 
 
+def _dumps(obj, default=None, **kwargs) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            pass  # e.g. integers wider than 64 bits
+    return json.dumps(obj, default=default, separators=(",", ":"), ensure_ascii=False)
+
+
+def capture(record: logging.LogRecord) -> None:
+    # NB: must run on the emitting thread (and task), the writer thread has no access to its context
+    if "context" in record.__dict__:
+        return
+    ctx = _get()
+    usr = ctx.user
+    record.__dict__.update({
+        "context": {"id": ctx.id, "entrypoint": ctx._entrypoint, "mutation": ctx._global, "properties": { k: v for (k,v) in ctx._vars.flatten().items() if not k.startswith("_")} },
+        "user": {"id": usr.identity, "display_name": usr.display_name, "properties": usr.props},
+    })
+    span = tracing.current()
+    if span is not None:
+        record.__dict__["trace"] = {"trace_id": span.trace_id, "span_id": span.span_id}
+
+
+def _get():
+    # NB: deferred, the context module imports this one
+    global _get
+    from unrest.contexts._context import get as _get
+    return _get()
+
+
 class Formatter(JsonFormatter):
     def formatTime(self, record, datefmt=None):
-        from unrest.contexts import context
-        ctx = context._ctx
-        usr = ctx.user
-        record.__dict__.update({
-            "context": {"id": ctx.id, "entrypoint": ctx._entrypoint, "mutation": ctx._global, "properties": { k: v for (k,v) in ctx._vars.items() if not k.startswith("_")} },
-            "user": {"id": usr.identity, "display_name": usr.display_name, "properties": usr.props},
-        })
+        capture(record)
         return datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds")
 
 
+class QueueHandler(logging.handlers.QueueHandler):
+    # Cheap on the caller: snapshot the context and message, then hand off to the writer without blocking
+    def __init__(self, queue: SimpleQueue, maxsize: int = 10000):
+        super().__init__(queue)
+        self.records = queue
+        self.maxsize = maxsize
+        self.enqueued = 0
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        capture(record)
+        if not isinstance(record.msg, dict):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # NB: SimpleQueue is far cheaper to put to than Queue, so bound it by hand
+        if self.records.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self.enqueued += 1
+        self.records.put_nowait(record)
+
+
+class Writer:
+    # Formats and writes queued records on a background thread, one write per batch
+    def __init__(self, queue: SimpleQueue, handler: QueueHandler, stream=None, batch: int = 256):
+        self.queue = queue
+        self.handler = handler
+        self.stream = stream
+        self.batch = batch
+        self.processed = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self._reported = 0
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="unrest-log-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            stop = None in records
+            if stop:
+                records = [r for r in records if r is not None]
+            self._write(records)
+            self.processed += len(records)
+            if stop:
+                return
+
+    def _write(self, records: list[logging.LogRecord]) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(formatter.format(record))
+            except Exception:
+                self.errors += 1
+        dropped = self.handler.dropped
+        if dropped != self._reported:
+            lines.append(_dumps({"logger": __name__, "timestamp": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), "loglevel": "WARNING", "message": "Dropped %d log records" % (dropped - self._reported)}))
+            self._reported = dropped
+        if not lines:
+            return
+        try:
+            stream = self.stream or sys.stderr
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+            self.written += len(lines)
+            self.batches += 1
+        except Exception:
+            self.errors += 1
+
+    def flush(self, timeout: float = 1.0) -> bool:
+        deadline = time.monotonic() + timeout
+        target = self.handler.enqueued
+        while self.processed < target and self._thread is not None:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def stop(self, timeout: float = 1.0) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout)
+        self._thread = None
+
+
 fmtstring = "%(name)s %(asctime)s %(levelname)s %(filename)s:%(lineno)s %(message)s"
 mapping = {"name": "logger", "asctime": "timestamp", "levelname": "loglevel"}
-formatter = Formatter(fmtstring, json_default=str, rename_fields=mapping)  # json_indent=2
-logHandler = logging.StreamHandler(stream=sys.stderr)
+formatter = Formatter(fmtstring, json_default=str, json_serializer=_dumps, rename_fields=mapping)  # json_indent=2
+
+if config.get("UNREST_LOG_SYNC", "true" if config.is_under_test() else "false") == "true":
+    # Debugging aid: format and write on the caller (and the default under test, so output is captured per test)
+    logHandler: logging.Handler = logging.StreamHandler(stream=sys.stderr)
+    writer = None
+else:
+    _queue: SimpleQueue = SimpleQueue()
+    logHandler = QueueHandler(_queue, int(config.get("UNREST_LOG_BUFFER", "10000"))) # type:ignore
+    writer = Writer(_queue, logHandler)
+    writer.start()
+    atexit.register(writer.stop)
+    # NB: threads do not survive fork()
+    os.register_at_fork(after_in_child=writer.start)
+
 logHandler.setLevel(loglevel)
 logHandler.setFormatter(formatter)
 logging.root.handlers = [logHandler]
 
 logging.basicConfig(level=loglevel, handlers=[logHandler])
 
+
+def flush(timeout: float = 1.0) -> bool:
+    return True if writer is None else writer.flush(timeout)
+
+
+def stats() -> dict[str, int]:
+    if writer is None:
+        return {}
+    return {"queued": writer.queue.qsize(), "dropped": writer.handler.dropped, "written": writer.written, "batches": writer.batches, "errors": writer.errors}
+
+
+@metrics.collector
+def _collect():
+    for (name, value) in stats().items():
+        if name == "queued":
+            gauge = metrics.Gauge("unrest_log_queued", "Log records waiting for the writer")
+            gauge.set(value)
+            yield gauge
+        else:
+            counter = metrics.Counter("unrest_log_%s_total" % name, "Log pipeline %s" % name)
+            counter.labels().set(value)
+            yield counter
+
+
 _loggers = {}
 
 def getLogger(name):
@@ -2,12 +2,14 @@ from contextlib import asynccontextmanager
 from contextvars import ContextVar
 from functools import wraps
 from inspect import iscoroutinefunction
-from typing import AsyncGenerator
+from time import perf_counter
+from typing import Any, AsyncGenerator
 
 from asyncpg import connect as _connect # type:ignore
 from asyncpg.connection import Connection # type:ignore
 
-from unrest.db import pool
+from unrest import tracing
+from unrest.db import pool, stats
 from unrest.db.sql import Fragment, SqlExpression
 from unrest.contexts import context, config
 
@@ -67,11 +69,11 @@ async def transaction(*args, **kwargs):
 
 async def _fetch(query: str, *args):
     async with pool.acquire() as conn:
-        return await conn.fetch(query, *args)
+        return await conn.fetch(query, *args, timeout=context.remaining())
 
 async def _fetchrow(query: str, *args):
     async with pool.acquire() as conn:
-        return await conn.fetchrow(query, *args)
+        return await conn.fetchrow(query, *args, timeout=context.remaining())
 
 async def _iterate(query: str, *args):
     async with pool.transaction() as conn:
@@ -80,25 +82,71 @@ async def _iterate(query: str, *args):
 
 async def _execute(query: str, *args):
     async with pool.acquire() as conn:
-        return await conn.execute(query, *args)
+        return await conn.execute(query, *args, timeout=context.remaining())
+
+def _span(frag: Fragment):
+    return tracing.span("sql %s" % frag.path, {"db.system": "postgresql", "db.operation": type(frag).__name__, "unrest.fragment": frag.path or ""})
+
+def _rows(result: Any) -> int:
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, str):
+        # Command status, e.g. "UPDATE 3" or "INSERT 0 1"
+        count = result.rsplit(" ", 1)[-1]
+        return int(count) if count.isdigit() else 0
+    return 0 if result is None else 1
+
+async def _run(frag: Fragment, method: str) -> Any:
+    cte = SqlExpression(frag)
+    sql = str(cte)
+    path = frag.path or "<unknown>"
+    with _span(frag) as span:
+        async with pool.acquire() as conn:
+            t_start = perf_counter()
+            try:
+                # NB: asyncpg cancels the statement on the server when this times out (or the task is cancelled)
+                result = await getattr(conn, method)(sql, *cte.args, timeout=context.remaining())
+            except BaseException:
+                stats.get(path).record(perf_counter() - t_start, 0, False)
+                raise
+            elapsed = perf_counter() - t_start
+            rows = _rows(result)
+            stats.get(path).record(elapsed, rows)
+            span.set("db.rows", rows)
+            if elapsed >= stats._slow:
+                await stats.slow(conn, path, sql, cte.args, elapsed, rows, cte.is_mutation)
+            return result
 
 class fetch(Fragment):
     async def __call__(self) -> list[dict]:
-        cte = SqlExpression(self)
-        return await _fetch(str(cte), *cte.args)
+        return await _run(self, "fetch")
 
 
 class fetchrow(Fragment):
     async def __call__(self) -> dict:
-        cte = SqlExpression(self)
-        return await _fetchrow(str(cte), *cte.args)
+        return await _run(self, "fetchrow")
 
 
 class iterate(Fragment):
     async def __call__(self) -> AsyncGenerator[dict, None]: 
-        cte = SqlExpression(self)
-        async for row in _iterate(str(cte), *cte.args):
-            yield row
+        # NB: not made current, the caller's code runs between rows (and may not finish iterating). For the
+        # same reason the time recorded includes the consumer's, so it is never reported as a slow query.
+        span = _span(self)
+        path = self.path or "<unknown>"
+        t_start = perf_counter()
+        rows = 0
+        try:
+            cte = SqlExpression(self)
+            async for row in _iterate(str(cte), *cte.args):
+                rows += 1
+                yield row
+        except BaseException as ex:
+            stats.get(path).record(perf_counter() - t_start, rows, False)
+            span.finish(ex)
+            raise
+        stats.get(path).record(perf_counter() - t_start, rows)
+        span.set("db.rows", rows)
+        span.finish()
 
 class execute(Fragment):
     def __init__(self, *args):
@@ -106,7 +154,6 @@ class execute(Fragment):
         self.is_mutation = True
 
     async def __call__(self) -> str:
-        cte = SqlExpression(self)
-        return await _execute(str(cte), *cte.args)
+        return await _run(self, "execute")
 
 
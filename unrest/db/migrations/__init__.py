@@ -11,6 +11,7 @@ import asyncclick as click
 import asyncpg
 
 from unrest.contexts import config
+from unrest.db import rls
 
 
 def role(role):
@@ -171,6 +172,31 @@ async def reset():
         """
             % {"schema": schema}
         )
+        await control(db, schema)
+
+
+async def control(db: asyncpg.connection.Connection, schema: str):
+    """
+    Create (or upgrade) the framework's own runtime tables
+    """
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS %(schema)s._schedules (
+            name text PRIMARY KEY,
+            last_run TIMESTAMPTZ NOT NULL
+        );
+        GRANT SELECT, INSERT, UPDATE ON %(schema)s._schedules TO readwrite_access;
+        CREATE UNLOGGED TABLE IF NOT EXISTS %(schema)s._ratelimits (
+            key text PRIMARY KEY,
+            tokens float8 NOT NULL,
+            taken boolean NOT NULL,
+            updated TIMESTAMPTZ NOT NULL
+        );
+        GRANT SELECT, INSERT, UPDATE, DELETE ON %(schema)s._ratelimits TO readwrite_access;
+    """
+        % {"schema": schema}
+    )
+    await db.execute(rls.functions(schema))
 
 
 async def migrate(execute: bool = False, dryrun: bool = True):
@@ -214,6 +240,7 @@ async def migrate(execute: bool = False, dryrun: bool = True):
             tx = db.transaction()
             await tx.start()
             try:
+                await control(db, schema)
                 for i, migration in enumerate(applicable_migrations):
                     try:
                         with open(migration["path"]) as f:
@@ -4,12 +4,13 @@ from dataclasses import dataclass
 from asyncpg import create_pool, Pool as BasePool
 from asyncpg.connection import Connection
 
-from unrest import context, config, getLogger
+from unrest import context, config, getLogger, metrics, tracing
+from unrest.db import rls
 
 class PoolState:
-    def __init__(self, conn: Connection, tenant: str, refcnt: int):
+    def __init__(self, conn: Connection, session: tuple[str, str, str], refcnt: int):
         self.conn = conn
-        self.tenant = tenant
+        self.session = session
         self.refcnt = refcnt
 
 # Holds pool connections that may have to be reconfigured for RLS
@@ -17,45 +18,60 @@ tenant_connections = ContextVar[PoolState]("tenant_connections")
 
 log = getLogger(__name__)
 
+# NB: one round-trip, and bound parameters rather than string interpolation
+_SET_SESSION = "SELECT set_config('rls.tenant', $1, false), set_config('rls.user', $2, false), set_config('rls.claims', $3, false)"
+
+def _session() -> tuple[str, str, str]:
+    # NB: we need the USER context to set the correct tenant, user and claims in Postgres for RLS
+    user = context.user
+    return str(context.tenant.identity), str(user.identity) if user.is_authenticated else "", rls.claims(user)
+
 class Pool:
     def __init__(self, **kwargs):
         from unrest.db import _setup_connection
         self.pool: BasePool = None # type:ignore
         self.args = {"init": _setup_connection, "min_size": 3, "command_timeout": 60, **kwargs}
 
+    async def warm(self):
+        # Opens the pool (and its min_size connections) ahead of the first request
+        if self.pool is None:
+            self.pool = await create_pool(**self.args) # type: ignore
+
     @asynccontextmanager
     async def acquire(self):
 
         if self.pool is None: 
-            self.pool = await create_pool(**self.args) # type: ignore
+            await self.warm()
 
-        # NB: we need the USER context to set the correct tenant in Postgres for RLS
-        tenant_id = str(context.tenant.identity)
+        session = _session()
 
         state = tenant_connections.get(None)
-        old_tenant = None if state is None else state.tenant
+        old_session = None if state is None else state.session
         needs_conn = state is None or state.conn is None or state.conn._con is None
-        needs_tenant = state is None or state.tenant != tenant_id
+        needs_session = state is None or state.session != session
         
  
-        if not needs_conn and not needs_tenant:
+        if not needs_conn and not needs_session:
             yield state.conn
             return
 
+        if needs_conn:
+            with tracing.span("pool.acquire"):
+                conn = await self.pool.acquire(timeout=context.remaining())
         state = PoolState(
-            conn=state.conn if not needs_conn else await self.pool.acquire(), 
-            tenant=state.tenant if not needs_tenant else tenant_id,
+            conn=state.conn if not needs_conn else conn, 
+            session=state.session if not needs_session else session,
             refcnt=state.refcnt + 1 if not needs_conn else 0,
         )
         token = tenant_connections.set(state) # type:ignore
         try:
-            if needs_tenant:
-                await state.conn.execute("SET rls.tenant = '%s';" % tenant_id)  
+            if needs_session:
+                await state.conn.execute(_SET_SESSION, *session)
             yield state.conn
         finally:    
             try:
-                if old_tenant is not None and old_tenant != tenant_id:
-                    await state.conn.execute("SET rls.tenant = '%s';" % old_tenant)  
+                if old_session is not None and old_session != session:
+                    await state.conn.execute(_SET_SESSION, *old_session)
                 if state.refcnt == 0:
                     await self.pool.release(state.conn)
             except Exception as e:
@@ -101,6 +117,16 @@ def get_instance():
     
     raise RuntimeError("Invalid operational context for database access: %s" % context._ctx._global)
 
+async def warmup():
+    # Both pools, regardless of the operational context, e.g. in each worker after forking
+    ctx = context._ctx
+    _global = ctx._global
+    try:
+        for ctx._global in (True, False):
+            await get_instance().warm()
+    finally:
+        ctx._global = _global
+
 @asynccontextmanager
 async def acquire():
     async with get_instance().acquire() as conn:
@@ -111,4 +137,15 @@ async def transaction(*args, **kwargs):
     async with get_instance().acquire() as conn:
         async with conn.transaction(*args, **kwargs):
             yield conn
-            
\ No newline at end of file
+
+
+@metrics.collector
+def _collect():
+    size = metrics.Gauge("unrest_db_pool_connections", "Database pool connections, by pool and state", ("pool", "state"))
+    for (name, p) in [("writers", _writers), ("readers", _readers)]:
+        if p is not None and p.pool is not None:
+            idle = p.pool.get_idle_size()
+            size.labels(name, "idle").set(idle)
+            size.labels(name, "busy").set(p.pool.get_size() - idle)
+            size.labels(name, "max").set(p.pool.get_max_size())
+    yield size
@@ -0,0 +1,99 @@
+import json
+from typing import Any
+
+from unrest.contexts import auth
+
+# Pool connections carry the user context as session settings (see pool.Pool.acquire):
+#
+#   rls.tenant  the tenant identity
+#   rls.user    the user identity (empty if unauthenticated)
+#   rls.claims  the user's claims as jsonb, {name: usable in a mutation}
+#
+# The helpers below generate SQL for use in migrations, so row filtering happens inside Postgres.
+
+
+def functions(schema: str = "public") -> str:
+    return """
+        CREATE OR REPLACE FUNCTION %(schema)s.rls_tenant() RETURNS text LANGUAGE sql STABLE AS $$
+            SELECT nullif(current_setting('rls.tenant', true), '')
+        $$;
+        CREATE OR REPLACE FUNCTION %(schema)s.rls_user() RETURNS text LANGUAGE sql STABLE AS $$
+            SELECT nullif(current_setting('rls.user', true), '')
+        $$;
+        CREATE OR REPLACE FUNCTION %(schema)s.rls_claims() RETURNS jsonb LANGUAGE sql STABLE AS $$
+            SELECT coalesce(nullif(current_setting('rls.claims', true), '')::jsonb, '{}'::jsonb)
+        $$;
+        CREATE OR REPLACE FUNCTION %(schema)s.rls_claim(name text, mutation boolean DEFAULT false) RETURNS boolean LANGUAGE sql STABLE AS $$
+            SELECT CASE WHEN mutation THEN coalesce((%(schema)s.rls_claims() ->> name)::boolean, false) ELSE %(schema)s.rls_claims() ? name END
+        $$;
+    """ % {"schema": schema}
+
+
+def claims(user: auth.User) -> str:
+    # Same semantics as auth.Claim: present to query, true to mutate. Cached on the user like auth.claimset()
+    if not user.is_authenticated:
+        return "{}"
+    cached = user.__dict__.get("_rlsclaims")
+    if cached is None or cached[0] is not user.claims:
+        granted: dict[str, bool] = {}
+        for name, value in user.claims.items():
+            try:
+                if value >= False:
+                    granted[name] = bool(value >= True)
+            except TypeError:
+                pass
+        cached = user.__dict__["_rlsclaims"] = (user.claims, json.dumps(granted, sort_keys=True))
+    return cached[1]
+
+
+def _literal(value: str) -> str:
+    return "'%s'" % value.replace("'", "''")
+
+
+def sql(expr: auth.UserPredicateFunction, mutation: bool = False) -> str:
+    # Translates a user predicate into an equivalent SQL boolean expression over the session settings
+    return _sql(expr, mutation, True)
+
+
+def _sql(expr: auth.UserPredicateFunction, mutation: bool, root: bool = False) -> str:
+    # NB: matched like auth._source, so subclasses translate as their base unless they override __call__ below the root
+    if isinstance(expr, auth.UserPredicate) and (root or not auth._overrides(expr)):
+        if isinstance(expr, auth.Claim):
+            return "rls_claim(%s, %s)" % (_literal(expr._name), "true" if mutation else "false")
+        if isinstance(expr, auth.AndExpression):
+            return "(%s AND %s)" % (_sql(expr._left, mutation), _sql(expr._right, mutation))
+        if isinstance(expr, auth.OrExpression):
+            return "(%s OR %s)" % (_sql(expr._left, mutation), _sql(expr._right, mutation))
+        if isinstance(expr, auth.NotExpression):
+            return "(NOT %s)" % _sql(expr._expr, mutation)
+        if isinstance(expr, auth.UnrestrictedHelper):
+            return "true"
+        if isinstance(expr, auth.UserIsAuthenticatedHelper):
+            return "(rls_user() IS NOT NULL)"
+    raise ValueError("Predicate cannot be expressed in SQL: %r" % expr)
+
+
+def _conditions(perms: Any, mutation: bool, tenant: str | None, owner: str | None) -> str:
+    conditions = []
+    if tenant is not None:
+        conditions.append("%s::text = rls_tenant()" % tenant)
+    if owner is not None:
+        conditions.append("%s::text = rls_user()" % owner)
+    if perms is not None:
+        conditions.append(sql(perms, mutation))
+    return " AND ".join(conditions) or "true"
+
+
+def policy(table: str, perms: auth.UserPredicateFunction | None = None, tenant: str | None = None, owner: str | None = None, name: str | None = None) -> str:
+    # Rows are visible if they belong to the current tenant (tenant column) and user (owner column) and the
+    # user satisfies `perms`; writes additionally need the claims to be usable in a mutation.
+    name = name or "%s__unrest" % table.replace(".", "__")
+    read = _conditions(perms, False, tenant, owner)
+    write = _conditions(perms, True, tenant, owner)
+    return """
+        ALTER TABLE %(table)s ENABLE ROW LEVEL SECURITY;
+        DROP POLICY IF EXISTS %(name)s_query ON %(table)s;
+        DROP POLICY IF EXISTS %(name)s_mutate ON %(table)s;
+        CREATE POLICY %(name)s_query ON %(table)s FOR SELECT USING (%(read)s);
+        CREATE POLICY %(name)s_mutate ON %(table)s FOR ALL USING (%(write)s) WITH CHECK (%(write)s);
+    """ % {"table": table, "name": name, "read": read, "write": write}
@@ -0,0 +1,121 @@
+import json
+from collections import deque
+from random import random
+from typing import Any
+
+from unrest import config, getLogger, metrics
+
+log = getLogger(__name__)
+
+# Per-fragment query statistics, keyed by the originating @db.query / @db.mutate path
+
+_slow = float(config.get("UNREST_SLOW_QUERY", "0.5")) # type:ignore
+# EXPLAIN (ANALYZE, BUFFERS) re-runs the query, so it is opt-in and never allowed in production
+_explain = float(config.get("UNREST_EXPLAIN_SAMPLE", "0")) if config.get("ENVIRONMENT", "") not in ("prod", "production") else 0.0 # type:ignore
+
+
+class FragmentStats:
+    __slots__ = ("calls", "errors", "slow", "total", "max", "rows", "_recent")
+
+    def __init__(self, window: int = 1024):
+        self.calls = 0
+        self.errors = 0
+        self.slow = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self._recent: deque[float] = deque(maxlen=window)
+
+    def record(self, elapsed: float, rows: int, ok: bool = True):
+        self.calls += 1
+        self.total += elapsed
+        self.rows += rows
+        if elapsed > self.max:
+            self.max = elapsed
+        if not ok:
+            self.errors += 1
+        self._recent.append(elapsed)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.calls if self.calls else 0.0
+
+    def percentile(self, q: float) -> float:
+        # Over the most recent calls only, so it tracks current behaviour
+        recent = sorted(self._recent)
+        if not recent:
+            return 0.0
+        return recent[min(len(recent) - 1, int(q * len(recent)))]
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "slow": self.slow,
+            "rows": self.rows,
+            "total": self.total,
+            "mean": self.mean,
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+_stats: dict[str, FragmentStats] = {}
+
+
+def get(path: str) -> FragmentStats:
+    stats = _stats.get(path)
+    if stats is None:
+        stats = _stats[path] = FragmentStats()
+    return stats
+
+
+def snapshot() -> dict[str, dict[str, Any]]:
+    return {path: stats.snapshot() for (path, stats) in _stats.items()}
+
+
+def reset():
+    _stats.clear()
+
+
+async def slow(conn: Any, path: str, sql: str, args: list, elapsed: float, rows: int, is_mutation: bool):
+    stats = get(path)
+    stats.slow += 1
+    plan = None
+    if _explain > 0.0 and not is_mutation and random() < _explain:
+        plan = await explain(conn, sql, args)
+    log.warning(
+        "Slow query %s %.3f",
+        path,
+        elapsed,
+        extra={"query": {"path": path, "time": elapsed, "rows": rows, "args": len(args), "sql": sql, "plan": plan}},
+    )
+
+
+async def explain(conn: Any, sql: str, args: list) -> Any:
+    # NB: ANALYZE executes the statement, so always inside a transaction that is rolled back
+    tx = conn.transaction()
+    await tx.start()
+    try:
+        plan = await conn.fetchval("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, *args)
+        return json.loads(plan) if isinstance(plan, str) else plan
+    except Exception as ex:
+        log.warning("Unable to explain slow query: %s", ex)
+        return None
+    finally:
+        await tx.rollback()
+
+
+@metrics.collector
+def _collect():
+    calls = metrics.Counter("unrest_db_queries_total", "Queries executed, by fragment path and outcome", ("fragment", "outcome"))
+    seconds = metrics.Counter("unrest_db_query_seconds_total", "Time spent executing queries, by fragment path", ("fragment",))
+    rows = metrics.Counter("unrest_db_query_rows_total", "Rows returned or affected, by fragment path", ("fragment",))
+    slow = metrics.Counter("unrest_db_slow_queries_total", "Queries slower than UNREST_SLOW_QUERY, by fragment path", ("fragment",))
+    for (path, stats) in list(_stats.items()):
+        calls.labels(path, "ok").set(stats.calls - stats.errors)
+        calls.labels(path, "error").set(stats.errors)
+        seconds.labels(path).set(stats.total)
+        rows.labels(path).set(stats.rows)
+        slow.labels(path).set(stats.slow)
+    return [calls, seconds, rows, slow]
@@ -1,7 +1,7 @@
 
 from starlette.requests import Request
 from starlette.responses import Response 
-from starlette.routing import Route, Router
+from starlette.routing import Match as Match, Route, Router
 
 from starlette.applications import Starlette
 from starlette.exceptions import HTTPException
@@ -9,7 +9,7 @@ from starlette.requests import Request
 from starlette.responses import Response
 from starlette.types import Scope, Receive, Send
 
-from starlette.responses import HTMLResponse, RedirectResponse
+from starlette.responses import HTMLResponse, RedirectResponse, StreamingResponse as StreamingResponse
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 from starlette.datastructures import UploadFile, URL
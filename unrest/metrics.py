@@ -0,0 +1,191 @@
+import logging
+from bisect import bisect_left
+from math import inf
+from typing import Callable, Generic, Iterable, TypeVar
+
+# In-process metrics, rendered in the Prometheus text exposition format.
+#
+# Updates are plain attribute arithmetic on pre-bound children (no locks): request handling happens on the
+# event loop, and the odd lost update from a worker thread is an acceptable price for keeping the hot path cheap.
+
+# NB: not unrest.getLogger, the logging setup itself reports metrics
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Buckets:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+Child = TypeVar("Child", Value, Buckets)
+
+
+class Metric(Generic[Child]):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str = "", labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._children: dict[tuple, Child] = {}
+
+    def _child(self) -> Child:
+        raise NotImplementedError()
+
+    def labels(self, *values) -> Child:
+        # Bind once and keep the child around on hot paths
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError("%s expects labels %s" % (self.name, self.labelnames))
+            child = self._children[key] = self._child()
+        return child
+
+    def samples(self) -> Iterable[tuple[str, tuple, tuple, float]]:
+        for key, child in list(self._children.items()):
+            yield self.name, self.labelnames, key, child.value # type:ignore
+
+    def render(self) -> str:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for name, labelnames, key, value in self.samples():
+            lines.append("%s%s %s" % (name, _labels(labelnames, key), _number(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric[Value]):
+    kind = "counter"
+
+    def _child(self) -> Value:
+        return Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric[Value]):
+    kind = "gauge"
+
+    def _child(self) -> Value:
+        return Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric[Buckets]):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str = "", labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self) -> Buckets:
+        return Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self) -> Iterable[tuple[str, tuple, tuple, float]]:
+        bucketnames = self.labelnames + ("le",)
+        for key, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (inf,), child.counts):
+                cumulative += count
+                yield self.name + "_bucket", bucketnames, key + (_number(bound),), cumulative
+            yield self.name + "_sum", self.labelnames, key, child.sum
+            yield self.name + "_count", self.labelnames, key, child.count
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (n, _escape(v)) for (n, v) in zip(names, values))
+
+
+def _number(value: float) -> str:
+    if value == inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+_registry: dict[str, Metric] = {}
+_collectors: list[Callable[[], Iterable[Metric]]] = []
+
+
+def _register(cls, name: str, *args, **kwargs):
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = cls(name, *args, **kwargs)
+    elif not isinstance(metric, cls):
+        raise ValueError("Metric %s is already registered as a %s" % (name, metric.kind))
+    return metric
+
+
+def counter(name: str, help: str = "", labels: Iterable[str] = ()) -> Counter:
+    return _register(Counter, name, help, labels)
+
+
+def gauge(name: str, help: str = "", labels: Iterable[str] = ()) -> Gauge:
+    return _register(Gauge, name, help, labels)
+
+
+def histogram(name: str, help: str = "", labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, help, labels, buckets)
+
+
+def collector(f: Callable[[], Iterable[Metric]]) -> Callable[[], Iterable[Metric]]:
+    # Collectors are called at scrape time and return freshly built metrics, e.g. for pool or queue state
+    _collectors.append(f)
+    return f
+
+
+def render() -> str:
+    metrics = list(_registry.values())
+    for f in _collectors:
+        try:
+            metrics.extend(f())
+        except Exception as ex:
+            # NB: one broken collector shouldn't take the others (or the registered metrics) down with it
+            log.exception("Metrics collector %s failed: %s", getattr(f, "__qualname__", f), ex)
+    return "\n".join(m.render() for m in metrics) + "\n"
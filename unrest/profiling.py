@@ -0,0 +1,166 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from random import random
+from typing import Any
+
+from unrest.contexts import config
+
+# Opt-in wall-clock stack sampling of individual requests, aggregated per route.
+#
+# A request is profiled when it carries `X-Unrest-Profile: <UNREST_PROFILE_TOKEN>` or is picked at
+# UNREST_PROFILE_SAMPLE. A background thread then samples that request's task every UNREST_PROFILE_INTERVAL
+# seconds: the running stack when the task is on the CPU, otherwise the chain of awaits it is suspended in.
+# Stacks are kept in folded format ("a;b;c count"), ready for flamegraph tools.
+
+HEADER = "x-unrest-profile"
+
+_sample = float(config.get("UNREST_PROFILE_SAMPLE", "0")) # type:ignore
+_token = config.get("UNREST_PROFILE_TOKEN")
+_interval = float(config.get("UNREST_PROFILE_INTERVAL", "0.005")) # type:ignore
+_maxstacks = 5000
+
+# Checked by Endpoint before anything else, so profiling costs one attribute lookup when off
+enabled = _sample > 0.0 or _token is not None
+
+
+class Profile:
+    def __init__(self, route: str):
+        self.route = route
+        self.requests = 0
+        self.samples = 0
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+
+    def add(self, stack: tuple[str, ...]):
+        self.samples += 1
+        if len(self.stacks) >= _maxstacks and stack not in self.stacks:
+            stack = ("(truncated)",)
+        self.stacks[stack] += 1
+
+    def folded(self) -> str:
+        return "".join("%s %d\n" % (";".join(stack), n) for (stack, n) in self.stacks.most_common())
+
+    def summary(self, top: int = 10) -> dict[str, Any]:
+        leaves: Counter[str] = Counter()
+        for stack, n in self.stacks.items():
+            leaves[stack[-1]] += n
+        return {
+            "requests": self.requests,
+            "samples": self.samples,
+            "seconds": self.samples * _interval,
+            "hotspots": [{"frame": frame, "samples": n} for (frame, n) in leaves.most_common(top)],
+        }
+
+
+def _label(frame: Any) -> str:
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_qualname, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _stack(task: asyncio.Task, loop: asyncio.AbstractEventLoop, frame: Any, root: Any) -> tuple[str, ...] | None:
+    # Stacks start at the profiled endpoint's frame, not at the server plumbing above it
+    if frame is not None and asyncio.current_task(loop) is task:
+        # On the CPU: walk the thread's stack back up to the endpoint
+        stack = []
+        while frame is not None:
+            stack.append(_label(frame))
+            if frame is root:
+                return tuple(reversed(stack))
+            frame = frame.f_back
+        return None
+
+    # Suspended: follow the chain of awaits from the endpoint down to whatever it is waiting on
+    stack = []
+    coro: Any = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        if stack or frame is root:
+            stack.append(_label(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    if not stack:
+        return None
+    stack.append("(waiting)")
+    return tuple(stack)
+
+
+class Sampler:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.active: dict[asyncio.Task, tuple[Profile, asyncio.AbstractEventLoop, int, Any]] = {}
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def add(self, task: asyncio.Task, profile: Profile, root: Any):
+        self.active[task] = (profile, task.get_loop(), threading.get_ident(), root)
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="unrest-profiler", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def remove(self, task: asyncio.Task):
+        self.active.pop(task, None)
+
+    def _run(self):
+        while True:
+            if not self.active:
+                self._wake.clear()
+                self._wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for task, (profile, loop, ident, root) in list(self.active.items()):
+                try:
+                    stack = _stack(task, loop, frames.get(ident), root)
+                except Exception:
+                    stack = None
+                if stack:
+                    profile.add(stack)
+
+
+_sampler = Sampler(_interval)
+_profiles: dict[str, Profile] = {}
+
+
+def configure(sample: float | None = None, token: str | None = None):
+    global _sample, _token, enabled
+    if sample is not None:
+        _sample = sample
+    if token is not None:
+        _token = token
+    enabled = _sample > 0.0 or _token is not None
+
+
+def begin(route: str, request: Any) -> asyncio.Task | None:
+    if not ((_token is not None and request.headers.get(HEADER) == _token) or (_sample > 0.0 and random() < _sample)):
+        return None
+    task = asyncio.current_task()
+    if task is None:
+        return None
+    profile = _profiles.get(route)
+    if profile is None:
+        profile = _profiles[route] = Profile(route)
+    profile.requests += 1
+    # NB: the caller's frame, i.e. Endpoint.__call__
+    _sampler.add(task, profile, sys._getframe(1))
+    return task
+
+
+def end(task: asyncio.Task):
+    _sampler.remove(task)
+
+
+def summary() -> dict[str, dict[str, Any]]:
+    return {route: profile.summary() for (route, profile) in _profiles.items()}
+
+
+def folded(route: str) -> str:
+    profile = _profiles.get(route)
+    return "" if profile is None else profile.folded()
+
+
+def reset():
+    _profiles.clear()
@@ -0,0 +1,240 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from typing import Literal
+
+from unrest import config, getLogger, http, metrics
+from unrest.contexts.auth import Tenant, User
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None # type:ignore
+
+log = getLogger(__name__)
+
+# Per-tenant and per-user rate limits: token buckets of `burst` tokens refilled at `rate` per second, checked right
+# after authentication so that a throttled request never reaches the database pool.
+#
+# Buckets are always kept in-process. With a shared backend (UNREST_RATE_LIMIT_BACKEND=redis|postgres) a request
+# the local bucket allows is also taken from the shared one, so the limit holds across workers. Since a process never
+# sees more than all of the traffic, a request the local bucket refuses is refused without asking the backend. The
+# backend gets UNREST_RATE_LIMIT_TIMEOUT seconds (connecting included), after which the request is let through.
+
+
+_limits: list["RateLimit"] = []
+
+
+class Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        # Seconds until a token is available, 0 when one was taken
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class RedisBackend:
+    # NB: one round-trip, the refill and take are atomic in the script
+    _script = """
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local t = redis.call('TIME')
+        local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+        local b = redis.call('HMGET', KEYS[1], 't', 'u')
+        local tokens = math.min(burst, (tonumber(b[1]) or burst) + math.max(0, now - (tonumber(b[2]) or now)) * rate)
+        local taken = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            taken = 1
+        end
+        redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return {taken, tostring(tokens)}
+    """
+    _refund = """
+        local tokens = tonumber(redis.call('HGET', KEYS[1], 't'))
+        if tokens then
+            redis.call('HSET', KEYS[1], 't', tostring(math.min(tonumber(ARGV[1]), tokens + 1)))
+        end
+    """
+
+    def __init__(self, uri: str | None = None):
+        if redis is None:
+            raise RuntimeError("The redis backend for rate limits needs the redis package")
+        self.client = redis.from_url(uri or config.get("REDIS_URI") or "redis://localhost:6379")
+        self.script = self.client.register_script(self._script)
+        self.refund_script = self.client.register_script(self._refund)
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        taken, tokens = await self.script(keys=["unrest:ratelimit:" + key], args=[rate, burst])
+        return 0.0 if taken else (1 - float(tokens)) / rate
+
+    async def refund(self, key: str, burst: float):
+        await self.refund_script(keys=["unrest:ratelimit:" + key], args=[burst])
+
+
+class PostgresBackend:
+    # The unlogged _ratelimits table (created with the framework's other runtime tables, see migrations.control), on
+    # its own small pool rather than the request pool
+    _refill = "least($3, b.tokens + extract(epoch FROM clock_timestamp() - b.updated) * $2)"
+    _take = """
+        INSERT INTO _ratelimits AS b (key, tokens, taken, updated) VALUES ($1, $3 - 1, true, clock_timestamp())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = %(refill)s - CASE WHEN %(refill)s >= 1 THEN 1 ELSE 0 END,
+            taken = %(refill)s >= 1,
+            updated = clock_timestamp()
+        RETURNING taken, tokens
+    """ % {"refill": _refill}
+    _refund = "UPDATE _ratelimits SET tokens = least($2, tokens + 1) WHERE key = $1"
+
+    def __init__(self, dsn: str | None = None, size: int | None = None):
+        self.dsn = dsn or config.get("UNREST_RATE_LIMIT_URI") or config.get("POSTGRES_MUTATE_URI")
+        self.size = size or int(config.get("UNREST_RATE_LIMIT_POOL", "10")) # type:ignore
+        self.pool = None
+        self._connecting = asyncio.Lock()
+
+    async def connect(self):
+        # NB: once, however many requests arrive before the pool is up
+        async with self._connecting:
+            if self.pool is None:
+                from asyncpg import create_pool
+                self.pool = await create_pool(dsn=self.dsn, min_size=1, max_size=self.size)
+        return self.pool
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        pool = self.pool or await self.connect()
+        taken, tokens = await pool.fetchrow(self._take, key, float(rate), float(burst))
+        return 0.0 if taken else (1 - tokens) / rate
+
+    async def refund(self, key: str, burst: float):
+        pool = self.pool or await self.connect()
+        await pool.execute(self._refund, key, float(burst))
+
+
+_backend: RedisBackend | PostgresBackend | None = None
+_timeout = float(config.get("UNREST_RATE_LIMIT_TIMEOUT", "0.05")) # type:ignore
+
+
+def backend() -> RedisBackend | PostgresBackend | None:
+    global _backend
+    if _backend is None:
+        kind = (config.get("UNREST_RATE_LIMIT_BACKEND", "memory") or "memory").lower()
+        if kind == "redis":
+            _backend = RedisBackend()
+        elif kind == "postgres":
+            _backend = PostgresBackend()
+        elif kind != "memory":
+            raise RuntimeError("Unknown rate limit backend: %s" % kind)
+    return _backend
+
+
+class RateLimit:
+    def __init__(self, rate: float, burst: float | None = None, per: Literal["tenant", "user"] = "tenant", shared: bool = True, maxsize: int = 100000, name: str = ""):
+        if per not in ("tenant", "user"):
+            raise ValueError("Rate limits are per tenant or per user")
+        self.name = name
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.per = per
+        self.shared = shared
+        self.maxsize = maxsize
+        self.allowed = 0
+        self.throttled = 0
+        self._buckets: OrderedDict[str, Bucket] = OrderedDict()
+        _limits.append(self)
+
+    def key(self, request: http.Request, user: User, tenant: Tenant | None) -> str:
+        if self.per == "tenant":
+            return "t:" + str(getattr(tenant, "identity", ""))
+        if user.is_authenticated:
+            return "u:" + str(user.identity)
+        # NB: anonymous requests are limited by client address
+        return "a:" + (request.client.host if request.client else "")
+
+    async def take(self, request: http.Request, user: User, tenant: Tenant | None) -> float:
+        # Seconds the client should wait before retrying, 0 when the request may proceed
+        key = self.key(request, user, tenant)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket(self.burst, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        wait = bucket.take(self.rate, self.burst, now)
+        shared = backend() if self.shared and not wait else None
+        if shared is not None:
+            try:
+                async with asyncio.timeout(_timeout):
+                    wait = await shared.take("%s:%s" % (self.name, key), self.rate, self.burst)
+            except Exception as ex:
+                # NB: fail open (slow counts as unavailable), the local bucket still limits each process
+                log.warning("Rate limit backend unavailable: %r", ex)
+        if wait:
+            self.throttled += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    async def refund(self, request: http.Request, user: User, tenant: Tenant | None):
+        # Gives back the token taken for a request that another limit then refused
+        key = self.key(request, user, tenant)
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.tokens = min(self.burst, bucket.tokens + 1)
+        self.allowed -= 1
+        shared = backend() if self.shared else None
+        if shared is not None:
+            try:
+                async with asyncio.timeout(_timeout):
+                    await shared.refund("%s:%s" % (self.name, key), self.burst)
+            except Exception as ex:
+                log.warning("Rate limit backend unavailable: %r", ex)
+
+    def retry_after(self, wait: float) -> int:
+        return max(1, math.ceil(wait))
+
+
+async def take(limits: list[RateLimit], request: http.Request, user: User, tenant: Tenant | None) -> tuple[RateLimit, float] | None:
+    # The limit that refuses the request and the seconds to wait, or None when all of them allow it. Tokens already
+    # taken from the other limits are refunded, so a refused request costs nothing.
+    taken: list[RateLimit] = []
+    for limit in limits:
+        wait = await limit.take(request, user, tenant)
+        if wait:
+            for other in taken:
+                await other.refund(request, user, tenant)
+            return limit, wait
+        taken.append(limit)
+    return None
+
+
+def from_config(name: str) -> list[RateLimit]:
+    # Default limits for a Service, off unless UNREST_TENANT_RATE or UNREST_USER_RATE (requests per second) is set
+    limits = []
+    for per in ("tenant", "user"):
+        rate = float(config.get("UNREST_%s_RATE" % per.upper(), "0")) # type:ignore
+        if rate > 0:
+            burst = config.get("UNREST_%s_BURST" % per.upper())
+            limits.append(RateLimit(rate, float(burst) if burst else None, per=per, name="%s.%s" % (name, per))) # type:ignore
+    return limits
+
+
+@metrics.collector
+def _collect():
+    allowed = metrics.Counter("unrest_ratelimit_allowed_total", "Requests within their rate limit, by limit", ("limit",))
+    throttled = metrics.Counter("unrest_ratelimit_throttled_total", "Requests rejected with 429, by limit", ("limit",))
+    for limit in _limits:
+        allowed.labels(limit.name).set(limit.allowed)
+        throttled.labels(limit.name).set(limit.throttled)
+    return [allowed, throttled]
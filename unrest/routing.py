@@ -1,5 +1,15 @@
 
+import asyncio
+from asyncio import get_running_loop
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import wraps
+from importlib import import_module
 import inspect
+import logging
+import multiprocessing
+import os
+from random import random
 import time
 from typing import Any, Awaitable, Callable, Self, Tuple, get_args, get_origin
 
@@ -8,26 +18,36 @@ from asyncpg import InsufficientPrivilegeError # type:ignore
 from unrest.contexts.auth import AuthFunction, AuthResponse, Tenant, User, UnauthenticatedUser
 from unrest.contexts import getLogger, query as _query, mutate as _mutate
 from unrest.contexts import Unauthorized, usercontext, requestcontext 
-from unrest.contexts import getLogger, auth
+from unrest.contexts import getLogger, auth, config
+from unrest.contexts._context import Context, restorecontext
 
 from unrest import Payload, ContextError, ClientError, ServerError, Unauthorized
-from unrest import http, context
+from unrest import admission, http, context, metrics, profiling, ratelimit, tracing
 
 from mangum import Mangum
 
-
-# from unrest.tasks import TaskNotReady, TaskTimeout
+from unrest import tasks
+from unrest.tasks import TaskNotFound, TaskNotReady, TaskTimeout
 
 
 
 log = getLogger(__name__)
 
 
+class Disconnected(Exception):
+    pass
+
+
 class Service(http.Router):
     def __init__(self, name: str | None = None, parent: Self | None = None):
         super().__init__()
         self.name = name
         self._authfunction: AuthFunction = None # type:ignore
+        # Route name -> Endpoint, e.g. for dispatching batched operations
+        self.endpoints: dict[str, Endpoint] = {}
+        # Shared by all of the service's endpoints that don't have their own
+        self.limiter: admission.Limiter | None = admission.from_config(name or "default")
+        self.ratelimits: list[ratelimit.RateLimit] = ratelimit.from_config(name or "default")
         if parent is not None:
             parent.mount("/%s" % name, self, name=self.name)
 
@@ -41,11 +61,20 @@ class Service(http.Router):
 
 
 class Endpoint:
-    def __init__(self, func: Callable, service: Service):
+    def __init__(self, func: Callable, service: Service, sample: float | None = None):
         self.function = func
         self.returns = None
         self.payload = None
         self.service = service
+        self.sample = _sample if sample is None else sample
+        self.slow = _slow
+        self.name = func.__module__ + "." + func.__name__
+        self.limiter: admission.Limiter | None = None
+        self.ratelimits: list[ratelimit.RateLimit] | None = None
+        self.timeout: float | None = _timeout
+        self._inflight = _inflight.labels(self.name)
+        self._latency = _latency.labels(self.name)
+        self._requests: dict[tuple[str, int], metrics.Value] = {}
         self.args: dict[str, Any] | None = {}
         self.kwargs: dict[str, Any] | None = {}
         
@@ -91,98 +120,309 @@ class Endpoint:
     async def encode(self, req: http.Request, resp: Any | None) -> http.Response:
         raise NotImplementedError("Response encoding not implemented")
 
+    async def handle(self, request: http.Request) -> http.Response:
+        # Runs in the request's user context; subclasses wrap this to serve responses without the handler
+        with tracing.span("decode"):
+            (args, kwargs) = await self.decode(request)
+        with tracing.span("handler"):
+            response = await self.function(*args, **kwargs)
+        with tracing.span("encode"):
+            return await self.encode(request, response)
+
+    def deadline(self, request: http.Request) -> float | None:
+        # The route's timeout, or the client's own (X-Request-Timeout, in seconds) when that is sooner
+        timeout = self.timeout
+        header = request.headers.get(_header)
+        if header:
+            try:
+                requested = float(header)
+            except ValueError:
+                requested = 0.0
+            if requested > 0 and (timeout is None or requested < timeout):
+                timeout = requested
+        return None if timeout is None else time.monotonic() + timeout
+
+    async def bounded(self, request: http.Request) -> http.Response:
+        # Cancels the handler (and so any statement it is waiting on) at the deadline, or when the client goes away
+        remaining = context.remaining()
+        if remaining is None and not _watch:
+            return await self.handle(request)
+        loop = get_running_loop()
+        receive = request._receive
+        messages: asyncio.Queue = asyncio.Queue()
+        disconnected = False
+        try:
+            async with asyncio.timeout(remaining) as scope:
+                async def watch():
+                    nonlocal disconnected
+                    while True:
+                        message = await receive()
+                        messages.put_nowait(message)
+                        if message["type"] == "http.disconnect":
+                            disconnected = True
+                            scope.reschedule(loop.time())
+                            return
+
+                # NB: the handler reads the body through the watcher, so they don't compete for messages
+                watcher = loop.create_task(watch())
+                request._receive = messages.get
+                try:
+                    return await self.handle(request)
+                finally:
+                    watcher.cancel()
+                    request._receive = receive
+        except TimeoutError:
+            if disconnected:
+                raise Disconnected("Client disconnected") from None
+            raise
+
     async def __call__(self, request: http.Request) -> http.Response:
             t_start = time.perf_counter()
+            deadline = self.deadline(request)
+            limiter = self.limiter or self.service.limiter
+            if limiter is not None:
+                # NB: before authenticating, which may well need the database
+                if not await limiter.acquire(request.method in _mutations):
+                    return self.rejected(request, limiter, t_start)
+                t_admitted = time.perf_counter()
+            self._inflight.value += 1
+            profiled = profiling.begin(self.name, request) if profiling.enabled else None
             try:
-                user, tenant = await self.service.authenticate(request)
-                with usercontext(user, tenant=tenant):  
-                    with requestcontext(request):
-                        try:
-                            (args, kwargs) = await self.decode(request)
-                            response = await self.function(*args, **kwargs)
-                            response = await self.encode(request, response)
-                            payload = {"method": request.method, "path": request.url.path, "status": response.status_code, "time": time.perf_counter() - t_start}
-                            log.info("%(method)s %(path)s %(status)d %(time).3f" % payload, extra={"request": payload})
-                            return response
-                        except ClientError as ex:
-                            log.error(ex)
-                            payload = {"method": request.method, "path": request.url.path, "status": 400, "time": time.perf_counter() - t_start}
-                            log.error("%(method)s %(path)s %(status)d %(time).3f" % payload, extra={"request": payload})
-                            return http.Response(status_code=400)
-                        except http.AuthenticationError:
-                            payload = {"method": request.method, "path": request.url.path, "status": 401, "time": time.perf_counter() - t_start}
-                            log.error("%(method)s %(path)s %(status)d %(time).3f" % payload, extra={"request": payload})
-                            return http.Response(status_code=401)
-                        except Unauthorized as ex:
-                            log.error(ex)
-                            payload = {"method": request.method, "path": request.url.path, "status": 401, "time": time.perf_counter() - t_start}
-                            log.error("%(method)s %(path)s %(status)d %(time).3f" % payload, extra={"request": payload})
-                            return http.Response(status_code=401)
-                        except InsufficientPrivilegeError as ex:
-                            log.warning(ex)
-                            payload = {"method": request.method, "path": request.url.path, "status": 403, "time": time.perf_counter() - t_start}
-                            log.warning("%(method)s %(path)s %(status)d %(time).3f" % payload, extra={"request": payload})
-                            return http.Response(status_code=403)
-                        except ContextError as ex:
-                            log.error(ex)
-                            payload = {"method": request.method, "path": request.url.path, "status": 403, "time": time.perf_counter() - t_start}
-                            log.error("%(method)s %(path)s %(status)d %(time).3f" % payload, extra={"request": payload})
-                            return http.Response(status_code=403)            
-                        except ServerError as ex:
-                            log.error(ex)
-                            payload = {"method": request.method, "path": request.url.path, "status": 500, "time": time.perf_counter() - t_start}
-                            log.error("%(method)s %(path)s %(status)d %(time).3f" % payload, extra={"request": payload})
-                            return http.Response(status_code=500)
-                        # except TaskTimeout:
-                        #     raise HTTPException(status_code=504)
-                        # except TaskNotReady:
-                        #     raise HTTPException(status_code=202)
-                        except Exception as ex:
-                            log.exception(ex)
-                            payload = {"method": request.method, "path": request.url.path, "status": 500, "time": time.perf_counter() - t_start}
-                            log.error("%(method)s %(path)s %(status)d %(time).3f" % payload, extra={"request": payload})
-                            return http.Response(status_code=500)
-            # TODO: now we have nested I think only authentication errors can happen here?
-            except ClientError as ex:
-                log.error(ex)
-                log.error("%s %s %d %.3f", request.method, request.url.path, 400, time.perf_counter() - t_start)
-                return http.Response(status_code=400)
-            except http.AuthenticationError:
-                log.error("%s %s %d %.3f", request.method, request.url.path, 401, time.perf_counter() - t_start)
-                return http.Response(status_code=401)
-            except Unauthorized as ex:
-                log.error(ex)
-                log.error("%s %s %d %.3f", request.method, request.url.path, 401, time.perf_counter() - t_start)
-                return http.Response(status_code=401)
-            except InsufficientPrivilegeError as ex:
-                log.warning(ex)
-                log.warning("%s %s %d %.3f", request.method, request.url.path, 403, time.perf_counter() - t_start)
-                return http.Response(status_code=403)
-            except ContextError as ex:
-                log.error(ex)
-                log.error("%s %s %d %.3f", request.method, request.url.path, 403, time.perf_counter() - t_start)
-                return http.Response(status_code=403)            
-            except ServerError as ex:
-                log.error(ex)
-                log.error("%s %s %d %.3f", request.method, request.url.path, 500, time.perf_counter() - t_start)
-                return http.Response(status_code=500)
-            # except TaskTimeout:
-            #     raise HTTPException(status_code=504)
-            # except TaskNotReady:
-            #     raise HTTPException(status_code=202)
-            except Exception as ex:
-                log.exception(ex)
-                log.error("%s %s %d %.3f", request.method, request.url.path, 500, time.perf_counter() - t_start)
-                return http.Response(status_code=500)       
-
-
+                with tracing.incoming(self.name, request):
+                    try:
+                        with tracing.span("authenticate"):
+                            user, tenant = await self.service.authenticate(request)
+                        limits = self.service.ratelimits if self.ratelimits is None else self.ratelimits
+                        if limits and (refused := await ratelimit.take(limits, request, user, tenant)) is not None:
+                            return self.throttled(request, *refused, t_start)
+                        with usercontext(user, tenant=tenant):  
+                            with requestcontext(request, deadline):
+                                try:
+                                    response = await self.bounded(request)
+                                except Exception as ex:
+                                    return self.failed(request, ex, t_start)
+                                self.access(request, response.status_code, t_start)
+                                return response
+                    # TODO: now we have nested I think only authentication errors can happen here?
+                    except Exception as ex:
+                        return self.failed(request, ex, t_start)
+            finally:
+                self._inflight.value -= 1
+                if profiled is not None:
+                    profiling.end(profiled)
+                if limiter is not None:
+                    limiter.release(time.perf_counter() - t_admitted)
+
+    def rejected(self, request: http.Request, limiter: admission.Limiter, t_start: float) -> http.Response:
+        self.access(request, 503, t_start, logging.WARNING)
+        return http.Response(status_code=503, headers={"Retry-After": str(limiter.retry_after())})
+
+    def throttled(self, request: http.Request, limit: ratelimit.RateLimit, wait: float, t_start: float) -> http.Response:
+        self.access(request, 429, t_start, logging.WARNING)
+        return http.Response(status_code=429, headers={"Retry-After": str(limit.retry_after(wait))})
+
+    def failed(self, request: http.Request, ex: Exception, t_start: float) -> http.Response:
+        for (kind, status, level, detail) in _failures:
+            if isinstance(ex, kind):
+                if detail:
+                    log.log(level, ex)
+                break
+        else:
+            log.exception(ex)
+            status, level = 500, logging.ERROR
+        self.access(request, status, t_start, level)
+        return http.Response(status_code=status)
+
+    def access(self, request: http.Request, status: int, t_start: float, level: int = logging.INFO) -> None:
+        elapsed = time.perf_counter() - t_start
+        self._latency.observe(elapsed)
+        counter = self._requests.get((request.method, status))
+        if counter is None:
+            counter = self._requests[(request.method, status)] = _requests.labels(self.name, request.method, status)
+        counter.value += 1
+        span = tracing.current()
+        if span is not None:
+            span.set("http.response.status_code", status)
+            if status >= 500:
+                span.status = 2
+
+        if level == logging.INFO:
+            if elapsed >= self.slow:
+                level = logging.WARNING
+            elif status < 400 and self.sample < 1.0 and (self.sample <= 0.0 or random() >= self.sample):
+                return
+        # NB: skip building the record entirely when nothing would be emitted
+        if not log.isEnabledFor(level):
+            return
+        payload = {"method": request.method, "path": request.url.path, "status": status, "time": elapsed}
+        log.log(level, "%(method)s %(path)s %(status)d %(time).3f", payload, extra={"request": payload})
+
+
+# Exception -> (status, log level, whether to log the exception itself); first match wins
+_mutations = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+
+_failures: list[tuple[type[Exception], int, int, bool]] = [
+    (ClientError, 400, logging.ERROR, True),
+    (Disconnected, 499, logging.INFO, False),
+    (http.AuthenticationError, 401, logging.ERROR, False),
+    (Unauthorized, 401, logging.ERROR, True),
+    (InsufficientPrivilegeError, 403, logging.WARNING, True),
+    (ContextError, 403, logging.ERROR, True),
+    (ServerError, 500, logging.ERROR, True),
+    (TaskTimeout, 504, logging.ERROR, True),
+    (TaskNotReady, 202, logging.INFO, False),
+    (TaskNotFound, 404, logging.INFO, False),
+    (TimeoutError, 504, logging.WARNING, True),
+]
+
+# Fraction of successful requests to log (per route override with sample=), slow requests (seconds) are always logged
+_sample = float(config.get("UNREST_ACCESS_LOG_SAMPLE", "1.0")) # type:ignore
+_slow = float(config.get("UNREST_ACCESS_LOG_SLOW", "1.0")) # type:ignore
+
+# Default request timeout in seconds (per route override with timeout=, 0 for none); clients may ask for less
+_timeout = float(config.get("UNREST_REQUEST_TIMEOUT", "0")) or None # type:ignore
+_header = "x-request-timeout"
+# Watch for clients disconnecting even without a deadline
+_watch = config.get("UNREST_WATCH_DISCONNECT", "false").lower() in ("1", "true", "yes") # type:ignore
+
+_requests = metrics.counter("unrest_requests_total", "Requests handled, by route, method and status", ("route", "method", "status"))
+_latency = metrics.histogram("unrest_request_duration_seconds", "Request latency, by route", ("route",))
+_inflight = metrics.gauge("unrest_requests_inflight", "Requests currently being handled, by route", ("route",))
+
+
+def _run(ctx: Context, f: Callable, args: tuple, kwargs: dict) -> Any:
+    with restorecontext(ctx):
+        return f(*args, **kwargs)
+
+
+def _run_by_name(ctx: Context, module: str, name: str, args: tuple, kwargs: dict) -> Any:
+    # Decorated functions can't be pickled (the module attribute is the wrapper), so resolve them in the worker
+    f: Any = import_module(module)
+    for attr in name.split("."):
+        f = getattr(f, attr)
+    return _run(ctx, getattr(f, "__wrapped__", f), args, kwargs)
+
+
+class WorkerPool:
+    def __init__(self, kind: str):
+        if kind not in ("thread", "process"):
+            raise RuntimeError("Invalid pool type: %s" % kind)
+        self.kind = kind
+        self.size = int(config.get("UNREST_%s_WORKERS" % kind.upper(), str(os.cpu_count() or 1))) # type:ignore
+        self.executor: Executor | None = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.inflight = 0
+        self.peak = 0
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.inflight - self.size)
+
+    def _get_executor(self) -> Executor:
+        if self.executor is None:
+            if self.kind == "thread":
+                self.executor = ThreadPoolExecutor(self.size, thread_name_prefix="unrest")
+            else:
+                # Forking a process that is running an event loop (and threads) is not safe
+                self.executor = ProcessPoolExecutor(self.size, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    async def run(self, f: Callable, *args, **kwargs) -> Any:
+        executor = self._get_executor()
+        ctx = context._ctx.copy()
+        self.submitted += 1
+        self.inflight += 1
+        self.peak = max(self.peak, self.inflight)
+        try:
+            if self.kind == "process":
+                result = await get_running_loop().run_in_executor(executor, _run_by_name, ctx, f.__module__, f.__qualname__, args, kwargs)
+            else:
+                result = await get_running_loop().run_in_executor(executor, _run, ctx, f, args, kwargs)
+        except BaseException:
+            # NB: raised by the function, or cancelled while waiting for it
+            self.failed += 1
+            raise
+        finally:
+            self.inflight -= 1
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict[str, int]:
+        return {"workers": self.size, "submitted": self.submitted, "completed": self.completed, "failed": self.failed, "inflight": self.inflight, "queued": self.queued, "peak": self.peak}
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+_pools: dict[str, WorkerPool] = {}
+def get_pool(kind: str = "thread") -> WorkerPool:
+    if kind not in _pools:
+        _pools[kind] = WorkerPool(kind)
+    return _pools[kind]
+
+
+@metrics.collector
+def _collect_pools():
+    for (name, help) in [("workers", "Worker pool size"), ("inflight", "Offloaded calls in progress"), ("queued", "Offloaded calls waiting for a worker")]:
+        gauge = metrics.Gauge("unrest_offload_%s" % name, help, ("pool",))
+        for kind, pool in _pools.items():
+            gauge.labels(kind).set(pool.stats()[name])
+        yield gauge
+    completed = metrics.Counter("unrest_offload_completed_total", "Offloaded calls completed successfully", ("pool",))
+    failed = metrics.Counter("unrest_offload_failed_total", "Offloaded calls that raised or were cancelled", ("pool",))
+    for kind, pool in _pools.items():
+        completed.labels(kind).set(pool.completed)
+        failed.labels(kind).set(pool.failed)
+    yield completed
+    yield failed
+
+
+def offload(pool: str = "thread") -> Callable:
+    # Runs a blocking (CPU-bound or legacy I/O) function in a worker pool under a copy of the caller's context
+    def decorator(f: Callable) -> Callable:
+        if inspect.iscoroutinefunction(f):
+            raise RuntimeError("Offloaded functions must not be async: %s" % f.__name__)
+
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            return await get_pool(pool).run(f, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@asynccontextmanager
+async def lifespan(app: http.Starlette):
+    await tasks.startup()
+    try:
+        yield
+    finally:
+        await tasks.shutdown()
+        for p in _pools.values():
+            p.shutdown()
+
+
+# Anything not starting with "/" (e.g. "off") disables the endpoint
+_metrics_path = config.get("UNREST_METRICS_PATH", "/metrics")
 
 class Server(http.Starlette):
     def __init__(self) -> None:
-        super().__init__()
+        super().__init__(lifespan=lifespan)
 
     async def __call__(self, scope: http.Scope, receive: http.Receive, send: http.Send) -> None:        
 
+        if scope["type"] == "lifespan":
+            await super().__call__(scope, receive, send)
+            return
+
+        # NB: scraped by infrastructure, so no authentication, context or content negotiation
+        if scope["type"] == "http" and scope["path"] == _metrics_path:
+            await http.Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")(scope, receive, send)
+            return
+
         from unrest.api import get_instance as get_api
         from unrest.app import get_instance as get_app
 
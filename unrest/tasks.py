@@ -1,20 +1,26 @@
-from asyncio import create_task, sleep
+from asyncio import CancelledError, Task, create_task, gather, get_running_loop, sleep
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 from inspect import iscoroutinefunction
+from time import perf_counter
 from typing import Any, Awaitable, Callable
-import sys
+import random
 
-from taskiq import AsyncTaskiqDecoratedTask, InMemoryBroker, TaskiqScheduler
+import pycron
+from taskiq import AsyncTaskiqDecoratedTask, AsyncTaskiqTask, InMemoryBroker, TaskiqScheduler
+from taskiq.depends.progress_tracker import TaskProgress
 from taskiq.exceptions import ResultGetError, TaskiqResultTimeoutError
 from taskiq.schedule_sources import LabelScheduleSource
 from taskiq_redis import ListQueueBroker, RedisAsyncResultBackend
+from redis.asyncio import Redis
 
 
+from unrest import metrics, tracing
 from unrest.contexts import context, config, getLogger
-from unrest.contexts._context import Context, operationalcontext, restorecontext, systemcontext
-from unrest.contexts.auth import AuthResponse, AuthenticatedUser, System, Tenant, TokenAuthFunction, UnauthenticatedUser, Unrestricted, UserPredicateFunction
+from unrest.contexts._context import Context, Unauthorized, operationalcontext, requestcontext, restorecontext, systemcontext
+from unrest.contexts.auth import AuthResponse, AuthenticatedUser, Tenant, UnauthenticatedUser, Unrestricted, UserPredicateFunction
 
 log = getLogger(__name__)
 
@@ -26,10 +32,14 @@ class TaskTimeout(TaskiqResultTimeoutError):
 class TaskNotReady(ResultGetError):
     pass
 
+
+class TaskNotFound(ResultGetError):
+    __template__ = "No such task, or its result has expired"
+
 _started = False
 _tasked: list[AsyncTaskiqDecoratedTask] = []
-_scheduled: list[AsyncTaskiqDecoratedTask] = []
-_pending: list[Callable] = []
+_scheduled: list["Schedule"] = []
+_periodic: list["Periodic"] = []
 
 
 if config.is_under_test():
@@ -46,7 +56,7 @@ else:
         raise RuntimeError("REDIS_URI must be set")
 
 
-async def kiq(task: AsyncTaskiqDecoratedTask, *args, **kwargs):
+async def _startup_broker():
     global _started
     if not _started:
         _started = True
@@ -55,21 +65,59 @@ async def kiq(task: AsyncTaskiqDecoratedTask, *args, **kwargs):
             await broker.startup()
             await scheduler.startup()
 
-        if len(_pending) > 0:
-            for f in _pending:
-                create_task(f())
-    await task.kiq(*args, **kwargs)
+
+async def startup():
+    # Called from the application lifespan; kiq() still starts the broker lazily for callers without one
+    await _startup_broker()
+    for p in _periodic:
+        p.start()
+    if isinstance(broker, ListQueueBroker) and _depth.every > 0:
+        _depth.start()
+    if len(_scheduled) > 0 and config.get("UNREST_SCHEDULER", "embedded") == "embedded":
+        leader.start()
+
+
+async def shutdown():
+    global _started
+    await gather(leader.stop(), _depth.stop(), *[p.stop() for p in _periodic], return_exceptions=True)
+    if _started:
+        _started = False
+        if len(_scheduled) > 0 or len(_tasked) > 0:
+            await scheduler.shutdown()
+            await broker.shutdown()
+
+
+_dispatched = metrics.counter("unrest_tasks_dispatched_total", "Tasks sent to the broker, by task", ("task",))
+_executing = metrics.gauge("unrest_tasks_inflight", "Tasks executing in this process, by task", ("task",))
+_executed = metrics.counter("unrest_tasks_executed_total", "Tasks executed by this process, by task and outcome", ("task", "outcome"))
+
+async def kiq(task: AsyncTaskiqDecoratedTask, *args, _labels: dict[str, str] | None = None, **kwargs) -> AsyncTaskiqTask:
+    await _startup_broker()
+    _dispatched.labels(task.task_name).inc()
+    with tracing.span("send %s" % task.task_name, kind=tracing.PRODUCER):
+        if _labels:
+            return await task.kicker().with_labels(**_labels).kiq(*args, **kwargs)
+        return await task.kiq(*args, **kwargs)
 
 
 async def _create_context_payload(args, kwargs) -> dict:
     return {
-        "context": context._ctx.copy(),
+        "context": context._ctx.export(),
         "fargs": list(args),
         "fkwargs": dict(kwargs),
-        "is_authenticated": context.user.is_authenticated
+        "is_authenticated": context.user.is_authenticated,
+        "is_mutation": context._ctx._global is not False,
+        "traceparent": tracing.traceparent(),
     }
 
 
+def _restore_context_payload(context_payload: dict) -> Context:
+    context_payload["context"]["user"] = AuthenticatedUser(**context_payload["context"]["user"]) if context_payload["is_authenticated"] else UnauthenticatedUser(**context_payload["context"]["user"])
+    context_payload["context"]["tenant"] = Tenant(**context_payload["context"]["tenant"])
+    context_payload["context"]["_global"] = None
+    return Context(**context_payload["context"])
+
+
 def background(pred: UserPredicateFunction = Unrestricted):
     def inner(f: Callable):
         if not iscoroutinefunction(f):
@@ -80,13 +128,11 @@ def background(pred: UserPredicateFunction = Unrestricted):
         @wraps(f)
         async def inner(context_payload: dict) -> None:
             try:
-                context_payload["context"]["user"] = AuthenticatedUser(**context_payload["context"]["user"]) if context_payload["is_authenticated"] else UnauthenticatedUser(**context_payload["context"]["user"])
-                context_payload["context"]["tenant"] = Tenant(**context_payload["context"]["tenant"])
-                context_payload["context"]["_global"] = None
-                ctx = Context(**context_payload["context"])
+                ctx = _restore_context_payload(context_payload)
                 with restorecontext(ctx): 
-                    async with operationalcontext(True, f, pred):
-                        await f(*context_payload["fargs"], **context_payload["fkwargs"])
+                    with tracing.span("task %s" % f.__name__, parent=tracing.parse(context_payload.get("traceparent")), kind=tracing.CONSUMER):
+                        async with operationalcontext(True, f, pred):
+                            await f(*context_payload["fargs"], **context_payload["fkwargs"])
             except Exception as e:
                 log.exception("Error in background task %s: %s", f.__name__, e)
 
@@ -103,6 +149,124 @@ def background(pred: UserPredicateFunction = Unrestricted):
 
 
 
+class Schedule:
+    def __init__(self, task: AsyncTaskiqDecoratedTask, cron: str, name: str):
+        self.task = task
+        self.cron = cron
+        self.name = name
+        self.runs = 0
+        self.missed = 0
+
+    def due(self, last: datetime, now: datetime) -> int:
+        # Number of cron ticks (at minute resolution) in the interval (last, now]
+        n = 0
+        t = last.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        while t <= now:
+            if pycron.is_now(self.cron, t):
+                n += 1
+            t += timedelta(minutes=1)
+        return n
+
+
+class Scheduler:
+    # Every app instance runs one of these; a session-level advisory lock elects a single leader that
+    # dispatches cron jobs to the broker. Postgres drops the lock with the leader's connection, so a
+    # follower takes over within `interval` seconds and catches up on ticks missed in the meantime.
+    lock = 7281903461
+
+    def __init__(self, interval: float = 5.0, catchup: timedelta = timedelta(hours=1)):
+        self.interval = interval
+        self.catchup = catchup
+        self.is_leader = False
+        self._conn: Any = None
+        self._task: Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _elect(self):
+        from unrest.db import connect
+
+        if self._conn is None or self._conn.is_closed():
+            dsn = config.get("POSTGRES_MUTATE_URI")
+            if dsn is None:
+                raise RuntimeError("Invalid Postgres DSN configuration")
+            self._conn = await connect(dsn)
+        if self.is_leader:
+            # Session locks are re-entrant, so just check the session holding it is still alive
+            await self._conn.execute("SELECT 1")
+            return
+        res = await self._conn.fetchrow("SELECT pg_try_advisory_lock($1) as lock", self.lock)
+        if res["lock"]:
+            log.info("Scheduler elected leader")
+        self.is_leader = res["lock"]
+
+    async def _resign(self):
+        conn, self._conn = self._conn, None
+        if self.is_leader:
+            self.is_leader = False
+            log.info("Scheduler resigned leadership")
+        if conn is not None and not conn.is_closed():
+            try:
+                await conn.close(timeout=5)
+            except Exception:
+                conn.terminate()
+
+    async def tick(self, now: datetime | None = None):
+        now = now or datetime.now(timezone.utc)
+        rows = await self._conn.fetch("SELECT name, last_run FROM _schedules")
+        last_runs = {r["name"]: r["last_run"] for r in rows}
+        for schedule in _scheduled:
+            last = max(last_runs.get(schedule.name, now - timedelta(minutes=1)), now - self.catchup)
+            n = schedule.due(last, now)
+            if n == 0:
+                continue
+            # Record first: the write only succeeds while our session (and so the lock) is still alive
+            await self._conn.execute(
+                "INSERT INTO _schedules (name, last_run) VALUES ($1, $2) ON CONFLICT (name) DO UPDATE SET last_run = EXCLUDED.last_run",
+                schedule.name,
+                now,
+            )
+            if n > 1:
+                schedule.missed += n - 1
+                log.warning("Scheduled task %s missed %d tick(s), catching up", schedule.name, n - 1)
+            schedule.runs += 1
+            await kiq(schedule.task)
+
+    async def loop(self):
+        while True:
+            try:
+                await self._elect()
+                if self.is_leader:
+                    await self.tick()
+            except CancelledError:
+                raise
+            except Exception as e:
+                log.exception("Error in scheduler: %s", e)
+                await self._resign()
+            # Followers poll for the lock; the leader wakes for each new minute
+            now = datetime.now(timezone.utc)
+            await sleep(min(self.interval, 60.0 - now.second - now.microsecond / 1e6 + 0.01))
+
+    def start(self):
+        if not self.running:
+            self._task = create_task(self.loop(), name="scheduler")
+
+    async def stop(self):
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except CancelledError:
+                pass
+        await self._resign()
+
+
+leader = Scheduler()
+
+
 def scheduled(schedule):
     def inner(f: Callable):
         if not iscoroutinefunction(f):
@@ -116,89 +280,217 @@ def scheduled(schedule):
                 async with operationalcontext(True, f, Unrestricted):
                     await f(*args, **kwargs)
 
-        _task = (broker.task(schedule=[{"cron": schedule}]))(inner)
-        _scheduled.append(_task)
+        _task = (broker.task())(inner)
+        _scheduled.append(Schedule(_task, schedule, f.__module__ + "." + f.__name__))
         return f
 
     return inner
 
 
-# async def result(task_id):
-#     if await results.is_result_ready(task_id):
-#         try:
-#             res = await results.get_result(task_id)
-#         except Exception:
-#             raise TaskNotReady("Please try again later")
-#         res.raise_for_error()
-#         return res.return_value
-#     raise TaskNotReady("Please try again later")
-
-
-# def synchronous(timeout=10.0):
-#     def inner(f: callable):
-#         if not iscoroutinefunction(f):
-#             raise RuntimeError("Background task %s is not async" % f.__name__)
-
-#         @wraps(f)
-#         async def inner(*args, **kwargs):
-#             context.set(False)
-#             return await f(*args, **kwargs)
-
-#         _task = (broker.task())(inner)
-#         _tasked.append(_task)
+def _owns(task_id: str, owner: Any):
+    # Task ids are bearer handles, so only hand results (and failures) back to whoever launched the task
+    owner = owner if isinstance(owner, dict) else {}
+    if owner.get("unrest_user") != str(context.user.identity) or owner.get("unrest_tenant") != str(context.tenant.identity):
+        raise Unauthorized("Task result belongs to another user: %s" % task_id)
+
+
+async def result(task_id: str) -> Any:
+    if not await results.is_result_ready(task_id):
+        # NB: launched tasks are marked queued until their result arrives, anything else is unknown (or expired)
+        progress = await results.get_progress(task_id)
+        if progress is None:
+            raise TaskNotFound()
+        _owns(task_id, progress.meta)
+        raise TaskNotReady()
+    try:
+        res = await results.get_result(task_id)
+    except Exception:
+        raise TaskNotReady()
+    _owns(task_id, res.labels)
+    res.raise_for_error()
+    return res.return_value
+
+
+def _offloaded(f: Callable, pred: UserPredicateFunction) -> AsyncTaskiqDecoratedTask:
+    name = f.__module__ + ":" + f.__name__
+    executing, ok, error = _executing.labels(name), _executed.labels(name, "ok"), _executed.labels(name, "error")
+
+    @wraps(f)
+    async def inner(context_payload: dict) -> Any:
+        ctx = _restore_context_payload(context_payload)
+        executing.inc()
+        try:
+            with restorecontext(ctx):
+                with tracing.span("task %s" % f.__name__, parent=tracing.parse(context_payload.get("traceparent")), kind=tracing.CONSUMER):
+                    async with operationalcontext(context_payload["is_mutation"], f, pred):
+                        value = await f(*context_payload["fargs"], **context_payload["fkwargs"])
+        except BaseException:
+            error.inc()
+            raise
+        finally:
+            executing.dec()
+        ok.inc()
+        return value
+
+    _task = (broker.task())(inner)
+    _tasked.append(_task)
+    return _task
+
+
+# Runs on a worker and awaits the result, raising TaskTimeout after `timeout` seconds
+def synchronous(timeout=10.0, pred: UserPredicateFunction = Unrestricted):
+    def inner(f: Callable):
+        if not iscoroutinefunction(f):
+            raise RuntimeError("Background task %s is not async" % f.__name__)
 
-#         @wraps(f)
-#         async def wrapper(*args, **kwargs):
-#             task = await _task.kiq(*args, **kwargs)
-#             try:
-#                 res = await task.wait_result(timeout=timeout)
-#                 return res.return_value
-#             except Exception:
-#                 raise TaskTimeout()
+        _task = _offloaded(f, pred)
 
-#         return wrapper
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            task = await kiq(_task, await _create_context_payload(args, kwargs))
+            try:
+                res = await task.wait_result(timeout=timeout)
+            except TaskiqResultTimeoutError:
+                raise TaskTimeout()
+            res.raise_for_error()
+            return res.return_value
 
-#     return inner
+        return wrapper
 
+    return inner
 
-# def asynchronous():
-#     def inner(f: callable):
-#         if not iscoroutinefunction(f):
-#             raise RuntimeError("Background task %s is not async" % f.__name__)
 
-#         @wraps(f)
-#         async def inner(*args, **kwargs):
-#             context.set(False)
-#             return await f(*args, **kwargs)
+# Runs on a worker and returns the task id immediately; poll for the outcome with result()
+def asynchronous(pred: UserPredicateFunction = Unrestricted):
+    def inner(f: Callable):
+        if not iscoroutinefunction(f):
+            raise RuntimeError("Background task %s is not async" % f.__name__)
 
-#         _task = (broker.task())(inner)
-#         _tasked.append(_task)
+        _task = _offloaded(f, pred)
 
-#         @wraps(f)
-#         async def wrapper(*args, **kwargs):
-#             task = await _task.kiq(*args, **kwargs)
-#             return task.task_id
+        @wraps(f)
+        async def wrapper(*args, **kwargs) -> str:
+            # NB: the owner travels as labels, which are kept with the result whether the task succeeds or fails
+            owner = {"unrest_user": str(context.user.identity), "unrest_tenant": str(context.tenant.identity)}
+            task = await kiq(_task, await _create_context_payload(args, kwargs), _labels=owner)
+            await results.set_progress(task.task_id, TaskProgress(state="QUEUED", meta=owner))
+            return task.task_id
 
-#         return wrapper
+        return wrapper
 
-#     return inner
+    return inner
 
 
-def lightweight(every=10.0):
+class Periodic:
+    def __init__(self, f: Callable, every: float, jitter: float = 0.0):
+        self.function = f
+        self.every = every
+        self.jitter = jitter
+        self.name = f.__module__ + "." + f.__name__
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.duration = 0.0
+        self.total = 0.0
+        self._task: Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def run(self):
+        t_start = perf_counter()
+        try:
+            with restorecontext(Context()), tracing.span("periodic %s" % self.name):
+                with requestcontext():
+                    with systemcontext():
+                        async with operationalcontext(True, self.function, Unrestricted):
+                            await self.function()
+        except Exception as e:
+            self.failures += 1
+            log.exception("Error in lightweight task %s: %s", self.name, e)
+        finally:
+            self.duration = perf_counter() - t_start
+            self.total += self.duration
+            self.runs += 1
+
+    async def loop(self):
+        # Ticks are on a fixed grid from the first run, so runtime and jitter never accumulate as drift.
+        # Runs are awaited inline (never overlap); ticks that pass while a run is in progress are skipped.
+        clock = get_running_loop().time
+        tick = clock()
+        while True:
+            delay = tick - clock()
+            if self.jitter > 0:
+                delay += random.uniform(0, self.jitter)
+            if delay > 0:
+                await sleep(delay)
+            await self.run()
+            tick += self.every
+            now = clock()
+            if now > tick:
+                missed = int((now - tick) // self.every) + 1
+                self.skipped += missed
+                tick += missed * self.every
+                log.warning("Lightweight task %s overran, skipped %d tick(s)", self.name, missed)
+
+    def start(self):
+        if not self.running:
+            self._task = create_task(self.loop(), name="lightweight:%s" % self.name)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except CancelledError:
+            pass
+
+
+def lightweight(every=10.0, jitter=0.0):
     def inner(f: Callable):
         if not iscoroutinefunction(f):
             raise RuntimeError("Background task %s is not async" % f.__name__)
 
-        async def wrapper():
-            while True:
-                try:
-                    # TODO: restore context?
-                    await f()
-                except Exception:
-                    pass
-                await sleep(every)
-
-        _pending.append(wrapper)
+        _periodic.append(Periodic(f, every, jitter))
         return f
 
     return inner
+
+
+# Depth of the broker's queue (shared by every producer and worker), sampled since collectors can't await Redis
+_queued: int | None = None
+
+async def _sample_queue():
+    global _queued
+    async with Redis(connection_pool=broker.connection_pool) as conn: # type:ignore
+        _queued = await conn.llen(broker.queue_name) # type:ignore
+
+_depth = Periodic(_sample_queue, float(config.get("UNREST_TASK_QUEUE_POLL", "15"))) # type:ignore
+
+
+@metrics.collector
+def _collect():
+    runs = metrics.Counter("unrest_periodic_runs_total", "Lightweight task runs, by task and outcome", ("task", "outcome"))
+    skipped = metrics.Counter("unrest_periodic_skipped_total", "Lightweight task ticks skipped because a run overran", ("task",))
+    seconds = metrics.Counter("unrest_periodic_seconds_total", "Time spent in lightweight task runs", ("task",))
+    for p in _periodic:
+        runs.labels(p.name, "ok").set(p.runs - p.failures)
+        runs.labels(p.name, "error").set(p.failures)
+        skipped.labels(p.name).set(p.skipped)
+        seconds.labels(p.name).set(p.total)
+    scheduled = metrics.Counter("unrest_scheduled_runs_total", "Scheduled task runs dispatched by this process, by task", ("task",))
+    missed = metrics.Counter("unrest_scheduled_missed_total", "Scheduled ticks coalesced into a catch-up run, by task", ("task",))
+    for sched in _scheduled:
+        scheduled.labels(sched.name).set(sched.runs)
+        missed.labels(sched.name).set(sched.missed)
+    leading = metrics.Gauge("unrest_scheduler_leader", "Whether this process is the scheduler leader")
+    leading.set(1 if leader.is_leader else 0)
+    collected = [runs, skipped, seconds, scheduled, missed, leading]
+    if _queued is not None:
+        queued = metrics.Gauge("unrest_tasks_queued", "Tasks waiting in the broker queue, as last sampled")
+        queued.set(_queued)
+        collected.append(queued)
+    return collected
@@ -0,0 +1,239 @@
+import atexit
+import os
+import threading
+import time
+from contextvars import ContextVar
+from queue import Empty, SimpleQueue
+from random import random
+from typing import Any, Iterable
+
+from unrest.contexts import config
+
+# OpenTelemetry-compatible spans with W3C trace context (https://www.w3.org/TR/trace-context/).
+#
+# Tracing is off unless an exporter is configured (UNREST_TRACE_EXPORTER=otlp, or configure() in code), and
+# costs one global check per span when it is. Root spans are sampled at UNREST_TRACE_SAMPLE; children follow.
+
+INTERNAL, SERVER, CLIENT, PRODUCER, CONSUMER = 1, 2, 3, 4, 5
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "sampled", "attributes", "start", "end", "status", "message", "_token")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None, sampled: bool, kind: int = INTERNAL, attributes: dict | None = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.sampled = sampled
+        self.attributes = attributes if attributes is not None else {}
+        self.start = time.time_ns()
+        self.end = 0
+        self.status = 0
+        self.message = ""
+        self._token = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def finish(self, ex: BaseException | None = None):
+        self.end = time.time_ns()
+        if ex is not None:
+            self.status = 2
+            self.message = "%s: %s" % (type(ex).__name__, ex)
+        if self.sampled and _exporter is not None:
+            _exporter.export(self)
+
+    @property
+    def traceparent(self) -> str:
+        return "00-%s-%s-%s" % (self.trace_id, self.span_id, "01" if self.sampled else "00")
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self) # type:ignore
+        return self
+
+    def __exit__(self, kind, ex, tb):
+        _current.reset(self._token) # type:ignore
+        self.finish(ex)
+
+
+class _Noop:
+    __slots__ = ()
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def finish(self, ex: BaseException | None = None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, ex, tb):
+        pass
+
+_noop = _Noop()
+_current = ContextVar[Span | None]("span", default=None)
+
+
+def current() -> Span | None:
+    return _current.get()
+
+
+def parse(traceparent: str | None) -> tuple[str, str, bool] | None:
+    # version-trace_id-parent_id-flags, anything malformed starts a new trace
+    if not traceparent:
+        return None
+    parts = traceparent.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        return parts[1], parts[2], bool(int(parts[3][:2], 16) & 1)
+    except ValueError:
+        return None
+
+
+def traceparent() -> str | None:
+    span = _current.get()
+    return None if span is None else span.traceparent
+
+
+def span(name: str, attributes: dict | None = None, parent: tuple[str, str, bool] | None = None, kind: int = INTERNAL) -> Span | _Noop:
+    # Use as a context manager to make it the current span, or call finish() on a span that must not be current
+    if _exporter is None:
+        return _noop
+    if parent is None:
+        up = _current.get()
+        if up is not None:
+            if not up.sampled:
+                return _noop
+            return Span(name, up.trace_id, up.span_id, True, kind, attributes)
+        return Span(name, os.urandom(16).hex(), None, random() < _sample, kind, attributes)
+    return Span(name, parent[0], parent[1], parent[2], kind, attributes)
+
+
+def incoming(name: str, request: Any) -> Span | _Noop:
+    # Server span for an HTTP request, continuing the caller's trace if it sent a traceparent header
+    if _exporter is None:
+        return _noop
+    attributes = {"http.request.method": request.method, "url.path": request.url.path}
+    return span(name, attributes, parse(request.headers.get("traceparent")), SERVER)
+
+
+class MemoryExporter:
+    # Collector stand-in for tests and local debugging
+    def __init__(self):
+        self.spans: list[Span] = []
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def clear(self):
+        self.spans.clear()
+
+    def shutdown(self):
+        pass
+
+
+def _value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp(spans: Iterable[Span], service: str) -> dict:
+    # OTLP/HTTP JSON encoding of a batch of spans
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+            "scopeSpans": [{
+                "scope": {"name": "unrest"},
+                "spans": [{
+                    "traceId": s.trace_id,
+                    "spanId": s.span_id,
+                    **({"parentSpanId": s.parent_id} if s.parent_id else {}),
+                    "name": s.name,
+                    "kind": s.kind,
+                    "startTimeUnixNano": str(s.start),
+                    "endTimeUnixNano": str(s.end),
+                    "attributes": [{"key": k, "value": _value(v)} for (k, v) in s.attributes.items()],
+                    "status": {"code": s.status or 1, **({"message": s.message} if s.message else {})},
+                } for s in spans],
+            }],
+        }]
+    }
+
+
+class OTLPExporter:
+    # Posts batches to an OTLP/HTTP collector from a background thread, so exporting never blocks the loop
+    def __init__(self, endpoint: str, service: str = "unrest", batch: int = 512, interval: float = 1.0, maxsize: int = 10000):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service = service
+        self.batch = batch
+        self.interval = interval
+        self.maxsize = maxsize
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue: SimpleQueue = SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="unrest-trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span):
+        if self._queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self._queue.put_nowait(span)
+
+    def _run(self):
+        import httpx
+        with httpx.Client(timeout=5.0) as client:
+            while True:
+                spans: list[Span] = []
+                stop = False
+                deadline = time.monotonic() + self.interval
+                try:
+                    while len(spans) < self.batch:
+                        span = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                        if span is None:
+                            stop = True
+                            break
+                        spans.append(span)
+                except Empty:
+                    pass
+                if spans:
+                    try:
+                        client.post(self.url, json=otlp(spans, self.service)).raise_for_status()
+                        self.exported += len(spans)
+                    except Exception:
+                        self.errors += 1
+                if stop:
+                    return
+
+    def shutdown(self, timeout: float = 5.0):
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+
+_exporter: Any = None
+_sample = float(config.get("UNREST_TRACE_SAMPLE", "1.0")) # type:ignore
+
+
+def configure(exporter: Any, sample: float | None = None) -> Any:
+    # Replaces the exporter (None turns tracing off) and returns the previous one
+    global _exporter, _sample
+    previous, _exporter = _exporter, exporter
+    if sample is not None:
+        _sample = sample
+    return previous
+
+
+if config.get("UNREST_TRACE_EXPORTER") == "otlp":
+    configure(OTLPExporter(config.get("UNREST_OTLP_ENDPOINT", "http://localhost:4318"), config.get("UNREST_SERVICE_NAME", "unrest"))) # type:ignore
+    atexit.register(_exporter.shutdown)
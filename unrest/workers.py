@@ -0,0 +1,199 @@
+import asyncio
+import gc
+import math
+import os
+import select
+import signal
+import socket
+import time
+
+import uvicorn
+from uvicorn.importer import import_from_string
+
+from unrest import getLogger
+
+log = getLogger(__name__)
+
+# Pre-fork deployment: the application is imported (and its route tables built) once in the supervisor, then forked
+# into `workers` processes that share those pages copy-on-write. Each worker opens its own database pools before it
+# accepts connections, and is replaced if it dies.
+#
+# Workers either share the supervisor's listening socket, or with reuse_port bind their own with SO_REUSEPORT and let
+# the kernel balance connections between them. SIGHUP replaces the workers one at a time, each only once its
+# replacement is serving; SIGTERM or SIGINT shuts them all down gracefully.
+
+
+def bind(host: str, port: int, reuse_port: bool = False, backlog: int = 2048) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def prepare(target: str):
+    # Everything workers can share: the application, its routes, and the objects they hold
+    app = import_from_string(target)
+    from unrest.api import get_instance as get_api
+    from unrest.app import get_instance as get_app
+    get_api()
+    get_app()
+    # NB: keeps the collector from touching (and so copying) the shared objects in every worker
+    gc.collect()
+    gc.freeze()
+    return app
+
+
+class Supervisor:
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 8000, workers: int | None = None, reuse_port: bool = False, graceful: float = 30.0, ready_timeout: float = 60.0):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        self.graceful = graceful
+        self.ready_timeout = ready_timeout
+        self.pids: set[int] = set()
+        self._retired: set[int] = set()
+        self._socket: socket.socket | None = None
+        self._signals: list[int] = []
+
+    def spawn(self) -> tuple[int, int]:
+        # Returns the worker's pid and a pipe that is written to once it is serving (or closed if it fails)
+        ready, notify = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready)
+            code = 1
+            try:
+                for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+                    signal.signal(sig, signal.SIG_DFL)
+                code = asyncio.run(self.serve(notify))
+            except BaseException as ex:
+                log.exception(ex)
+            finally:
+                os._exit(code)
+        os.close(notify)
+        self.pids.add(pid)
+        return pid, ready
+
+    async def serve(self, notify: int) -> int:
+        from unrest.db import pool
+        sock = self._socket or bind(self.host, self.port, reuse_port=True)
+        try:
+            await pool.warmup()
+        except Exception as ex:
+            log.warning("Unable to warm database pools: %s", ex)
+
+        # NB: uvicorn takes whole seconds, round up so a short grace period isn't none at all
+        server = uvicorn.Server(uvicorn.Config(self.app, lifespan="on", timeout_graceful_shutdown=math.ceil(self.graceful), log_config=None))
+        serving = asyncio.create_task(server.serve(sockets=[sock]))
+        while not server.started and not serving.done():
+            await asyncio.sleep(0.05)
+        if server.started:
+            os.write(notify, b"1")
+        os.close(notify)
+        await serving
+        return 0 if server.started else 1
+
+    def wait_ready(self, pid: int, ready: int) -> bool:
+        try:
+            deadline = time.monotonic() + self.ready_timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                if select.select([ready], [], [], remaining)[0]:
+                    return os.read(ready, 1) == b"1"
+            return False
+        finally:
+            os.close(ready)
+
+    def start(self) -> bool:
+        pid, ready = self.spawn()
+        if self.wait_ready(pid, ready):
+            return True
+        log.error("Worker %d did not start", pid)
+        self.retire(pid, signal.SIGKILL)
+        return False
+
+    def retire(self, pid: int, sig: int = signal.SIGTERM):
+        self.pids.discard(pid)
+        self._retired.add(pid)
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def reap(self) -> list[tuple[int, int]]:
+        # Workers that exited without being retired
+        exited = []
+        while self.pids or self._retired:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.pids.clear()
+                self._retired.clear()
+                break
+            if pid == 0:
+                break
+            if pid in self.pids:
+                self.pids.discard(pid)
+                exited.append((pid, status))
+            self._retired.discard(pid)
+        return exited
+
+    def restart(self):
+        # Rolling: each worker is stopped only once its replacement is serving
+        for old in list(self.pids):
+            if not self.start():
+                log.error("Keeping worker %d", old)
+                continue
+            self.retire(old)
+            log.info("Retired worker %d", old)
+
+    def shutdown(self):
+        for pid in list(self.pids):
+            self.retire(pid)
+        deadline = time.monotonic() + self.graceful + 5
+        while self._retired and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self._retired):
+            self.retire(pid, signal.SIGKILL)
+        while self._retired:
+            self.reap()
+            time.sleep(0.01)
+
+    def run(self):
+        if not self.reuse_port:
+            self._socket = bind(self.host, self.port)
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda sig, frame: self._signals.append(sig))
+
+        log.info("Starting %d workers on %s:%d%s", self.workers, self.host, self.port, " (SO_REUSEPORT)" if self.reuse_port else "")
+        try:
+            for _ in range(self.workers):
+                if not self.start():
+                    raise RuntimeError("Unable to start workers")
+
+            while True:
+                while self._signals:
+                    sig = self._signals.pop(0)
+                    if sig == signal.SIGHUP:
+                        log.info("Restarting workers")
+                        self.restart()
+                    else:
+                        return
+                for (pid, status) in self.reap():
+                    log.warning("Worker %d exited (status %d), replacing it", pid, status)
+                while len(self.pids) < self.workers and not self._signals:
+                    if not self.start():
+                        time.sleep(1.0)
+                time.sleep(0.2)
+        finally:
+            log.info("Stopping workers")
+            self.shutdown()
+            if self._socket is not None:
+                self._socket.close()